@@ -1,3 +1,4 @@
+from dao import get_similar_aliases
 from model import AliasMapping
 
 # return map from alias -> Player
@@ -27,14 +28,46 @@ def get_top_suggestion_for_aliases(dao, aliases):
 
 
 def get_alias_to_id_map_in_list_format(dao, aliases):
-    alias_to_id_map = get_top_suggestion_for_aliases(dao, aliases)
-    list_format = []
-    for alias, player in alias_to_id_map.iteritems():
-        list_format.append(AliasMapping(
-            player_alias=alias,
-            player_id=player.id if player else None
-        ))
-    return list_format
+    return get_alias_to_id_maps_in_list_format(dao, [aliases])[0]
+
+# same as get_alias_to_id_map_in_list_format, but for several tournaments at
+# once. all aliases are resolved together with a single player lookup
+
+
+def get_alias_to_id_maps_in_list_format(dao, alias_lists):
+    all_aliases = list({alias for aliases in alias_lists for alias in aliases})
+    alias_to_id_map = get_top_suggestion_for_aliases(dao, all_aliases)
+
+    list_formats = []
+    for aliases in alias_lists:
+        list_format = []
+        for alias in set(aliases):
+            player = alias_to_id_map[alias]
+            list_format.append(AliasMapping(
+                player_alias=alias,
+                player_id=player.id if player else None
+            ))
+        list_formats.append(list_format)
+    return list_formats
+
+# return a map from similar alias -> list of candidate Players (in the order
+# mongo returned them), plus the index of each Player in that order
+
+
+def _index_candidates(candidates):
+    alias_index = {}
+    for player in candidates:
+        for alias in player.aliases:
+            alias_index.setdefault(alias, []).append(player)
+    return alias_index, {player.id: i for i, player in enumerate(candidates)}
+
+
+def _get_suggestions(alias, alias_index, positions):
+    suggestions = {}
+    for similar_alias in get_similar_aliases(alias):
+        for player in alias_index.get(similar_alias, []):
+            suggestions[player.id] = player
+    return sorted(suggestions.values(), key=lambda p: positions[p.id])
 
 # return a map from alias -> suggestions (a list of Players)
 
@@ -42,9 +75,12 @@ def get_alias_to_id_map_in_list_format(dao, aliases):
 def get_player_suggestions_from_player_aliases(dao, aliases):
     alias_to_suggestion_map = {}
 
+    alias_index, positions = _index_candidates(
+        dao.get_players_with_similar_aliases(aliases))
+
     for alias in aliases:
-        alias_to_suggestion_map[
-            alias] = dao.get_players_with_similar_alias(alias)
+        alias_to_suggestion_map[alias] = _get_suggestions(
+            alias, alias_index, positions)
 
     return alias_to_suggestion_map
 
@@ -55,10 +91,21 @@ def get_player_suggestions_from_player_aliases(dao, aliases):
 def get_player_or_suggestions_from_player_aliases(dao, aliases):
     alias_to_player_or_suggestions_map = {}
 
+    # the exact alias is always one of the similar aliases, so one query
+    # gets us both the exact match and the suggestions for every alias
+    alias_index, positions = _index_candidates(
+        dao.get_players_with_similar_aliases(aliases))
+
     for alias in aliases:
+        player = None
+        for candidate in alias_index.get(alias.lower(), []):
+            if dao.region_id in candidate.regions:
+                player = candidate
+                break
+
         alias_to_player_or_suggestions_map[alias] = {
-            "player": dao.get_player_by_alias(alias),
-            "suggestions": dao.get_players_with_similar_alias(alias)
+            "player": player,
+            "suggestions": _get_suggestions(alias, alias_index, positions)
         }
 
     return alias_to_player_or_suggestions_map
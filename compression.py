@@ -0,0 +1,124 @@
+import threading
+import zlib
+
+from collections import OrderedDict
+from flask import request
+
+# compresses responses for clients that accept it (gzip or deflate, whichever
+# they prefer). small responses aren't worth it and go out as they are;
+# streamed responses are compressed as they stream. compressed bodies of
+# responses with an ETag are kept (per process), so a cacheable response is
+# only compressed again once it changes. that means a response with an ETag
+# must depend on nothing but its url.
+
+# smallest (uncompressed) body we compress. streamed responses, whose size we
+# don't know up front, are always compressed.
+COMPRESSION_MIN_SIZE = 1024
+COMPRESSION_LEVEL = 6
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'text/plain', 'text/html')
+
+# zlib wbits for each encoding, in order of preference
+ENCODINGS = OrderedDict([('gzip', 16 + zlib.MAX_WBITS),
+                         ('deflate', zlib.MAX_WBITS)])
+
+# how many compressed bodies we keep
+COMPRESSED_CACHE_SIZE = 32
+
+
+class CompressedCache(object):
+    '''Compressed bodies by (url, etag, encoding), least recently used ones
+    are dropped first'''
+
+    def __init__(self, size=COMPRESSED_CACHE_SIZE):
+        self.lock = threading.Lock()
+        self.size = size
+        self.bodies = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            body = self.bodies.pop(key, None)
+            if body is not None:
+                self.bodies[key] = body
+            return body
+
+    def put(self, key, body):
+        with self.lock:
+            self.bodies.pop(key, None)
+            self.bodies[key] = body
+            while len(self.bodies) > self.size:
+                self.bodies.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.bodies = OrderedDict()
+
+
+cache = CompressedCache()
+
+
+def _compressor(encoding):
+    return zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, ENCODINGS[encoding])
+
+
+def _compress_chunks(chunks, encoding, cache_key):
+    compressor = _compressor(encoding)
+    # only kept to be cached, so without a key the body isn't held in memory
+    body = [] if cache_key is not None else None
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            if body is not None:
+                body.append(data)
+            yield data
+    data = compressor.flush()
+    if body is not None:
+        body.append(data)
+    yield data
+
+    # only reached if the whole response went out
+    if body is not None:
+        cache.put(cache_key, ''.join(body))
+
+
+def compress_response(resp):
+    if resp.status_code < 200 or resp.status_code >= 300 or resp.status_code == 204:
+        return resp
+    if 'Content-Encoding' in resp.headers or resp.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return resp
+
+    resp.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(ENCODINGS.keys())
+    if encoding is None:
+        return resp
+    if not resp.is_streamed and len(resp.get_data()) < COMPRESSION_MIN_SIZE:
+        return resp
+
+    etag, _ = resp.get_etag()
+    cache_key = (request.url, etag, encoding) if etag is not None else None
+    body = cache.get(cache_key) if cache_key is not None else None
+
+    if body is not None:
+        # a streamed body is never read, so whatever it would have loaded
+        # isn't either
+        resp.set_data(body)
+    elif resp.is_streamed:
+        resp.response = _compress_chunks(resp.iter_encoded(), encoding, cache_key)
+        resp.headers.pop('Content-Length', None)
+    else:
+        compressor = _compressor(encoding)
+        body = compressor.compress(resp.get_data()) + compressor.flush()
+        if cache_key is not None:
+            cache.put(cache_key, body)
+        resp.set_data(body)
+
+    resp.headers['Content-Encoding'] = encoding
+    # the compressed body isn't byte for byte what the ETag was made for
+    if etag is not None:
+        resp.set_etag(etag, weak=True)
+    return resp
+
+
+def init_app(app):
+    '''Compresses the responses of app'''
+    app.after_request(compress_response)
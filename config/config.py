@@ -2,6 +2,16 @@ from ConfigParser import ConfigParser
 
 DEFAULT_CONFIG_PATH = './config/config.ini'
 
+# used when config.ini has no [server] section
+DEFAULT_SERVER_MODE = 'twisted'
+DEFAULT_SERVER_MIN_THREADS = 5
+DEFAULT_SERVER_MAX_THREADS = 20
+DEFAULT_SERVER_PROCESSES = 4
+DEFAULT_SERVER_THREADS = 4
+DEFAULT_SERVER_TIMING = False
+DEFAULT_PASSWORD_HASH_WORKERS = 2
+DEFAULT_MAX_PENDING_PASSWORD_HASHES = 8
+
 class Config(object):
     def __init__(self, config_file_path=DEFAULT_CONFIG_PATH):
         self.config = ConfigParser()
@@ -73,3 +83,36 @@ class Config(object):
 
     def get_dropbox_access_token(self):
         return self.config.get('dropbox', 'access_token')
+
+    def get_server_mode(self):
+        return self._get_or_default('server', 'mode', DEFAULT_SERVER_MODE)
+
+    def get_server_min_threads(self):
+        return int(self._get_or_default('server', 'min_threads', DEFAULT_SERVER_MIN_THREADS))
+
+    def get_server_max_threads(self):
+        return int(self._get_or_default('server', 'max_threads', DEFAULT_SERVER_MAX_THREADS))
+
+    def get_server_processes(self):
+        return int(self._get_or_default('server', 'processes', DEFAULT_SERVER_PROCESSES))
+
+    def get_server_threads(self):
+        return int(self._get_or_default('server', 'threads', DEFAULT_SERVER_THREADS))
+
+    def get_server_timing(self):
+        if self.config.has_option('server', 'server_timing'):
+            return self.config.getboolean('server', 'server_timing')
+        return DEFAULT_SERVER_TIMING
+
+    def get_password_hash_workers(self):
+        return int(self._get_or_default('server', 'password_hash_workers',
+                                        DEFAULT_PASSWORD_HASH_WORKERS))
+
+    def get_max_pending_password_hashes(self):
+        return int(self._get_or_default('server', 'max_pending_password_hashes',
+                                        DEFAULT_MAX_PENDING_PASSWORD_HASHES))
+
+    def _get_or_default(self, section, option, default):
+        if self.config.has_option(section, option):
+            return self.config.get(section, option)
+        return default
@@ -0,0 +1,140 @@
+import hashlib
+import threading
+import time
+
+from multiprocessing import Pool, TimeoutError
+
+import metrics
+
+# password hashing (pbkdf2) is slow on purpose. done on the request threads, a
+# burst of logins would hold up every other request, so the server hashes on
+# a small pool of worker processes instead (see init_pool), and turns logins
+# away once too many are waiting. scripts that never call init_pool hash
+# in-process. everything here is per process (each uwsgi worker has its own
+# pool and throttles).
+
+DEFAULT_NUM_WORKERS = 2
+# hashes queued or running before we turn requests away
+DEFAULT_MAX_PENDING = 8
+# how long a request waits for its hash
+HASH_TIMEOUT_SECONDS = 10
+
+# logins allowed from one ip, and failed logins allowed for one username,
+# within LOGIN_THROTTLE_WINDOW seconds
+LOGIN_THROTTLE_WINDOW = 5 * 60
+MAX_LOGINS_PER_IP = 30
+MAX_FAILED_LOGINS_PER_USERNAME = 10
+
+
+class HashPoolBusyException(Exception):
+    # caught by the server, which returns a 503
+    pass
+
+
+def _pbkdf2(password, salt, iterations):
+    return hashlib.pbkdf2_hmac('sha256', password, salt, iterations)
+
+
+class HashPool(object):
+    '''A process pool for pbkdf2, with a bound on how many hashes can be
+    waiting for it'''
+
+    def __init__(self, num_workers=DEFAULT_NUM_WORKERS, max_pending=DEFAULT_MAX_PENDING):
+        self.num_workers = num_workers
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.pool = None
+
+    def pbkdf2(self, password, salt, iterations):
+        with self.lock:
+            if self.pending >= self.max_pending:
+                raise HashPoolBusyException('too many password hashes pending')
+            self.pending += 1
+            # started on first use, so every (forked) uwsgi worker gets its own
+            if self.pool is None:
+                self.pool = Pool(self.num_workers)
+
+        try:
+            return self.pool.apply_async(_pbkdf2, (password, salt, iterations)).get(
+                HASH_TIMEOUT_SECONDS)
+        except TimeoutError:
+            raise HashPoolBusyException('password hash timed out')
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+    def close(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool.join()
+                self.pool = None
+
+
+pool = None
+
+
+def init_pool(num_workers=DEFAULT_NUM_WORKERS, max_pending=DEFAULT_MAX_PENDING):
+    '''Hashes passwords on a pool of num_workers processes from now on'''
+    global pool
+    if pool is not None:
+        pool.close()
+    pool = HashPool(num_workers, max_pending)
+
+
+def pbkdf2(password, salt, iterations):
+    '''pbkdf2_hmac sha256 of password, on the pool if there is one. Raises
+    HashPoolBusyException if the pool is full.'''
+    start = time.time()
+    try:
+        if pool is None:
+            return _pbkdf2(password, salt, iterations)
+        return pool.pbkdf2(password, salt, iterations)
+    finally:
+        metrics.record_password_hash(time.time() - start)
+
+
+class Throttle(object):
+    '''Allows max_attempts per key within any window seconds'''
+
+    def __init__(self, max_attempts, window=LOGIN_THROTTLE_WINDOW):
+        self.max_attempts = max_attempts
+        self.window = window
+        self.lock = threading.Lock()
+        self.attempts = {}
+        self.last_sweep = 0
+
+    def retry_after(self, key, now=None):
+        '''Seconds until key can make another attempt, 0 if it can now'''
+        now = now or time.time()
+        with self.lock:
+            attempts = self._current_attempts(key, now)
+            if len(attempts) < self.max_attempts:
+                return 0
+            return int(attempts[-self.max_attempts] + self.window - now) + 1
+
+    def add(self, key, now=None):
+        now = now or time.time()
+        with self.lock:
+            self._current_attempts(key, now).append(now)
+
+            # drop keys nobody has tried in a while, so we don't grow forever
+            if now - self.last_sweep > self.window:
+                for k in self.attempts.keys():
+                    if not self._current_attempts(k, now):
+                        del self.attempts[k]
+                self.last_sweep = now
+
+    def reset(self):
+        with self.lock:
+            self.attempts = {}
+
+    def _current_attempts(self, key, now):
+        attempts = [t for t in self.attempts.get(key, []) if t > now - self.window]
+        self.attempts[key] = attempts
+        return attempts
+
+
+ip_throttle = Throttle(MAX_LOGINS_PER_IP)
+username_throttle = Throttle(MAX_FAILED_LOGINS_PER_USERNAME)
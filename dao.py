@@ -1,13 +1,22 @@
-from datetime import timedelta
+from bson import json_util
+from bson.binary import Binary
+from bson.objectid import ObjectId
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 
 import base64
 import hashlib
+import hmac
 import os
 import pymongo
 import re
+import zlib
 
 from config.config import Config
 
+import credentials
+import merge_forest
 import model as M
 
 config = Config()
@@ -18,6 +27,83 @@ DATABASE_NAME = config.get_db_name()
 
 special_chars = re.compile("[^\w\s]*")
 
+RAW_FILE_COMPRESSION = 'zlib'
+# same as gridfs
+RAW_FILE_CHUNK_SIZE = 255 * 1024
+# number of chunks we buffer before writing them out
+RAW_FILE_CHUNK_BATCH_SIZE = 16
+
+# how many times we reread a tournament when a match update loses a race
+MATCH_UPDATE_RETRIES = 5
+
+# rankings are stored as changes to the previous ranking, with every this
+# many rankings in a region stored in full
+RANKING_KEYFRAME_INTERVAL = 10
+
+# every write to a player stores the next value of this counter on it
+# (change_stamp), so clients can fetch just the players that changed since
+# they last synced. a write takes its stamp before it lands, so the counter
+# also keeps the stamps of the writes still in flight (pending), and clients
+# are only ever told a stamp below all of them.
+COUNTERS_COLLECTION_NAME = 'counters'
+PLAYER_CHANGE_STAMP_COUNTER = 'players'
+# a pending write older than this is assumed to have died
+PLAYER_CHANGE_STAMP_TIMEOUT = timedelta(minutes=1)
+# every merge and unmerge stores a new (random) version of the merge forest
+# here, see merge_forest.py
+MERGE_FOREST_VERSION = 'merge_forest'
+
+# a session expires once it hasn't been used for this long. mongo deletes
+# expired sessions (with a TTL index on last_seen), and we check the expiry
+# ourselves too, since mongo only gets around to it every minute or so.
+SESSION_TTL = timedelta(days=30)
+# we only write a session's last_seen when it's at least this old, so most
+# requests only read their session
+SESSION_LAST_SEEN_INTERVAL = timedelta(minutes=10)
+
+# documents fetched per round trip by the iter_* methods
+ITER_BATCH_SIZE = 500
+
+# the *_page methods return pages of documents in (key, _id) order, and an
+# opaque cursor for the next page: the key and _id of the last document on
+# the page. the next page starts right after that document, so (with an index
+# on (key, _id)) fetching any page costs the same, no matter how deep it is.
+
+
+def encode_page_cursor(key, id):
+    return base64.urlsafe_b64encode(json_util.dumps([key, id]))
+
+
+def decode_page_cursor(cursor):
+    '''Returns the (key, id) in cursor. Raises ValueError if cursor wasn't
+    made by encode_page_cursor.'''
+    try:
+        key, id = json_util.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise ValueError('invalid cursor')
+    if not isinstance(id, ObjectId):
+        raise ValueError('invalid cursor')
+    # json_util gives us timezone aware dates, we store naive ones
+    if isinstance(key, datetime):
+        key = key.replace(tzinfo=None)
+    return key, id
+
+
+def _projection(document_class, fields, sort_key=None):
+    '''The projection that loads fields of document_class (and its required
+    fields, which loading needs). None (every field) if fields is None.
+    sort_key is included when given (mongomock sorts projected documents).'''
+    if fields is None:
+        return None
+    projection = [sort_key] if sort_key is not None else []
+    for field_name, field in document_class.fields:
+        if field_name in fields or field.required:
+            db_name = field_name
+            if isinstance(field.load_from, dict):
+                db_name = field.load_from.get('db', field_name)
+            projection.append(db_name)
+    return projection
+
 
 # make sure all the exceptions here are properly caught, or the server code
 # knows about them.
@@ -47,19 +133,172 @@ class InvalidNameException(Exception):
     pass
 
 
+class ConcurrentUpdateException(Exception):
+    # caught by the match resources in server
+    pass
+
+
 def gen_password(password):
     # more bytes of randomness? i think 16 bytes is sufficient for a salt
     salt = base64.b64encode(os.urandom(16))
-    hashed_password = base64.b64encode(hashlib.pbkdf2_hmac(
-        'sha256', password, salt, ITERATION_COUNT))
+    hashed_password = base64.b64encode(credentials.pbkdf2(password, salt, ITERATION_COUNT))
 
     return salt, hashed_password
 
 
 def verify_password(password, salt, hashed_password):
-    the_hash = base64.b64encode(hashlib.pbkdf2_hmac(
-        'sha256', password, salt, ITERATION_COUNT))
-    return (the_hash and the_hash == hashed_password)
+    the_hash = base64.b64encode(credentials.pbkdf2(password, salt, ITERATION_COUNT))
+    return (the_hash and hmac.compare_digest(the_hash, str(hashed_password)))
+
+
+def hash_session_token(session_id):
+    return hashlib.sha256(session_id).hexdigest()
+
+
+def get_similar_aliases(alias):
+    '''Returns the list of lowercase aliases we consider "similar" to alias
+    (used for merge targets and alias suggestions).'''
+    alias_lower = alias.lower()
+
+    # here be regex dragons
+    re_test_1 = '([1-9]+\s+[1-9]+\s+)(.+)'  # to match '1 1 slox'
+    re_test_2 = '(.[1-9]+.[1-9]+\s+)(.+)'  # to match 'p1s1 slox'
+
+    alias_set_1 = re.split(re_test_1, alias_lower)
+    alias_set_2 = re.split(re_test_2, alias_lower)
+
+    similar_aliases = [
+        alias_lower,
+        alias_lower.replace(" ", ""),  # remove spaces
+        # remove special characters
+        re.sub(special_chars, '', alias_lower),
+        # remove everything before the last special character; hopefully
+        # removes crew/sponsor tags
+        re.split(special_chars, alias_lower)[-1].strip()
+    ]
+
+    # regex nonsense to deal with pool prefixes
+    # prevent index OOB errors when dealing with tags that don't split well
+    if len(alias_set_1) == 4:
+        similar_aliases.append(alias_set_1[2].strip())
+    if len(alias_set_2) == 4:
+        similar_aliases.append(alias_set_2[2].strip())
+
+    # add suffixes of the string
+    alias_words = alias_lower.split()
+    similar_aliases.extend([' '.join(alias_words[i:])
+                            for i in xrange(len(alias_words))])
+
+    # uniqify
+    return list(set(similar_aliases))
+
+
+def compress_chunks(pieces, chunk_size=RAW_FILE_CHUNK_SIZE):
+    '''Yields the data in pieces (an iterable of strings) zlib-compressed, in
+    chunk_size pieces. Compresses as it goes so neither the data nor the
+    whole compressed blob is ever held in memory.'''
+    compressor = zlib.compressobj()
+    buf = ''
+    for data in pieces:
+        for i in xrange(0, len(data), chunk_size):
+            buf += compressor.compress(data[i:i + chunk_size])
+            while len(buf) >= chunk_size:
+                yield buf[:chunk_size]
+                buf = buf[chunk_size:]
+
+    buf += compressor.flush()
+    while buf:
+        yield buf[:chunk_size]
+        buf = buf[chunk_size:]
+
+
+def add_head_to_head_deltas(deltas, matches, sign=1):
+    '''Adds the change in head to head counts from adding (sign=1) or removing
+    (sign=-1) matches to deltas, a map from (player, opponent) to changes in
+    wins, losses and excluded. Returns deltas.'''
+    for match in matches:
+        for player, opponent in ((match.winner, match.loser), (match.loser, match.winner)):
+            if match.excluded:
+                field = 'excluded'
+            elif player == match.winner:
+                field = 'wins'
+            else:
+                field = 'losses'
+            counts = deltas.setdefault((player, opponent),
+                                       {'wins': 0, 'losses': 0, 'excluded': 0})
+            counts[field] += sign
+    return deltas
+
+
+def add_region_head_to_head_deltas(region_deltas, deltas, regions):
+    '''Adds deltas (see add_head_to_head_deltas) to the head to head records
+    in every one of regions. region_deltas is a map from (player, opponent,
+    region) to changes in wins, losses and excluded. Returns region_deltas.'''
+    for (player, opponent), counts in deltas.iteritems():
+        for region in regions:
+            total = region_deltas.setdefault((player, opponent, region),
+                                             {'wins': 0, 'losses': 0, 'excluded': 0})
+            for field, count in counts.iteritems():
+                total[field] += count
+    return region_deltas
+
+
+def encode_ranking(ranking, previous=None, previous_doc=None):
+    '''Returns the document to store for ranking, given the ranking before it
+    in the same region (previous, and the document it was stored as).
+
+    Every document has the id of the last full ranking (keyframe_id) and how
+    many rankings it is after it (depth). Rankings in between only store the
+    entries that changed (changes), the players who dropped out (removed) and
+    the tournaments that were added or removed.'''
+    doc = ranking.dump(context='db')
+    if previous is None or previous_doc.get('keyframe_id') is None or \
+            previous_doc['depth'] + 1 >= RANKING_KEYFRAME_INTERVAL:
+        doc['keyframe_id'] = ranking.id
+        doc['depth'] = 0
+        return doc
+
+    old_entries = {entry.player: entry for entry in previous.ranking}
+    new_players = {entry.player for entry in ranking.ranking}
+    old_tournaments = set(previous.tournaments)
+    new_tournaments = set(ranking.tournaments)
+
+    doc['keyframe_id'] = previous_doc['keyframe_id']
+    doc['depth'] = previous_doc['depth'] + 1
+    doc['ranking'] = []
+    doc['tournaments'] = []
+    doc['changes'] = [entry.dump(context='db') for entry in ranking.ranking
+                      if old_entries.get(entry.player) != entry]
+    doc['removed'] = [player for player in old_entries if player not in new_players]
+    doc['tournaments_added'] = [t for t in ranking.tournaments if t not in old_tournaments]
+    doc['tournaments_removed'] = [t for t in previous.tournaments if t not in new_tournaments]
+    return doc
+
+
+def decode_rankings(docs):
+    '''Yields the Rankings stored in docs, which must be in the order they were
+    stored in (and start at a full ranking)'''
+    entries = {}
+    tournaments = []
+    for doc in docs:
+        ranking = M.Ranking.load(doc, context='db')
+        if doc.get('depth'):
+            for e in doc.get('changes', []):
+                entry = M.RankingEntry.load(e, context='db')
+                entries[entry.player] = entry
+            for player in doc.get('removed', []):
+                entries.pop(player, None)
+            removed_tournaments = set(doc.get('tournaments_removed', []))
+            tournaments = [t for t in tournaments if t not in removed_tournaments] + \
+                doc.get('tournaments_added', [])
+
+            ranking.ranking = sorted(entries.values(), key=lambda e: (e.rank, -e.rating))
+            ranking.tournaments = list(tournaments)
+        else:
+            # a full ranking (rankings from before delta encoding have no depth)
+            entries = {entry.player: entry for entry in ranking.ranking}
+            tournaments = list(ranking.tournaments)
+        yield ranking
 
 
 # TODO create RegionSpecificDao object rn we pass in norcal for a buncha
@@ -78,6 +317,8 @@ class Dao(object):
 
     def __init__(self, region_id, mongo_client, database_name=DATABASE_NAME):
         self.players_col = mongo_client[database_name][M.Player.collection_name]
+        self.deleted_players_col = mongo_client[database_name][M.Player.deleted_collection_name]
+        self.counters_col = mongo_client[database_name][COUNTERS_COLLECTION_NAME]
         self.tournaments_col = mongo_client[
             database_name][M.Tournament.collection_name]
         self.rankings_col = mongo_client[
@@ -88,9 +329,60 @@ class Dao(object):
         self.merges_col = mongo_client[database_name][M.Merge.collection_name]
         self.sessions_col = mongo_client[database_name][M.Session.collection_name]
         self.raw_files_col = mongo_client[database_name][M.RawFile.collection_name]
+        self.raw_file_chunks_col = mongo_client[database_name][M.RawFile.chunks_collection_name]
         self.regions_col = mongo_client[database_name][M.Region.collection_name]
+        self.head_to_head_col = mongo_client[database_name][M.HeadToHead.collection_name]
+        self.player_stats_col = mongo_client[database_name][M.PlayerStats.collection_name]
+        self.ratings_col = mongo_client[database_name][M.PlayerRating.collection_name]
         self.mongo_client = mongo_client
+        self.database_name = database_name
         self.region_id = region_id
+        # loaded on first use, see get_merge_forest
+        self._merge_forest = None
+
+    @classmethod
+    def ensure_indexes(cls, mongo_client, database_name=DATABASE_NAME):
+        '''Creates the indexes (and counters) the dao relies on. Safe to run
+        repeatedly.'''
+        db = mongo_client[database_name]
+        # the merge forest is only cached once it has a version
+        db[COUNTERS_COLLECTION_NAME].update_one(
+            {'_id': MERGE_FOREST_VERSION},
+            {'$setOnInsert': {'version': ObjectId()}},
+            upsert=True)
+        db[M.RawFile.chunks_collection_name].create_index(
+            [('raw_id', pymongo.ASCENDING), ('n', pymongo.ASCENDING)], unique=True)
+        db[M.HeadToHead.collection_name].create_index(
+            [('region', pymongo.ASCENDING), ('player', pymongo.ASCENDING),
+             ('opponent', pymongo.ASCENDING)], unique=True)
+        db[M.Ranking.collection_name].create_index(
+            [('region', pymongo.ASCENDING), ('time', pymongo.ASCENDING)])
+        db[M.Player.collection_name].create_index('change_stamp')
+        db[M.PlayerRating.collection_name].create_index(
+            [('player', pymongo.ASCENDING), ('region', pymongo.ASCENDING)], unique=True)
+        db[M.Player.collection_name].create_index(
+            [('sort_name', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)])
+        db[M.Player.collection_name].create_index(
+            [('regions', pymongo.ASCENDING), ('sort_name', pymongo.ASCENDING),
+             ('_id', pymongo.ASCENDING)])
+        db[M.Tournament.collection_name].create_index(
+            [('regions', pymongo.ASCENDING), ('date', pymongo.ASCENDING),
+             ('_id', pymongo.ASCENDING)])
+        db[M.Tournament.collection_name].create_index('players')
+        db[M.Merge.collection_name].create_index(
+            [('time', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)])
+        db[M.Merge.collection_name].create_index('source_player_obj_id')
+        db[M.Player.collection_name].create_index('merge_children')
+        db[M.Player.deleted_collection_name].create_index('change_stamp')
+        db[M.Ranking.collection_name].create_index(
+            [('keyframe_id', pymongo.ASCENDING), ('depth', pymongo.ASCENDING)])
+        # sessions from before we hashed them have no token_hash, and would
+        # all collide in the unique index
+        cls(None, mongo_client, database_name=database_name).hash_session_ids()
+        db[M.Session.collection_name].create_index('token_hash', unique=True)
+        db[M.Session.collection_name].create_index('user_id')
+        db[M.Session.collection_name].create_index(
+            'last_seen', expireAfterSeconds=int(SESSION_TTL.total_seconds()))
 
     @classmethod
     def insert_region(cls, region, mongo_client, database_name=DATABASE_NAME):
@@ -103,24 +395,48 @@ class Dao(object):
             database_name][M.Region.collection_name].find()]
         return sorted(regions, key=lambda r: r.display_name)
 
-    def get_player_by_id(self, id):
-        '''id must be an ObjectId'''
-        return M.Player.load(self.players_col.find_one({'_id': id}), context='db')
+    def _load_players(self, docs, fields=None):
+        '''Loads player documents, and fills in their ratings from the ratings
+        collection (unless fields leaves them out). Ratings still on the
+        document (players from before the ratings collection) are kept, unless
+        the collection has one for the same region.'''
+        players = [M.Player.load(p, context='db') for p in docs]
+        if fields is None or 'ratings' in fields:
+            ratings = self.get_ratings([player.id for player in players])
+            for player in players:
+                player.ratings.update(ratings.get(player.id, {}))
+        return players
+
+    def _load_player(self, doc, fields=None):
+        if doc is None:
+            return None
+        return self._load_players([doc], fields)[0]
+
+    def get_player_by_id(self, id, fields=None):
+        '''id must be an ObjectId. With fields, only those fields are loaded.'''
+        return self._load_player(self.players_col.find_one(
+            {'_id': id}, _projection(M.Player, fields)), fields)
+
+    def get_players_by_ids(self, ids, fields=None):
+        '''ids must be ObjectIds'''
+        return self._load_players(
+            self.players_col.find({'_id': {'$in': list(ids)}}, _projection(M.Player, fields)),
+            fields)
 
     def get_player_by_alias(self, alias):
         '''Converts alias to lowercase'''
-        return M.Player.load(self.players_col.find_one({
+        return self._load_player(self.players_col.find_one({
             'aliases': {'$in': [alias.lower()]},
             'regions': {'$in': [self.region_id]},
             'merged': False
-        }), context='db')
+        }))
 
     def get_players_by_alias_from_all_regions(self, alias):
         '''Converts alias to lowercase'''
-        return [M.Player.load(p, context='db') for p in self.players_col.find({
+        return self._load_players(self.players_col.find({
             'aliases': {'$in': [alias.lower()]},
             'merged': False
-        })]
+        }))
 
     def get_player_id_map_from_player_aliases(self, aliases):
         '''Given a list of player aliases, returns a list of player aliases/id pairs for the current
@@ -147,24 +463,256 @@ class Dao(object):
             mongo_request['regions'] = {'$in': [self.region_id]}
         if not include_merged:
             mongo_request['merged'] = False
-        return [M.Player.load(p, context='db')
-                for p in self.players_col.find(mongo_request).sort([('name', 1)])]
+        return self._load_players(self.players_col.find(mongo_request).sort([('name', 1)]))
+
+    @contextmanager
+    def _reserve_player_change_stamps(self, count=1):
+        '''Reserves count change stamps, and yields the first one. The write
+        using them goes in the with block: until it exits, the stamps are
+        pending, and get_player_change_stamp stays below them.'''
+        while True:
+            counter = self.counters_col.find_one({'_id': PLAYER_CHANGE_STAMP_COUNTER}) or \
+                {'value': 0}
+            first_stamp = counter['value'] + 1
+            now = datetime.utcnow()
+            update = {'$set': {'value': counter['value'] + count,
+                               'pending.%d' % first_stamp: now}}
+            # clear out the writes that died
+            expired = [stamp for stamp, started in counter.get('pending', {}).iteritems()
+                       if started <= now - PLAYER_CHANGE_STAMP_TIMEOUT]
+            if expired:
+                update['$unset'] = {'pending.' + stamp: '' for stamp in expired}
+            try:
+                # only if nobody took the stamps since we read the counter
+                # (upserting the counter if there isn't one yet)
+                result = self.counters_col.update_one(
+                    {'_id': PLAYER_CHANGE_STAMP_COUNTER, 'value': counter['value']},
+                    update, upsert=True)
+                if result.matched_count or result.upserted_id is not None:
+                    break
+            except pymongo.errors.DuplicateKeyError:
+                pass
+
+        try:
+            yield first_stamp
+        finally:
+            self.counters_col.update_one({'_id': PLAYER_CHANGE_STAMP_COUNTER},
+                                         {'$unset': {'pending.%d' % first_stamp: ''}})
+
+    def _dump_player(self, player, change_stamp):
+        player_dict = player.dump(context='db')
+        # written to the ratings collection, see _replace_ratings
+        del player_dict['ratings']
+        player_dict['change_stamp'] = change_stamp
+        # player lists are sorted case insensitively, by this
+        player_dict['sort_name'] = player.name.lower()
+        return player_dict
+
+    def get_player_change_stamp(self):
+        '''The stamp of the latest write to players (0 if there hasn't been
+        one), such that every write up to it has landed'''
+        counter = self.counters_col.find_one({'_id': PLAYER_CHANGE_STAMP_COUNTER})
+        if not counter:
+            return 0
+        cutoff = datetime.utcnow() - PLAYER_CHANGE_STAMP_TIMEOUT
+        pending = [int(stamp) for stamp, started in counter.get('pending', {}).iteritems()
+                   if started > cutoff]
+        return min(pending) - 1 if pending else counter['value']
+
+    def get_player_changes(self, since):
+        '''Returns the players written and the ids of the players deleted after
+        the change stamp since, in every region'''
+        players = self._load_players(self.players_col.find({'change_stamp': {'$gt': since}}))
+        deleted_ids = [d['_id'] for d in
+                       self.deleted_players_col.find({'change_stamp': {'$gt': since}}, {'_id': 1})]
+        return players, deleted_ids
+
+    def stamp_players(self):
+        '''Gives a change stamp to every player that doesn't have one (players
+        from before change stamps). Returns how many were stamped.'''
+        player_ids = [p['_id'] for p in
+                      self.players_col.find({'change_stamp': {'$exists': False}}, {'_id': 1})]
+        self.restamp_players(player_ids)
+        return len(player_ids)
+
+    def restamp_players(self, player_ids):
+        '''Gives each of player_ids a new change stamp, without rewriting them'''
+        if not player_ids:
+            return
+        with self._reserve_player_change_stamps(len(player_ids)) as first_stamp:
+            bulk = self.players_col.initialize_unordered_bulk_op()
+            for stamp, player_id in enumerate(player_ids, start=first_stamp):
+                bulk.find({'_id': player_id}).update_one({'$set': {'change_stamp': stamp}})
+            bulk.execute()
+
+    def iter_all_players(self, all_regions=False, include_merged=False, fields=None,
+                         batch_size=ITER_BATCH_SIZE):
+        '''Like get_all_players, but sorted case insensitively and yielded as
+        they come off the cursor. With fields, only those fields are loaded.'''
+        mongo_request = {}
+        if not all_regions:
+            mongo_request['regions'] = {'$in': [self.region_id]}
+        if not include_merged:
+            mongo_request['merged'] = False
+        cursor = self.players_col.find(
+            mongo_request, _projection(M.Player, fields, sort_key='sort_name')).sort(
+            [('sort_name', pymongo.ASCENDING)]).batch_size(batch_size)
+        # ratings are looked up a batch at a time
+        batch = []
+        for p in cursor:
+            batch.append(p)
+            if len(batch) == batch_size:
+                for player in self._load_players(batch, fields):
+                    yield player
+                batch = []
+        for player in self._load_players(batch, fields):
+            yield player
+
+    def get_players_page(self, limit, after=None, all_regions=False, include_merged=False,
+                         fields=None):
+        '''A page of iter_all_players. Returns (players, cursor of the next
+        page or None if this is the last one).'''
+        mongo_request = {}
+        if not all_regions:
+            mongo_request['regions'] = {'$in': [self.region_id]}
+        if not include_merged:
+            mongo_request['merged'] = False
+        docs, next_cursor = self._get_page(self.players_col, mongo_request, 'sort_name',
+                                           limit, after, projection=_projection(M.Player, fields))
+        return self._load_players(docs, fields), next_cursor
+
+    def set_player_sort_names(self):
+        '''Sets sort_name on every player that doesn't have one (players from
+        before sort names). Returns how many were set.'''
+        players = list(self.players_col.find({'sort_name': {'$exists': False}}, {'name': 1}))
+        if not players:
+            return 0
+
+        bulk = self.players_col.initialize_unordered_bulk_op()
+        for p in players:
+            bulk.find({'_id': p['_id']}).update_one({'$set': {'sort_name': p['name'].lower()}})
+        bulk.execute()
+        return len(players)
+
+    def insert_players(self, players):
+        '''Inserts players in one go'''
+        if not players:
+            return []
+        with self._reserve_player_change_stamps(len(players)) as first_stamp:
+            player_ids = self.players_col.insert_many(
+                [self._dump_player(player, stamp)
+                 for stamp, player in enumerate(players, start=first_stamp)]).inserted_ids
+        self._replace_ratings(players)
+        return player_ids
 
     def insert_player(self, player):
-        return self.players_col.insert(player.dump(context='db'))
+        with self._reserve_player_change_stamps() as change_stamp:
+            player_id = self.players_col.insert(self._dump_player(player, change_stamp))
+        self._replace_ratings([player])
+        self.deleted_players_col.delete_one({'_id': player.id})
+        return player_id
 
     def delete_player(self, player):
+        with self._reserve_player_change_stamps() as change_stamp:
+            self.deleted_players_col.replace_one({'_id': player.id},
+                                                 {'change_stamp': change_stamp},
+                                                 upsert=True)
+        self.ratings_col.delete_many({'player': player.id})
         return self.players_col.remove({'_id': player.id})
 
+    def delete_players(self, players):
+        '''Deletes players in one go, like delete_player'''
+        if not players:
+            return
+        player_ids = [player.id for player in players]
+        with self._reserve_player_change_stamps(len(player_ids)) as first_stamp:
+            bulk = self.deleted_players_col.initialize_unordered_bulk_op()
+            for stamp, player_id in enumerate(player_ids, start=first_stamp):
+                bulk.find({'_id': player_id}).upsert().replace_one({'change_stamp': stamp})
+            bulk.execute()
+        self.ratings_col.delete_many({'player': {'$in': player_ids}})
+        self.players_col.delete_many({'_id': {'$in': player_ids}})
+
     def update_player(self, player):
-        return self.players_col.update({'_id': player.id}, player.dump(context='db'))
+        '''Rewrites player, but not their ratings: player.ratings may be
+        older than the last ranking run. Ranking runs use update_ratings.'''
+        with self._reserve_player_change_stamps() as change_stamp:
+            return self.players_col.update(
+                {'_id': player.id}, self._dump_player(player, change_stamp))
+
+    def _replace_ratings(self, players):
+        '''Writes the ratings of players, and deletes the ones they no longer
+        have'''
+        bulk = self.ratings_col.initialize_unordered_bulk_op()
+        for player in players:
+            for region_id, rating in player.ratings.iteritems():
+                bulk.find({'player': player.id, 'region': region_id}).upsert().update_one(
+                    {'$set': M.PlayerRating(player=player.id, region=region_id,
+                                            rating=rating).dump(context='db')})
+            bulk.find({'player': player.id,
+                       'region': {'$nin': player.ratings.keys()}}).remove()
+        if players:
+            bulk.execute()
+
+    def get_ratings(self, player_ids):
+        '''Returns the ratings of player_ids, as a map from player id to a map
+        from region to Rating. Players without ratings are left out.'''
+        ratings = {}
+        if not player_ids:
+            return ratings
+        for doc in self.ratings_col.find({'player': {'$in': list(player_ids)}}):
+            player_rating = M.PlayerRating.load(doc, context='db')
+            ratings.setdefault(player_rating.player, {})[player_rating.region] = player_rating.rating
+        return ratings
+
+    def update_ratings(self, ratings):
+        '''Writes the ratings of a ranking run in this region (a map from
+        player id to Rating), without touching the rest of the players or
+        their ratings in other regions. The players get new change stamps,
+        so clients see the new ratings.'''
+        if not ratings:
+            return
+        bulk = self.ratings_col.initialize_unordered_bulk_op()
+        for player_id, rating in ratings.iteritems():
+            bulk.find({'player': player_id, 'region': self.region_id}).upsert().update_one(
+                {'$set': M.PlayerRating(player=player_id, region=self.region_id,
+                                        rating=rating).dump(context='db')})
+        bulk.execute()
+        self.restamp_players(ratings.keys())
+
+    def move_player_ratings(self):
+        '''Moves the ratings stored on players (players from before the
+        ratings collection) to the ratings collection. A rating already in
+        the collection is kept. Returns how many players had ratings moved.'''
+        players = list(self.players_col.find({'ratings': {'$exists': True}}, {'ratings': 1}))
+        if not players:
+            return 0
+
+        bulk = self.ratings_col.initialize_unordered_bulk_op()
+        num_ratings = 0
+        for p in players:
+            for region_id, rating in p['ratings'].iteritems():
+                bulk.find({'player': p['_id'], 'region': region_id}).upsert().update_one(
+                    {'$setOnInsert': {'rating': rating}})
+                num_ratings += 1
+        if num_ratings:
+            bulk.execute()
+        self.players_col.update_many({'_id': {'$in': [p['_id'] for p in players]}},
+                                     {'$unset': {'ratings': ''}})
+        return len(players)
 
     def update_region(self, region):
         return self.regions_col.update({'_id': region.id}, region.dump(context='db'))
 
-    # TODO bulk update
     def update_players(self, players):
-        pass
+        '''Rewrites players in one go, like update_player'''
+        if not players:
+            return
+        with self._reserve_player_change_stamps(len(players)) as first_stamp:
+            bulk = self.players_col.initialize_unordered_bulk_op()
+            for stamp, player in enumerate(players, start=first_stamp):
+                bulk.find({'_id': player.id}).replace_one(self._dump_player(player, stamp))
+            bulk.execute()
 
     # unused, if you use this, make sure to surround it in a try block!
     def add_alias_to_player(self, player, alias):
@@ -192,12 +740,69 @@ class Dao(object):
     def insert_pending_tournament(self, pending_tournament):
         return self.pending_tournaments_col.insert(pending_tournament.dump(context='db'))
 
+    def insert_pending_tournaments(self, pending_tournaments):
+        if not pending_tournaments:
+            return []
+        return self.pending_tournaments_col.insert_many(
+            [pt.dump(context='db') for pt in pending_tournaments]).inserted_ids
+
     def update_pending_tournament(self, tournament):
         return self.pending_tournaments_col.update({'_id': tournament.id}, tournament.dump(context='db'))
 
     def delete_pending_tournament(self, pending_tournament):
         return self.pending_tournaments_col.remove({'_id': pending_tournament.id})
 
+    def finalize_pending_tournament(self, pending_tournament):
+        '''Creates a player for every alias mapped to None, then replaces
+        pending_tournament with a Tournament (with the same id). Returns the
+        id, or raises ValueError if the pending tournament can't be finalized.
+
+        The ids of the new players and the completed alias map are saved on
+        the pending tournament before anything else is written, and every write after that
+        is keyed on an id we already know. If a finalize gets interrupted,
+        finalizing again picks up where it left off instead of creating the
+        players twice.'''
+        new_players = []
+        for mapping in pending_tournament.alias_to_id_map:
+            if mapping.player_id is None:
+                mapping.player_id = ObjectId()
+                pending_tournament.new_player_ids.append(mapping.player_id)
+            if mapping.player_id in pending_tournament.new_player_ids:
+                new_players.append(M.Player.create_with_default_values(
+                    mapping.player_alias, self.region_id, id=mapping.player_id))
+
+        try:
+            tournament = M.Tournament.from_pending_tournament(pending_tournament)
+        except ValueError as e:
+            print e
+            raise ValueError('Not all player aliases in this pending tournament '
+                             'have been mapped to player ids.')
+
+        # validate players in this tournament
+        new_player_ids = {player.id for player in new_players}
+        players = self.get_players_by_ids(set(tournament.players))
+        found_ids = {player.id for player in players}
+        if set(tournament.players) - found_ids - new_player_ids:
+            raise ValueError('Not all player ids are valid')
+        for player in players:
+            if player.merged:
+                raise ValueError('Player {} has already been merged'.format(player.name))
+
+        self.update_pending_tournament(pending_tournament)
+
+        self.insert_players([player for player in new_players if player.id not in found_ids])
+        result = self.tournaments_col.replace_one({'_id': tournament.id},
+                                                  tournament.dump(context='db'),
+                                                  upsert=True)
+        # a resumed finalize may have counted these matches already
+        if result.upserted_id is not None:
+            self.update_head_to_head(new_matches=tournament.matches, new_date=tournament.date,
+                                     new_regions=tournament.regions)
+            self.update_player_attendance(new_players=tournament.players,
+                                          new_date=tournament.date)
+        self.delete_pending_tournament(pending_tournament)
+        return tournament.id
+
     def get_all_pending_tournament_jsons(self, regions=None):
         query_dict = {'regions': {'$in': regions}} if regions else {}
         return self.pending_tournaments_col.find(query_dict).sort([('date', 1)])
@@ -218,20 +823,82 @@ class Dao(object):
 
         return [M.PendingTournament.load(t, context='db') for t in pending_tournaments]
 
-    def get_pending_tournament_by_id(self, id):
-        '''id must be an ObjectId'''
-        return M.PendingTournament.load(self.pending_tournaments_col.find_one({'_id': id}),
-                                        context='db')
+    def get_pending_tournament_by_id(self, id, fields=None):
+        '''id must be an ObjectId. With fields, only those fields are loaded.'''
+        return M.PendingTournament.load(self.pending_tournaments_col.find_one(
+            {'_id': id}, _projection(M.PendingTournament, fields)), context='db')
 
     def insert_tournament(self, tournament):
         return self.tournaments_col.insert(tournament.dump(context='db'))
 
     # all uses of this MUST use a try/except block!
     def update_tournament(self, tournament):
-        return self.tournaments_col.update({'_id': tournament.id}, tournament.dump(context='db'))
+        old = self.tournaments_col.find_one({'_id': tournament.id},
+                                            {'matches': 1, 'players': 1, 'date': 1, 'regions': 1})
+        tournament.version = (tournament.version or 0) + 1
+        ret = self.tournaments_col.update({'_id': tournament.id}, tournament.dump(context='db'))
+        if old is not None:
+            self._tournament_updated(old, tournament)
+        return ret
+
+    def update_tournaments(self, tournaments):
+        '''Rewrites tournaments in one go, like update_tournament'''
+        if not tournaments:
+            return
+        olds = {t['_id']: t for t in self.tournaments_col.find(
+            {'_id': {'$in': [tournament.id for tournament in tournaments]}},
+            {'matches': 1, 'players': 1, 'date': 1, 'regions': 1})}
+        bulk = self.tournaments_col.initialize_unordered_bulk_op()
+        for tournament in tournaments:
+            tournament.version = (tournament.version or 0) + 1
+            bulk.find({'_id': tournament.id}).replace_one(tournament.dump(context='db'))
+        bulk.execute()
+        for tournament in tournaments:
+            if tournament.id in olds:
+                self._tournament_updated(olds[tournament.id], tournament)
+
+    def _tournament_updated(self, old, tournament):
+        '''Brings the head to head records, player stats and merges up to date
+        with a write of tournament over old (its matches, players, date and
+        regions)'''
+        self.update_head_to_head(
+            old_matches=[M.Match.load(m, context='db') for m in old.get('matches', [])],
+            old_date=old.get('date'),
+            old_regions=old.get('regions', []),
+            new_matches=tournament.matches,
+            new_date=tournament.date,
+            new_regions=tournament.regions)
+        self.update_player_attendance(
+            old_players=old.get('players', []), old_date=old.get('date'),
+            new_players=tournament.players, new_date=tournament.date)
+
+        # merged players replaced by who they were merged into (compact_merges
+        # does this, and so does writing back a tournament we read). every
+        # merge along the way has to know, so undoing it can put them back.
+        forest = self.get_merge_forest()
+        new_players = set(tournament.players)
+        compacted = [player_id for player_id in set(old.get('players', [])) - new_players
+                     if forest.find(player_id) != player_id and
+                     forest.find(player_id) in new_players]
+        if compacted:
+            sources = [p['_id'] for p in self.players_col.find(
+                {'merged': True, 'merge_children': {'$in': compacted}}, {'_id': 1})]
+            self.merges_col.update_many(
+                {'source_player_obj_id': {'$in': sources}},
+                {'$addToSet': {'rewritten_tournaments': tournament.id}})
 
     def delete_tournament(self, tournament):
-        return self.tournaments_col.remove({'_id': tournament.id})
+        old = self.tournaments_col.find_one({'_id': tournament.id},
+                                            {'matches': 1, 'players': 1, 'date': 1, 'regions': 1})
+        ret = self.tournaments_col.remove({'_id': tournament.id})
+        if old is not None:
+            self.update_head_to_head(
+                old_matches=[M.Match.load(m, context='db') for m in old.get('matches', [])],
+                old_date=old.get('date'),
+                old_regions=old.get('regions', []))
+            self.update_player_attendance(
+                old_players=old.get('players', []), old_date=old.get('date'))
+        return ret
 
     def get_all_tournament_ids(self, players=None, regions=None):
         '''players is a list of Players'''
@@ -240,7 +907,7 @@ class Dao(object):
 
         if players:
             for player in players:
-                query_list.append({'players': {'$in': [player.id]}})
+                query_list.append({'players': {'$in': list(self.get_merged_ids(player.id))}})
 
         if regions:
             query_list.append({'regions': {'$in': regions}})
@@ -257,7 +924,7 @@ class Dao(object):
 
         if players:
             for player in players:
-                query_list.append({'players': {'$in': [player.id]}})
+                query_list.append({'players': {'$in': list(self.get_merged_ids(player.id))}})
 
         if regions:
             query_list.append({'regions': {'$in': regions}})
@@ -268,20 +935,129 @@ class Dao(object):
         tournaments = [t for t in self.tournaments_col.find(
             query_dict).sort([('date', 1)])]
 
-        return [M.Tournament.load(t, context='db') for t in tournaments]
+        return self._load_tournaments(tournaments)
+
+    def iter_tournaments(self, regions=None, fields=None, batch_size=ITER_BATCH_SIZE):
+        '''Yields the tournaments in regions (every region if None) oldest
+        first, as they come off the cursor. With fields, only those fields
+        are loaded.'''
+        return self._iter_documents(self.tournaments_col, M.Tournament, regions, fields, batch_size)
+
+    def iter_pending_tournaments(self, regions=None, fields=None, batch_size=ITER_BATCH_SIZE):
+        '''Like iter_tournaments, for pending tournaments'''
+        return self._iter_documents(self.pending_tournaments_col, M.PendingTournament,
+                                    regions, fields, batch_size)
+
+    def _iter_documents(self, col, document_class, regions, fields, batch_size):
+        query = {'regions': {'$in': regions}} if regions else {}
+        cursor = col.find(query, _projection(document_class, fields, sort_key='date')).sort([('date', 1)]).batch_size(batch_size)
+        for doc in cursor:
+            document = document_class.load(doc, context='db')
+            if document_class is M.Tournament:
+                self._resolve_merged_players(document)
+            yield document
+
+    def get_tournaments_page(self, limit, after=None, regions=None, fields=None,
+                             newest_first=False):
+        '''A page of iter_tournaments. Returns (tournaments, cursor of the
+        next page or None if this is the last one).'''
+        query = {'regions': {'$in': regions}} if regions else {}
+        docs, next_cursor = self._get_page(self.tournaments_col, query, 'date', limit, after,
+                                           projection=_projection(M.Tournament, fields),
+                                           descending=newest_first)
+        return self._load_tournaments(docs), next_cursor
+
+    def _get_page(self, col, query, key, limit, after, projection=None, descending=False):
+        '''Returns up to limit documents matching query that come after the
+        cursor after in (key, _id) order, and the cursor of the next page.
+        Raises ValueError on a bad cursor.'''
+        direction = pymongo.DESCENDING if descending else pymongo.ASCENDING
+        if after is not None:
+            after_key, after_id = decode_page_cursor(after)
+            op = '$lt' if descending else '$gt'
+            query = {'$and': [query, {'$or': [{key: {op: after_key}},
+                                              {key: after_key, '_id': {op: after_id}}]}]}
+        if projection is not None and key not in projection:
+            projection = projection + [key]
+
+        # one extra document tells us if there is a next page
+        docs = list(col.find(query, projection).sort(
+            [(key, direction), ('_id', direction)]).limit(limit + 1))
+        if len(docs) <= limit:
+            return docs, None
+        docs = docs[:limit]
+        return docs, encode_page_cursor(docs[-1].get(key), docs[-1]['_id'])
+
+    def get_tournament_by_id(self, id, fields=None):
+        '''id must be an ObjectId. With fields, only those fields are loaded.'''
+        doc = self.tournaments_col.find_one({'_id': id}, _projection(M.Tournament, fields))
+        if doc is None:
+            return None
+        return self._load_tournaments([doc])[0]
 
-    def get_tournament_by_id(self, id):
-        '''id must be an ObjectId'''
-        return M.Tournament.load(self.tournaments_col.find_one({'_id': id}), context='db')
+    def get_tournaments_by_ids(self, ids, fields=None):
+        '''ids must be ObjectIds'''
+        return self._load_tournaments(self.tournaments_col.find(
+            {'_id': {'$in': list(ids)}}, _projection(M.Tournament, fields)))
 
     def get_match_by_tournament_id_and_match_id(self, tournament_id, match_id):
-        tourney_m = M.Tournament.load(self.tournaments_col.find_one({'_id': tournament_id}, {'matches', 1}), context='db')
-        for match in tourney_m.matches:
-            try:
-                if match_id == match.match_id:
-                    return match
-            except Exception as e:
-                print('Could not attain match. ' + str(e))
+        tourney = self.tournaments_col.find_one(
+            {'_id': tournament_id},
+            {'matches': {'$elemMatch': {'match_id': match_id}}})
+        if tourney and tourney.get('matches'):
+            match = M.Match.load(tourney['matches'][0], context='db')
+            forest = self.get_merge_forest()
+            match.winner = forest.find(match.winner)
+            match.loser = forest.find(match.loser)
+            return match
+
+    # merges. a merge only writes the two players (and the version of the
+    # merge forest); tournaments keep the ids of merged players, which the
+    # reads resolve with the merge forest (see merge_forest.py).
+
+    def get_merge_forest(self):
+        '''The merge forest, reloaded if a merge or unmerge changed it since
+        this process last loaded it'''
+        if self._merge_forest is None:
+            version_doc = self.counters_col.find_one({'_id': MERGE_FOREST_VERSION})
+            version = version_doc and version_doc.get('version')
+            forest = merge_forest.cache.get(self.database_name, version)
+            if forest is None:
+                forest = merge_forest.MergeForest(
+                    {p['_id']: p['merge_parent'] for p in
+                     self.players_col.find({'merged': True}, {'merge_parent': 1})})
+                merge_forest.cache.put(self.database_name, version, forest)
+            self._merge_forest = forest
+        return self._merge_forest
+
+    def merge_forest_changed(self):
+        '''Call after writing merge_parent outside of merge_players and
+        unmerge_players, so every process reloads the merge forest'''
+        self.counters_col.update_one({'_id': MERGE_FOREST_VERSION},
+                                     {'$set': {'version': ObjectId()}},
+                                     upsert=True)
+        self._merge_forest = None
+
+    def get_merged_ids(self, player_id):
+        '''The ids of player_id and the players merged into it, which are
+        the ids it may have in the tournaments (see get_merge_forest). Empty
+        if player_id has been merged itself.'''
+        return self.get_merge_forest().members(player_id)
+
+    def _resolve_merged_players(self, tournament):
+        forest = self.get_merge_forest()
+        if not forest:
+            return
+        tournament.players = [forest.find(player_id) for player_id in tournament.players]
+        for match in tournament.matches:
+            match.winner = forest.find(match.winner)
+            match.loser = forest.find(match.loser)
+
+    def _load_tournaments(self, docs):
+        tournaments = [M.Tournament.load(t, context='db') for t in docs]
+        for tournament in tournaments:
+            self._resolve_merged_players(tournament)
+        return tournaments
 
     def set_tournament_exclusion_by_tournament_id(self, tournament_id, excluded):
         if self.tournaments_col.find_one({'_id': tournament_id}):
@@ -292,105 +1068,420 @@ class Dao(object):
                                         }
                                     })
 
+    # the match methods below only touch the match they change. every write
+    # bumps the tournament version, and only goes through if the version is
+    # still the one we read (otherwise we reread and try again). the version is
+    # $set rather than $inc'd, since tournaments written without one have it
+    # stored as null.
 
     def set_match_exclusion_by_tournament_id_and_match_id(self, tournament_id, match_id, excluded):
-        # TODO ENHANCE THIS ALGORITHM TO ONLY UPDATE MATCH
-        match_updated = False
-        new_matches = []
-        tourney_m = \
-            M.Tournament.load(self.tournaments_col.find_one({'_id': tournament_id}), context='db')
-
-        for match in tourney_m.matches:
-            try:
-                if match_id == match.match_id:
-                    match.excluded = excluded
-                    match_updated = True
-                new_matches.append(match)
-            except Exception as e:
-                print('Could not attain match. ' + str(e))
-
-        if match_updated is True:
-            tourney_m.matches = new_matches
-            self.tournaments_col.update({'_id': tournament_id}, tourney_m.dump(context='db'))
+        for _ in xrange(MATCH_UPDATE_RETRIES):
+            tourney = self.tournaments_col.find_one(
+                {'_id': tournament_id},
+                {'matches': {'$elemMatch': {'match_id': match_id}}, 'version': 1, 'date': 1,
+                 'regions': 1})
+            if not tourney or not tourney.get('matches'):
+                return False
+            match = M.Match.load(tourney['matches'][0], context='db')
+
+            result = self.tournaments_col.update_one(
+                {'_id': tournament_id,
+                 'version': tourney.get('version'),
+                 'matches.match_id': match_id},
+                {'$set': {'matches.$.excluded': excluded,
+                          'version': (tourney.get('version') or 0) + 1}})
+            if result.matched_count:
+                if match.excluded != excluded:
+                    new_match = M.Match(match_id=match.match_id, winner=match.winner,
+                                        loser=match.loser, excluded=excluded)
+                    self.update_head_to_head(
+                        old_matches=[match], old_date=tourney.get('date'),
+                        old_regions=tourney.get('regions', []),
+                        new_matches=[new_match], new_date=tourney.get('date'),
+                        new_regions=tourney.get('regions', []))
+                return True
+
+        raise ConcurrentUpdateException('tournament was modified while excluding match')
 
     def add_match_by_tournament_id(self, tournament_id, winner_id, loser_id):
-        match_updates = False
-        tourney_m = \
-            M.Tournament.load(self.tournaments_col.find_one({'_id':tournament_id}), context='db')
-
-        new_match_id = len(tourney_m.matches)
-        new_match = M.Match(match_id=new_match_id, winner=winner_id, loser=loser_id, excluded=False)
-
-        tourney_m.matches.append(new_match)
-
-        if winner_id not in tourney_m.players:
-            tourney_m.players.append(winner_id)
-        if loser_id not in tourney_m.players:
-            tourney_m.players.append(loser_id)
-
-        self.tournaments_col.update({'_id': tournament_id}, tourney_m.dump(context='db'))
-
+        for _ in xrange(MATCH_UPDATE_RETRIES):
+            tourney = self.tournaments_col.find_one(
+                {'_id': tournament_id},
+                {'players': 1, 'version': 1, 'date': 1, 'regions': 1, 'matches.match_id': 1})
+            if tourney is None:
+                raise ValueError('tournament not found')
+
+            # the players may be in the tournament under the id of someone
+            # merged into them
+            forest = self.get_merge_forest()
+            tournament_ids = {forest.find(player_id): player_id
+                              for player_id in tourney['players']}
+            winner_id = tournament_ids.get(winner_id, winner_id)
+            loser_id = tournament_ids.get(loser_id, loser_id)
+
+            match_ids = [m['match_id'] for m in tourney.get('matches', [])]
+            new_match = M.Match(match_id=max(match_ids) + 1 if match_ids else 0,
+                                winner=winner_id, loser=loser_id, excluded=False)
+
+            new_player_ids = [player_id for player_id in (winner_id, loser_id)
+                              if player_id not in tourney['players']]
+
+            result = self.tournaments_col.update_one(
+                {'_id': tournament_id, 'version': tourney.get('version')},
+                {'$push': {'matches': new_match.dump(context='db'),
+                           'orig_ids': {'$each': new_player_ids}},
+                 '$addToSet': {'players': {'$each': new_player_ids}},
+                 '$set': {'version': (tourney.get('version') or 0) + 1}})
+            if result.matched_count:
+                self.update_head_to_head(new_matches=[new_match], new_date=tourney.get('date'),
+                                         new_regions=tourney.get('regions', []))
+                self.update_player_attendance(new_players=new_player_ids,
+                                              new_date=tourney.get('date'))
+                return new_match.match_id
+
+        raise ConcurrentUpdateException('tournament was modified while adding match')
 
     def swap_winner_loser_by_tournament_id_and_match_id(self, tournament_id, match_id):
-        new_matches = []
-        tourney_m = \
-            M.Tournament.load(self.tournaments_col.find_one({'_id': tournament_id}), context='db')
+        for _ in xrange(MATCH_UPDATE_RETRIES):
+            tourney = self.tournaments_col.find_one(
+                {'_id': tournament_id},
+                {'matches': {'$elemMatch': {'match_id': match_id}}, 'version': 1, 'date': 1,
+                 'regions': 1})
+            if not tourney or not tourney.get('matches'):
+                raise ValueError('Could not attain match.')
+            match = M.Match.load(tourney['matches'][0], context='db')
+
+            result = self.tournaments_col.update_one(
+                {'_id': tournament_id,
+                 'version': tourney.get('version'),
+                 'matches.match_id': match_id},
+                {'$set': {'matches.$.winner': match.loser,
+                          'matches.$.loser': match.winner,
+                          'version': (tourney.get('version') or 0) + 1}})
+            if result.matched_count:
+                swapped = M.Match(match_id=match.match_id, winner=match.loser,
+                                  loser=match.winner, excluded=match.excluded)
+                self.update_head_to_head(
+                    old_matches=[match], old_date=tourney.get('date'),
+                    old_regions=tourney.get('regions', []),
+                    new_matches=[swapped], new_date=tourney.get('date'),
+                    new_regions=tourney.get('regions', []))
+                return
+
+        raise ConcurrentUpdateException('tournament was modified while swapping match')
+
+    # head to head records, one per region of the tournaments the matches
+    # were played in. the tournament and match methods above keep these up to
+    # date, so a lookup never has to go through the tournaments. they're kept
+    # under the ids in the tournaments, so lookups add up the records of
+    # merged players.
+
+    def update_head_to_head(self, old_matches=(), old_date=None, old_regions=(),
+                            new_matches=(), new_date=None, new_regions=()):
+        '''Applies a change from old_matches (played on old_date, in a
+        tournament in old_regions) to new_matches (played on new_date, in
+        new_regions) to the head to head records.'''
+        old_deltas = add_head_to_head_deltas({}, old_matches, sign=-1)
+        new_deltas = add_head_to_head_deltas({}, new_matches, sign=1)
+        region_deltas = add_region_head_to_head_deltas({}, old_deltas, old_regions)
+        add_region_head_to_head_deltas(region_deltas, new_deltas, new_regions)
+
+        new_keys = set()
+        for match in new_matches:
+            for region in new_regions:
+                new_keys.update([(match.winner, match.loser, region),
+                                 (match.loser, match.winner, region)])
+
+        bulk = self.head_to_head_col.initialize_unordered_bulk_op()
+        num_updates = 0
+        for (player, opponent, region), counts in region_deltas.iteritems():
+            update = {}
+            inc = {field: count for field, count in counts.iteritems() if count}
+            if inc:
+                update['$inc'] = inc
+            if (player, opponent, region) in new_keys and new_date is not None:
+                update['$max'] = {'last_played': new_date}
+            if update:
+                bulk.find({'player': player, 'opponent': opponent,
+                           'region': region}).upsert().update_one(update)
+                num_updates += 1
+        if num_updates:
+            bulk.execute()
+
+        # a player's record is the sum of their head to heads (counting the
+        # matches of a tournament in several regions once)
+        self._update_player_records(
+            add_head_to_head_deltas(add_head_to_head_deltas({}, old_matches, sign=-1),
+                                    new_matches))
+
+        # pairs that lost a match may not have played each other anymore, or
+        # last played somewhere else. if the same tournament still has a match
+        # between them, nothing changed.
+        stale_keys = set()
+        for match in old_matches:
+            for region in old_regions:
+                stale_keys.update([(match.winner, match.loser, region),
+                                   (match.loser, match.winner, region)])
+        if old_date == new_date:
+            stale_keys -= new_keys
+        if not stale_keys:
+            return
+
+        for h in self.head_to_head_col.find(
+                {'$or': [{'player': player, 'opponent': opponent, 'region': region}
+                         for player, opponent, region in stale_keys]}):
+            head_to_head = M.HeadToHead.load(h, context='db')
+            if head_to_head.wins + head_to_head.losses + head_to_head.excluded <= 0:
+                self.head_to_head_col.delete_one({'_id': h['_id']})
+            elif old_date is None or head_to_head.last_played is None or \
+                    head_to_head.last_played <= old_date:
+                # the tournament we took matches from may have been the last one
+                self._refresh_head_to_head_last_played(head_to_head.player,
+                                                       head_to_head.opponent,
+                                                       head_to_head.region)
+
+    def _refresh_head_to_head_last_played(self, player, opponent, region):
+        players = [player, opponent]
+        key = {'player': player, 'opponent': opponent, 'region': region}
+        last = self.tournaments_col.find(
+            {'regions': region,
+             'matches': {'$elemMatch': {'winner': {'$in': players},
+                                        'loser': {'$in': players}}}},
+            {'date': 1}).sort([('date', pymongo.DESCENDING)]).limit(1)
+        for tournament in last:
+            self.head_to_head_col.update_one(key, {'$set': {'last_played': tournament.get('date')}})
+            return
+        self.head_to_head_col.delete_one(key)
+
+    def rebuild_head_to_head(self):
+        '''Recomputes every head to head record from the tournaments'''
+        region_deltas = {}
+        last_played = {}
+        for t in self.tournaments_col.find({}, {'matches': 1, 'date': 1, 'regions': 1}):
+            matches = [M.Match.load(m, context='db') for m in t.get('matches', [])]
+            regions = t.get('regions', [])
+            add_region_head_to_head_deltas(region_deltas, add_head_to_head_deltas({}, matches),
+                                           regions)
+            if t.get('date') is None:
+                continue
+            for match in matches:
+                for region in regions:
+                    for key in ((match.winner, match.loser, region),
+                                (match.loser, match.winner, region)):
+                        if last_played.get(key) is None or t['date'] > last_played[key]:
+                            last_played[key] = t['date']
+
+        self.head_to_head_col.delete_many({})
+        records = [M.HeadToHead(player=player, opponent=opponent, region=region,
+                                last_played=last_played.get((player, opponent, region)),
+                                **counts).dump(context='db')
+                   for (player, opponent, region), counts in region_deltas.iteritems()]
+        if records:
+            self.head_to_head_col.insert_many(records)
+        return len(records)
+
+    def _combine_head_to_heads(self, docs):
+        '''Loads head to head records, adding up the ones between players who
+        were merged into the same pair of players'''
+        forest = self.get_merge_forest()
+        combined = OrderedDict()
+        for h in docs:
+            head_to_head = M.HeadToHead.load(h, context='db')
+            pair = (forest.find(head_to_head.player), forest.find(head_to_head.opponent))
+            total = combined.get(pair)
+            if total is None:
+                head_to_head.player, head_to_head.opponent = pair
+                combined[pair] = head_to_head
+                continue
+            total.wins += head_to_head.wins
+            total.losses += head_to_head.losses
+            total.excluded += head_to_head.excluded
+            if total.last_played is None or (head_to_head.last_played is not None and
+                                             head_to_head.last_played > total.last_played):
+                total.last_played = head_to_head.last_played
+        return combined.values()
+
+    def get_head_to_head(self, player_id, opponent_id):
+        '''The head to head record of player_id against opponent_id in this
+        region, or None if they haven't played each other here'''
+        for head_to_head in self._combine_head_to_heads(self.head_to_head_col.find(
+                {'region': self.region_id,
+                 'player': {'$in': list(self.get_merged_ids(player_id))},
+                 'opponent': {'$in': list(self.get_merged_ids(opponent_id))}})):
+            return head_to_head
+
+    def get_head_to_heads_for_player(self, player_id):
+        return self._combine_head_to_heads(self.head_to_head_col.find(
+            {'region': self.region_id,
+             'player': {'$in': list(self.get_merged_ids(player_id))}}))
+
+    def get_head_to_head_matrix(self, player_ids):
+        '''Returns the head to head records between the given players in this
+        region'''
+        merged_ids = set()
+        for player_id in player_ids:
+            merged_ids.update(self.get_merged_ids(player_id))
+        merged_ids = list(merged_ids)
+        return self._combine_head_to_heads(self.head_to_head_col.find(
+            {'region': self.region_id,
+             'player': {'$in': merged_ids}, 'opponent': {'$in': merged_ids}}))
+
+    # player stats. records and attendance change with the tournaments (like
+    # the head to head records above), rating history and best wins are
+    # written by ranking runs.
+
+    def _update_player_records(self, deltas):
+        records = {}
+        for (player, _), counts in deltas.iteritems():
+            record = records.setdefault(player, {'wins': 0, 'losses': 0})
+            record['wins'] += counts['wins']
+            record['losses'] += counts['losses']
+
+        bulk = self.player_stats_col.initialize_unordered_bulk_op()
+        num_updates = 0
+        for player, record in records.iteritems():
+            inc = {field: count for field, count in record.iteritems() if count}
+            if inc:
+                bulk.find({'_id': player}).upsert().update_one({'$inc': inc})
+                num_updates += 1
+        if num_updates:
+            bulk.execute()
+
+    def update_player_attendance(self, old_players=(), old_date=None, new_players=(), new_date=None):
+        '''Applies a change in who attended a tournament (and when) to the
+        attendance of those players.'''
+        old_players, new_players = set(old_players), set(new_players)
+
+        bulk = self.player_stats_col.initialize_unordered_bulk_op()
+        num_updates = 0
+        for player in old_players | new_players:
+            update = {}
+            count = (player in new_players) - (player in old_players)
+            if count:
+                update['$inc'] = {'tournaments_attended': count}
+            if player in new_players and new_date is not None:
+                update['$max'] = {'last_active': new_date}
+            if update:
+                bulk.find({'_id': player}).upsert().update_one(update)
+                num_updates += 1
+        if num_updates:
+            bulk.execute()
+
+        # players who left the tournament (or all of them, if it moved) may
+        # have been last active somewhere else
+        stale_players = old_players - new_players if old_date == new_date else old_players
+        if not stale_players:
+            return
+        for stats in self.player_stats_col.find({'_id': {'$in': list(stale_players)}},
+                                                {'last_active': 1}):
+            last_active = stats.get('last_active')
+            if old_date is None or last_active is None or last_active <= old_date:
+                self._refresh_player_last_active(stats['_id'])
+
+    def _refresh_player_last_active(self, player_id):
+        last = self.tournaments_col.find({'players': player_id}, {'date': 1}).sort(
+            [('date', pymongo.DESCENDING)]).limit(1)
+        for tournament in last:
+            self.player_stats_col.update_one({'_id': player_id},
+                                             {'$set': {'last_active': tournament.get('date')}})
+            return
+        self.player_stats_col.update_one({'_id': player_id}, {'$unset': {'last_active': ''}})
+
+    def record_ranking_stats(self, rating_history, best_wins):
+        '''Adds the ratings of a ranking run in this region (a map from player
+        id to RatingHistoryEntry) to the rating history of every player in
+        it, and replaces their best wins in this region with best_wins (a map
+        from player id to a list of BestWins)'''
+        if not rating_history:
+            return
+        bulk = self.player_stats_col.initialize_unordered_bulk_op()
+        for player_id, entry in rating_history.iteritems():
+            bulk.find({'_id': player_id}).upsert().update_one({
+                '$push': {'rating_history.' + self.region_id: entry.dump(context='db')},
+                '$set': {'best_wins.' + self.region_id: [
+                    w.dump(context='db') for w in best_wins.get(player_id, [])]}})
+        bulk.execute()
+
+    def get_player_stats(self, player_id):
+        '''The stats of player_id, with the records and attendance of the
+        players merged into it added in'''
+        docs = {doc['_id']: doc for doc in self.player_stats_col.find(
+            {'_id': {'$in': list(self.get_merged_ids(player_id))}})}
+        if not docs:
+            return None
 
-        for match in tourney_m.matches:
-            try:
-                if match_id == match.match_id:
-                    winner_holder = match.winner
-                    match.winner = match.loser
-                    match.loser = winner_holder
-                    match_updated = True
-                new_matches.append(match)
-            except Exception as e:
-                raise Exception('Could not attain match. ' + str(e))
-
-        if match_updated is True:
-            tourney_m.matches = new_matches
-            self.tournaments_col.update({'_id': tournament_id}, tourney_m.dump(context='db'))
+        stats = M.PlayerStats.load(docs.pop(player_id, {'_id': player_id}), context='db')
+        for doc in docs.itervalues():
+            merged_stats = M.PlayerStats.load(doc, context='db')
+            stats.wins += merged_stats.wins
+            stats.losses += merged_stats.losses
+            stats.tournaments_attended += merged_stats.tournaments_attended
+            if stats.last_active is None or (merged_stats.last_active is not None and
+                                             merged_stats.last_active > stats.last_active):
+                stats.last_active = merged_stats.last_active
+        return stats
+
+    def rebuild_player_stats(self):
+        '''Recomputes records and attendance from the tournaments, and rating
+        history from the rankings. Best wins are left alone until the next
+        ranking run.'''
+        stats = {}
+
+        def get_stats(player_id):
+            return stats.setdefault(player_id, {'wins': 0, 'losses': 0,
+                                                'tournaments_attended': 0,
+                                                'rating_history': {}})
+
+        for t in self.tournaments_col.find({}, {'matches': 1, 'players': 1, 'date': 1}):
+            for player_id in set(t.get('players', [])):
+                player_stats = get_stats(player_id)
+                player_stats['tournaments_attended'] += 1
+                if t.get('date') is not None and ('last_active' not in player_stats or
+                                                  t['date'] > player_stats['last_active']):
+                    player_stats['last_active'] = t['date']
+            for m in t.get('matches', []):
+                if not m.get('excluded'):
+                    get_stats(m['winner'])['wins'] += 1
+                    get_stats(m['loser'])['losses'] += 1
+
+        for region_id in self.rankings_col.distinct('region'):
+            for ranking in decode_rankings(self.rankings_col.find({'region': region_id}).sort(
+                    [('time', pymongo.ASCENDING), ('depth', pymongo.ASCENDING)])):
+                for entry in ranking.ranking:
+                    get_stats(entry.player)['rating_history'].setdefault(region_id, []).append(
+                        M.RatingHistoryEntry(time=ranking.time, rating=entry.rating,
+                                             rank=entry.rank).dump(context='db'))
+
+        self.player_stats_col.update_many({}, {'$set': {'wins': 0,
+                                                        'losses': 0,
+                                                        'tournaments_attended': 0,
+                                                        'rating_history': {}},
+                                               '$unset': {'last_active': ''}})
+        if stats:
+            bulk = self.player_stats_col.initialize_unordered_bulk_op()
+            for player_id, player_stats in stats.iteritems():
+                bulk.find({'_id': player_id}).upsert().update_one({'$set': player_stats})
+            bulk.execute()
+        return len(stats)
 
     # gets potential merge targets from all regions
     # basically, get players who have an alias similar to the given alias
     def get_players_with_similar_alias(self, alias):
-        alias_lower = alias.lower()
-
-        # here be regex dragons
-        re_test_1 = '([1-9]+\s+[1-9]+\s+)(.+)'  # to match '1 1 slox'
-        re_test_2 = '(.[1-9]+.[1-9]+\s+)(.+)'  # to match 'p1s1 slox'
-
-        alias_set_1 = re.split(re_test_1, alias_lower)
-        alias_set_2 = re.split(re_test_2, alias_lower)
-
-        similar_aliases = [
-            alias_lower,
-            alias_lower.replace(" ", ""),  # remove spaces
-            # remove special characters
-            re.sub(special_chars, '', alias_lower),
-            # remove everything before the last special character; hopefully
-            # removes crew/sponsor tags
-            re.split(special_chars, alias_lower)[-1].strip()
-        ]
-
-        # regex nonsense to deal with pool prefixes
-        # prevent index OOB errors when dealing with tags that don't split well
-        if len(alias_set_1) == 4:
-            similar_aliases.append(alias_set_1[2].strip())
-        if len(alias_set_2) == 4:
-            similar_aliases.append(alias_set_2[2].strip())
-
-        # add suffixes of the string
-        alias_words = alias_lower.split()
-        similar_aliases.extend([' '.join(alias_words[i:])
-                                for i in xrange(len(alias_words))])
-
-        # uniqify
-        similar_aliases = list(set(similar_aliases))
-
-        ret = self.players_col.find({'aliases': {'$in': similar_aliases},
+        ret = self.players_col.find({'aliases': {'$in': get_similar_aliases(alias)},
+                                     'merged': False})
+        return self._load_players(ret)
+
+    # same as get_players_with_similar_alias, but for a whole batch of aliases
+    # in a single query. callers are responsible for matching players back
+    # up with the aliases they were looked up with.
+    def get_players_with_similar_aliases(self, aliases):
+        similar_aliases = set()
+        for alias in aliases:
+            similar_aliases.update(get_similar_aliases(alias))
+
+        ret = self.players_col.find({'aliases': {'$in': list(similar_aliases)},
                                      'merged': False})
-        return [M.Player.load(p, context='db') for p in ret]
+        return self._load_players(ret)
 
     # inserts and merges players!
     # TODO: add support for pending merges
@@ -405,6 +1496,12 @@ class Dao(object):
     def get_all_merges(self):
         return [M.Merge.load(m, context='db') for m in self.merges_col.find().sort([('time', 1)])]
 
+    def get_merges_page(self, limit, after=None):
+        '''A page of get_all_merges. Returns (merges, cursor of the next page
+        or None if this is the last one).'''
+        docs, next_cursor = self._get_page(self.merges_col, {}, 'time', limit, after)
+        return [M.Merge.load(m, context='db') for m in docs], next_cursor
+
     def undo_merge(self, the_merge):
         self.unmerge_players(the_merge)
         self.merges_col.remove({'_id': the_merge.id})
@@ -433,15 +1530,19 @@ class Dao(object):
 
         # check if these two players have ever played each other
         # (can't merge players who've played each other)
-        # TODO: reduce db calls for this
-        for tournament_id in self.get_all_tournament_ids():
-            tournament = self.get_tournament_by_id(tournament_id)
-            if source.id in tournament.players and target.id in tournament.players:
-                raise ValueError("source and target have played each other")
-
-        # update target and source players
-        target.aliases = list(set(source.aliases + target.aliases))
-        target.regions = list(set(source.regions + target.regions))
+        if self.tournaments_col.find_one(
+                {'$and': [{'players': {'$in': list(self.get_merged_ids(source.id))}},
+                          {'players': {'$in': list(self.get_merged_ids(target.id))}}]},
+                {'_id': 1}):
+            raise ValueError("source and target have played each other")
+
+        # update target and source players, and record what target gets
+        # from source so it can be taken away again
+        merge.aliases_added = [a for a in set(source.aliases) if a not in target.aliases]
+        merge.regions_added = [r for r in set(source.regions) if r not in target.regions]
+        merge.rewritten_tournaments = []
+        target.aliases = target.aliases + merge.aliases_added
+        target.regions = target.regions + merge.regions_added
 
         target.merge_children = target.merge_children + source.merge_children
         source.merge_parent = target.id
@@ -450,21 +1551,9 @@ class Dao(object):
         print 'source:', source
         print 'target:', target
 
-        self.update_player(source)
-        self.update_player(target)
-
-        # replace source with target in all tournaments that contain source
-        # TODO: reduce db calls for this (index tournaments by players)
-        for tournament_id in self.get_all_tournament_ids():
-            tournament = self.get_tournament_by_id(tournament_id)
-            if source.id in tournament.players:
-                try:
-                    tournament.replace_player(
-                        player_to_remove=source, player_to_add=target)
-                    self.update_tournament(tournament)
-                except Exception as e:
-                    print "error replacing source with target in tournament", tournament
-                    print e
+        self.update_players([source, target])
+        # the tournaments are left alone, reads resolve source to target
+        self.merge_forest_changed()
 
     def unmerge_players(self, merge):
         source = self.get_player_by_id(merge.source_player_obj_id)
@@ -479,41 +1568,224 @@ class Dao(object):
         if target.merged:
             raise ValueError("target has been merged; undo that merge first")
 
-        # TODO: unmerge aliases and regions
-        # (probably best way to do this is to store which aliases and regions were merged in the merge Object)
         source.merge_parent = None
         source.merged = False
         target.merge_children = [
             child for child in target.merge_children if child not in source.merge_children]
-
-        self.update_player(source)
-        self.update_player(target)
-
-        # unmerge source from target
-        # TODO: reduce db calls for this (index tournaments by players)
-        for tournament_id in self.get_all_tournament_ids():
-            tournament = self.get_tournament_by_id(tournament_id)
-
-            if target.id in tournament.players:
-                print "unmerging tournament", tournament
-                # check if original id now belongs to source
-                if any([child in tournament.orig_ids for child in source.merge_children]):
-                    # replace target with source in tournament
-                    tournament.replace_player(
-                        player_to_remove=target, player_to_add=source)
-                    self.update_tournament(tournament)
+        target.aliases = [a for a in target.aliases if a not in merge.aliases_added]
+        target.regions = [r for r in target.regions if r not in merge.regions_added]
+
+        self.update_players([source, target])
+        self.merge_forest_changed()
+
+        # tournaments that still have the ids of source's players resolve to
+        # source again by themselves. the ones rewritten to target since (which
+        # the merge recorded) get back the id they had before. they're read as
+        # stored, so nothing else in them gets rewritten.
+        source_ids = set(source.merge_children)
+        tournaments = []
+        for t in self.tournaments_col.find({'_id': {'$in': merge.rewritten_tournaments},
+                                            'players': target.id}):
+            tournament = M.Tournament.load(t, context='db')
+            orig_ids = [player_id for player_id in tournament.orig_ids if player_id in source_ids]
+            if not orig_ids:
+                continue
+            print "unmerging tournament", tournament.id
+            orig_id = orig_ids[0]
+            tournament.players = [orig_id if player_id == target.id else player_id
+                                  for player_id in tournament.players]
+            for match in tournament.matches:
+                if match.winner == target.id:
+                    match.winner = orig_id
+                if match.loser == target.id:
+                    match.loser = orig_id
+            tournaments.append(tournament)
+        self.update_tournaments(tournaments)
+
+    def record_merge_provenance(self):
+        '''Records the tournaments rewritten by merges from before merges
+        recorded them (back then, merging rewrote every tournament source
+        played in), so they can be undone. What aliases and regions they
+        added wasn't kept, so undoing them leaves those. Returns how many
+        merges were updated.'''
+        merges = [M.Merge.load(m, context='db') for m in
+                  self.merges_col.find({'rewritten_tournaments': {'$exists': False}})]
+        if not merges:
+            return 0
+
+        sources = {p.id: p for p in self.get_players_by_ids(
+            [merge.source_player_obj_id for merge in merges], fields=['merge_children'])}
+        bulk = self.merges_col.initialize_unordered_bulk_op()
+        for merge in merges:
+            source = sources.get(merge.source_player_obj_id)
+            source_ids = source.merge_children if source is not None else []
+            tournament_ids = [t['_id'] for t in self.tournaments_col.find(
+                {'players': merge.target_player_obj_id, 'orig_ids': {'$in': source_ids}},
+                {'_id': 1})]
+            bulk.find({'_id': merge.id}).update_one(
+                {'$set': {'rewritten_tournaments': tournament_ids}})
+        bulk.execute()
+        return len(merges)
+
+    def compact_merges(self):
+        '''Rewrites the tournaments that still have the ids of merged players
+        with the ids they resolve to, so reads don't have to resolve them (and
+        moves their head to head records and stats along). Returns how many
+        tournaments were rewritten.'''
+        merged_ids = [p['_id'] for p in self.players_col.find({'merged': True}, {'_id': 1})]
+        if not merged_ids:
+            return 0
+
+        count = 0
+        for doc in self.tournaments_col.find({'players': {'$in': merged_ids}}, {'_id': 1}):
+            # get_tournament_by_id resolves the merged players
+            self.update_tournament(self.get_tournament_by_id(doc['_id']))
+            count += 1
+        return count
+
+    def _get_latest_ranking_doc(self, region_id):
+        for doc in self.rankings_col.find({'region': region_id}).sort(
+                'time', pymongo.DESCENDING).limit(1):
+            return doc
+
+    def _get_ranking_from_doc(self, doc):
+        if doc is None or not doc.get('depth'):
+            return M.Ranking.load(doc, context='db')
+        chain = self.rankings_col.find({'keyframe_id': doc['keyframe_id'],
+                                        'depth': {'$lte': doc['depth']}}).sort('depth', pymongo.ASCENDING)
+        return list(decode_rankings(chain))[-1]
 
     def insert_ranking(self, ranking):
-        return self.rankings_col.insert(ranking.dump(context='db'))
+        previous_doc = self._get_latest_ranking_doc(ranking.region)
+        previous = self._get_ranking_from_doc(previous_doc)
+        return self.rankings_col.insert(encode_ranking(ranking, previous, previous_doc))
 
     def get_latest_ranking(self):
-        return M.Ranking.load(
-            self.rankings_col.find({'region': self.region_id}).sort(
-                'time', pymongo.DESCENDING)[0],
-            context='db')
+        return self._get_ranking_from_doc(self._get_latest_ranking_doc(self.region_id))
+
+    def get_ranking_history(self, since=None, until=None, limit=None, with_previous=False):
+        '''Returns the rankings in this region between since and until (either
+        can be None), or the last limit of those, oldest first. Only the
+        rankings asked for (and at most RANKING_KEYFRAME_INTERVAL before them)
+        are read. with_previous, returns (the ranking just before them or None,
+        the rankings).'''
+        query = {'region': self.region_id}
+        if since is not None or until is not None:
+            query['time'] = {}
+            if since is not None:
+                query['time']['$gte'] = since
+            if until is not None:
+                query['time']['$lte'] = until
+
+        if limit:
+            docs = list(self.rankings_col.find(query).sort(
+                [('time', pymongo.DESCENDING), ('depth', pymongo.DESCENDING)]).limit(limit))
+            docs.reverse()
+        else:
+            docs = list(self.rankings_col.find(query).sort(
+                [('time', pymongo.ASCENDING), ('depth', pymongo.ASCENDING)]))
+        if not docs:
+            return (None, []) if with_previous else []
+
+        # a change to the ranking before docs is decoded on the way to docs
+        # anyway. a full one isn't, so it has to be read on its own.
+        before = []
+        if with_previous and not docs[0].get('depth'):
+            before = list(self.rankings_col.find(
+                {'region': self.region_id, 'time': {'$lt': docs[0]['time']}}).sort(
+                [('time', pymongo.DESCENDING), ('depth', pymongo.DESCENDING)]).limit(1))
+        start = (before + docs)[0]
+
+        # the rankings from the last full one up to the first one we read
+        prefix = []
+        if start.get('depth'):
+            prefix = list(self.rankings_col.find(
+                {'keyframe_id': start['keyframe_id'],
+                 'depth': {'$lt': start['depth']}}).sort('depth', pymongo.ASCENDING))
+        decoded = list(decode_rankings(prefix + before + docs))
+        skipped = len(prefix) + len(before)
+        if not with_previous:
+            return decoded[skipped:]
+        return (decoded[skipped - 1] if skipped else None), decoded[skipped:]
+
+    def _insert_raw_file_chunks(self, raw_file):
+        if raw_file.data_pieces is not None:
+            pieces = raw_file.data_pieces
+        else:
+            data = raw_file.data or ''
+            if isinstance(data, unicode):
+                data = data.encode('utf-8')
+            pieces = [data]
+
+        length = [0]
+
+        def counted(pieces):
+            for piece in pieces:
+                length[0] += len(piece)
+                yield piece
+
+        num_chunks = 0
+        batch = []
+        for chunk in compress_chunks(counted(pieces)):
+            batch.append({'raw_id': raw_file.id,
+                          'n': num_chunks,
+                          'data': Binary(chunk)})
+            num_chunks += 1
+            if len(batch) >= RAW_FILE_CHUNK_BATCH_SIZE:
+                self.raw_file_chunks_col.insert_many(batch)
+                batch = []
+        if batch:
+            self.raw_file_chunks_col.insert_many(batch)
+
+        raw_file.compression = RAW_FILE_COMPRESSION
+        raw_file.length = length[0]
+        raw_file.num_chunks = num_chunks
+        raw_file.data_pieces = None
 
     def insert_raw_file(self, raw_file):
-        return self.raw_files_col.insert(raw_file.dump(context='db'))
+        return self.insert_raw_files([raw_file])[0]
+
+    def insert_raw_files(self, raw_files):
+        '''Writes the compressed chunks first, so a raw file never shows up
+        without its data.'''
+        if not raw_files:
+            return []
+        for raw_file in raw_files:
+            self._insert_raw_file_chunks(raw_file)
+        return self.raw_files_col.insert_many(
+            [rf.dump(context='db', exclude=('data',)) for rf in raw_files]).inserted_ids
+
+    def update_raw_file(self, raw_file):
+        '''Rewrites the data of a raw file (also converts old inline raw
+        files to compressed chunks)'''
+        self.raw_file_chunks_col.delete_many({'raw_id': raw_file.id})
+        self._insert_raw_file_chunks(raw_file)
+        return self.raw_files_col.replace_one(
+            {'_id': raw_file.id}, raw_file.dump(context='db', exclude=('data',)))
+
+    def delete_raw_file(self, raw_file):
+        self.raw_files_col.delete_one({'_id': raw_file.id})
+        self.raw_file_chunks_col.delete_many({'raw_id': raw_file.id})
+
+    def iter_raw_file_data(self, raw_file):
+        '''Yields the (decompressed) data of raw_file piece by piece'''
+        if raw_file.compression is None:
+            if raw_file.data:
+                yield raw_file.data
+            return
+
+        decompressor = zlib.decompressobj()
+        for chunk in self.raw_file_chunks_col.find(
+                {'raw_id': raw_file.id}).sort([('n', pymongo.ASCENDING)]):
+            yield decompressor.decompress(str(chunk['data']))
+        yield decompressor.flush()
+
+    def get_raw_file_by_id(self, id, include_data=True):
+        '''id must be an ObjectId'''
+        raw_file = M.RawFile.load(self.raw_files_col.find_one({'_id': id}), context='db')
+        if raw_file is not None and include_data and raw_file.compression is not None:
+            raw_file.data = ''.join(self.iter_raw_file_data(raw_file))
+        return raw_file
 
 
 
@@ -541,17 +1813,20 @@ class Dao(object):
     def update_region_ranking_criteria(self, region_id,
                                        ranking_num_tourneys_attended,
                                        ranking_activity_day_limit,
-                                       tournament_qualified_day_limit):
-        if self.regions_col.find_one({'_id': region_id}):
-            self.regions_col.update({'_id': region_id},
-                                    {'$set':
-                                        {
-                                         'ranking_num_tourneys_attended': ranking_num_tourneys_attended,
-                                         'ranking_activity_day_limit': ranking_activity_day_limit,
-                                         'tournament_qualified_day_limit': tournament_qualified_day_limit
-                                        }
-                                     })
+                                       tournament_qualified_day_limit,
+                                       rating_engine=None):
+        criteria = {
+            'ranking_num_tourneys_attended': ranking_num_tourneys_attended,
+            'ranking_activity_day_limit': ranking_activity_day_limit,
+            'tournament_qualified_day_limit': tournament_qualified_day_limit
+        }
+        if rating_engine is not None:
+            if rating_engine not in M.RATING_ENGINE_CHOICES:
+                raise ValueError('unknown rating engine: {}'.format(rating_engine))
+            criteria['rating_engine'] = rating_engine
 
+        if self.regions_col.find_one({'_id': region_id}):
+            self.regions_col.update({'_id': region_id}, {'$set': criteria})
 
     def get_region_ranking_criteria(self, region_id):
         result = self.regions_col.find_one({'_id': region_id})
@@ -617,14 +1892,24 @@ class Dao(object):
         return M.User.load(result[0], context='db')
 
     def get_user_by_session_id_or_none(self, session_id):
-        # mongo magic here, go through and get a user by session_id if they
-        # exist, otherwise return none
-        result = self.sessions_col.find({"session_id": session_id})
-        if result.count() == 0:
+        '''The user session_id belongs to, None if there is no such session or
+        it has expired. Keeps the session alive.'''
+        if not session_id:
+            return None
+
+        # we look sessions up by the hash of their id, so how long the lookup
+        # takes says nothing about how close a guess was
+        session = M.Session.load(self.sessions_col.find_one(
+            {'token_hash': hash_session_token(session_id)}), context='db')
+        now = datetime.utcnow()
+        if session is None or session.last_seen is None or \
+                session.last_seen < now - SESSION_TTL:
             return None
-        assert result.count() == 1, "WE HAVE MULTIPLE MAPPINGS FOR THE SAME SESSION_ID"
-        user_id = result[0]["user_id"]
-        return self.get_user_by_id_or_none(user_id)
+
+        if session.last_seen < now - SESSION_LAST_SEEN_INTERVAL:
+            self.sessions_col.update_one({'token_hash': session.token_hash},
+                                         {'$set': {'last_seen': now}})
+        return self.get_user_by_id_or_none(session.user_id)
 
     def get_user_by_region(self, regions):
         pass
@@ -647,16 +1932,6 @@ class Dao(object):
             self.users_col.update({'_id': user.id}, user.dump(context='db'))
      '''
 
-    #### FOR INTERNAL USE ONLY ####
-    #XXX: this method must NEVER be publicly routeable, or you have session-hijacking
-    def get_session_id_by_user_or_none(self, User):
-        results = self.sessions_col.find()
-        for session_mapping in results:
-            if session_mapping.user_id == User.user_id:
-                return session_mapping.session_id
-        return None
-    # END OF YELLING #
-
     def check_creds_and_get_session_id_or_none(self, username, password):
         result = self.users_col.find({"username": username})
         if result.count() == 0:
@@ -685,10 +1960,31 @@ class Dao(object):
     def update_session_id_for_user(self, user_id, session_id):
         # lets force people to have only one session at a time
         self.sessions_col.remove({"user_id": user_id})
-        session_mapping = M.Session(session_id=session_id,
-                                    user_id=user_id)
+        now = datetime.utcnow()
+        session_mapping = M.Session(token_hash=hash_session_token(session_id),
+                                    user_id=user_id,
+                                    created=now,
+                                    last_seen=now)
         self.sessions_col.insert(session_mapping.dump(context='db'))
 
+    def hash_session_ids(self):
+        '''Replaces the session id of every session from before we hashed them
+        with its hash. Returns how many were hashed.'''
+        sessions = list(self.sessions_col.find({'session_id': {'$exists': True}}))
+        if not sessions:
+            return 0
+
+        now = datetime.utcnow()
+        bulk = self.sessions_col.initialize_unordered_bulk_op()
+        for session in sessions:
+            bulk.find({'_id': session['_id']}).update_one({
+                '$set': {'token_hash': hash_session_token(session['session_id']),
+                         'created': now,
+                         'last_seen': now},
+                '$unset': {'session_id': ''}})
+        bulk.execute()
+        return len(sessions)
+
     def logout_user_or_none(self, session_id):
         user = self.get_user_by_session_id_or_none(session_id)
         if user:
@@ -0,0 +1,131 @@
+from multiprocessing.pool import ThreadPool
+
+import alias_service
+import model as M
+
+from scraper.tio import TioScraper
+from scraper.challonge import ChallongeScraper
+from scraper.smashgg import SmashGGScraper
+
+# scraping is almost entirely waiting on challonge/smash.gg, so threads are
+# plenty here
+DEFAULT_NUM_WORKERS = 8
+
+STATUS_SUCCESS = 'success'
+STATUS_ERROR = 'error'
+
+
+def get_scraper(type, data, bracket=None, included_phases=None):
+    '''Builds the scraper for a single bracket. data is the contents of the
+    file for tio, and a bracket id or url for challonge/smashgg.'''
+    if type == 'tio':
+        if bracket is None:
+            raise ValueError('Missing bracket name')
+        if isinstance(data, unicode):
+            # json payloads come in as unicode (often with a BOM)
+            data = data.encode('utf-8')
+        return TioScraper(data, bracket)
+    elif type == 'challonge':
+        if 'challonge.com' in data:
+            data = ChallongeScraper.get_tournament_id_from_url(data)
+        return ChallongeScraper(data)
+    elif type == 'smashgg':
+        if not included_phases:
+            # default to every phase of the event
+            included_phases = SmashGGScraper.get_phase_ids(
+                SmashGGScraper.get_tournament_event_name_from_url(data),
+                SmashGGScraper.get_tournament_phase_name_from_url(data))
+        return SmashGGScraper(data, included_phases)
+    else:
+        raise ValueError('Unknown tournament type %s' % type)
+
+
+def _get_source(item):
+    if item.get('source'):
+        return item['source']
+    if item.get('type') == 'tio':
+        # don't echo back the whole file
+        return item.get('bracket')
+    return item.get('data')
+
+
+def _scrape(args):
+    index, item, region_id = args
+    result = {'index': index,
+              'source': _get_source(item),
+              'type': item.get('type')}
+
+    try:
+        scraper = get_scraper(item.get('type'),
+                              item.get('data'),
+                              bracket=item.get('bracket'),
+                              included_phases=item.get('included_phases'))
+        pending_tournament, raw_file = M.PendingTournament.from_scraper(
+            item.get('type'), scraper, region_id)
+        result['pending_tournament'] = pending_tournament
+        result['raw_file'] = raw_file
+    except Exception as ex:
+        result['status'] = STATUS_ERROR
+        result['error'] = 'Scraper encountered an error: ' + str(ex)
+
+    return result
+
+
+def import_tournaments(dao, items, num_workers=DEFAULT_NUM_WORKERS):
+    '''Scrapes every item in a worker pool, resolves the aliases of all
+    entrants with a single player lookup, and inserts the resulting pending
+    tournaments and raw files in bulk.
+
+    items is a list of dicts with keys type, data, and optionally bracket
+    (tio), included_phases (smashgg) and source (a label for the report).
+    Returns one status dict per item, in the same order.'''
+    if not items:
+        return []
+
+    pool = ThreadPool(max(1, min(num_workers, len(items))))
+    try:
+        results = pool.map(_scrape, [(i, item, dao.region_id)
+                                     for i, item in enumerate(items)])
+    finally:
+        pool.close()
+        pool.join()
+
+    scraped = [r for r in results if 'pending_tournament' in r]
+
+    try:
+        alias_maps = alias_service.get_alias_to_id_maps_in_list_format(
+            dao, [r['pending_tournament'].players for r in scraped])
+    except Exception as ex:
+        print ex
+        for r in scraped:
+            r['status'] = STATUS_ERROR
+            r['error'] = 'Alias service encountered an error'
+        scraped = []
+        alias_maps = []
+
+    for r, alias_map in zip(scraped, alias_maps):
+        r['pending_tournament'].alias_to_id_map = alias_map
+
+    try:
+        dao.insert_raw_files([r['raw_file'] for r in scraped])
+        dao.insert_pending_tournaments(
+            [r['pending_tournament'] for r in scraped])
+        for r in scraped:
+            r['status'] = STATUS_SUCCESS
+    except Exception as ex:
+        print ex
+        for r in scraped:
+            r['status'] = STATUS_ERROR
+            r['error'] = 'Dao encountered an error inserting pending tournaments'
+
+    report = []
+    for r in results:
+        pending_tournament = r.pop('pending_tournament', None)
+        r.pop('raw_file', None)
+        if pending_tournament is not None and r['status'] == STATUS_SUCCESS:
+            r['id'] = str(pending_tournament.id)
+            r['name'] = pending_tournament.name
+            r['num_players'] = len(pending_tournament.players)
+        report.append(r)
+
+    return report
@@ -0,0 +1,79 @@
+import threading
+
+# merging a player doesn't touch the tournaments they played in: they keep
+# the merged player's id, and the dao resolves it to the player it was merged
+# into whenever it reads tournaments, head to heads or stats. the merges form
+# a forest (every merged player's merge_parent), which is kept in memory (per
+# process) and reloaded whenever a merge or unmerge changes the version the
+# dao stores with it. Dao.compact_merges writes the resolved ids into the
+# tournaments, so they don't have to be resolved on every read.
+
+
+class MergeForest(object):
+    '''Union-find over the merged players: resolves any player id to the id
+    of the unmerged player it was merged into (directly or not)'''
+
+    def __init__(self, parents=None):
+        # merged player id -> the id it was merged into (or, once find has
+        # been through it, the id that resolves to)
+        self.parents = dict(parents or {})
+        self.lock = threading.Lock()
+        self._members = None
+
+    def __len__(self):
+        return len(self.parents)
+
+    def find(self, player_id):
+        root = player_id
+        while root in self.parents:
+            root = self.parents[root]
+
+        # path compression. racing threads all write the same root, so this
+        # doesn't need the lock
+        while player_id != root:
+            next_id = self.parents[player_id]
+            self.parents[player_id] = root
+            player_id = next_id
+        return root
+
+    def members(self, player_id):
+        '''The ids that resolve to player_id (player_id included). Empty if
+        player_id has been merged into someone else.'''
+        if player_id in self.parents:
+            return set()
+        with self.lock:
+            if self._members is None:
+                members = {}
+                for merged_id in self.parents.keys():
+                    root = self.find(merged_id)
+                    members.setdefault(root, set([root])).add(merged_id)
+                self._members = members
+        return self._members.get(player_id, set([player_id]))
+
+
+class MergeForestCache(object):
+    '''The latest forest loaded, and its version, by database'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.forests = {}
+
+    def get(self, database_name, version):
+        if version is None:
+            return None
+        with self.lock:
+            cached_version, forest = self.forests.get(database_name, (None, None))
+        return forest if cached_version == version else None
+
+    def put(self, database_name, version, forest):
+        if version is None:
+            return
+        with self.lock:
+            self.forests[database_name] = (version, forest)
+
+    def clear(self):
+        with self.lock:
+            self.forests = {}
+
+
+cache = MergeForestCache()
@@ -0,0 +1,261 @@
+import threading
+import time
+
+from flask import Response, request
+from pymongo import monitoring
+
+import orm
+
+# request metrics, in the prometheus text format at /metrics. per route, we
+# keep the number of requests, wall time, number and time of mongo commands,
+# time spent loading/dumping orm documents (which makes N+1 query patterns
+# easy to spot) and time spent hashing passwords. numbers are per process (each uwsgi worker keeps its
+# own).
+
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+# upper bounds (in seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# used for requests that didn't match any route (e.g. 404s)
+UNMATCHED_ROUTE = 'unmatched'
+
+_local = threading.local()
+
+
+class RequestStats(object):
+    '''What a single request spent its time on'''
+
+    def __init__(self):
+        self.start = time.time()
+        self.mongo_commands = 0
+        self.mongo_seconds = 0.0
+        self.orm_load_seconds = 0.0
+        self.orm_dump_seconds = 0.0
+        self.orm_depth = 0
+        self.password_hashes = 0
+        self.password_hash_seconds = 0.0
+        self.recorded = False
+
+
+def _current_stats():
+    return getattr(_local, 'stats', None)
+
+
+class RouteMetrics(object):
+    '''Running totals for one (method, route)'''
+
+    def __init__(self):
+        self.statuses = {}
+        self.count = 0
+        self.seconds = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.mongo_commands = 0
+        self.mongo_seconds = 0.0
+        self.orm_load_seconds = 0.0
+        self.orm_dump_seconds = 0.0
+        self.password_hashes = 0
+        self.password_hash_seconds = 0.0
+
+    def add(self, status, seconds, stats):
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.count += 1
+        self.seconds += seconds
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+        self.mongo_commands += stats.mongo_commands
+        self.mongo_seconds += stats.mongo_seconds
+        self.orm_load_seconds += stats.orm_load_seconds
+        self.orm_dump_seconds += stats.orm_dump_seconds
+        self.password_hashes += stats.password_hashes
+        self.password_hash_seconds += stats.password_hash_seconds
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}
+
+    def record(self, method, route, status, seconds, stats):
+        with self.lock:
+            key = (method, route)
+            if key not in self.routes:
+                self.routes[key] = RouteMetrics()
+            self.routes[key].add(status, seconds, stats)
+
+    def reset(self):
+        with self.lock:
+            self.routes = {}
+
+    def render(self):
+        '''Returns every metric in the prometheus text exposition format'''
+        with self.lock:
+            routes = sorted(self.routes.items())
+
+            lines = []
+
+            def header(name, type, help):
+                lines.append('# HELP {} {}'.format(name, help))
+                lines.append('# TYPE {} {}'.format(name, type))
+
+            def sample(name, labels, value):
+                label_str = ','.join('{}="{}"'.format(k, _escape(v)) for k, v in labels)
+                lines.append('{}{{{}}} {}'.format(name, label_str, repr(value)))
+
+            header('garpr_requests_total', 'counter', 'Requests handled.')
+            for (method, route), m in routes:
+                for status, count in sorted(m.statuses.items()):
+                    sample('garpr_requests_total',
+                           [('method', method), ('route', route), ('status', status)], count)
+
+            header('garpr_request_duration_seconds', 'histogram', 'Request wall time.')
+            for (method, route), m in routes:
+                labels = [('method', method), ('route', route)]
+                for bound, count in zip(LATENCY_BUCKETS, m.buckets):
+                    sample('garpr_request_duration_seconds_bucket',
+                           labels + [('le', repr(bound))], count)
+                sample('garpr_request_duration_seconds_bucket', labels + [('le', '+Inf')], m.count)
+                sample('garpr_request_duration_seconds_sum', labels, m.seconds)
+                sample('garpr_request_duration_seconds_count', labels, m.count)
+
+            for name, attr, type, help in [
+                    ('garpr_mongo_commands_total', 'mongo_commands', 'counter',
+                     'Mongo commands sent while handling requests.'),
+                    ('garpr_mongo_seconds_total', 'mongo_seconds', 'counter',
+                     'Time spent in mongo commands while handling requests.'),
+                    ('garpr_orm_load_seconds_total', 'orm_load_seconds', 'counter',
+                     'Time spent loading orm documents while handling requests.'),
+                    ('garpr_orm_dump_seconds_total', 'orm_dump_seconds', 'counter',
+                     'Time spent dumping orm documents while handling requests.'),
+                    ('garpr_password_hashes_total', 'password_hashes', 'counter',
+                     'Passwords hashed while handling requests.'),
+                    ('garpr_password_hash_seconds_total', 'password_hash_seconds', 'counter',
+                     'Time spent waiting for password hashes while handling requests.')]:
+                header(name, type, help)
+                for (method, route), m in routes:
+                    sample(name, [('method', method), ('route', route)], getattr(m, attr))
+
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+registry = Registry()
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    '''Adds every mongo command to the stats of the request that sent it.
+    pymongo publishes command events on the thread that runs the command.'''
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._record(event)
+
+    def failed(self, event):
+        self._record(event)
+
+    def _record(self, event):
+        stats = _current_stats()
+        if stats is not None:
+            stats.mongo_commands += 1
+            stats.mongo_seconds += event.duration_micros / 1e6
+
+
+def record_password_hash(seconds):
+    '''Adds a password hash to the stats of the current request'''
+    stats = _current_stats()
+    if stats is not None:
+        stats.password_hashes += 1
+        stats.password_hash_seconds += seconds
+
+
+def _timed_orm_call(func, attr):
+    def wrapper(*args, **kwargs):
+        stats = _current_stats()
+        if stats is None:
+            return func(*args, **kwargs)
+
+        # documents load/dump their nested documents, only time the outer call
+        stats.orm_depth += 1
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stats.orm_depth -= 1
+            if stats.orm_depth == 0:
+                setattr(stats, attr, getattr(stats, attr) + time.time() - start)
+    return wrapper
+
+
+def instrument_orm():
+    if getattr(orm.Document, '_instrumented', False):
+        return
+    orm.Document.dump = _timed_orm_call(orm.Document.dump.im_func, 'orm_dump_seconds')
+    orm.Document.load = classmethod(_timed_orm_call(
+        orm.Document.__dict__['load'].__func__, 'orm_load_seconds'))
+    orm.Document._instrumented = True
+
+
+def server_timing_header(stats, seconds):
+    return ', '.join([
+        'total;dur={:.1f}'.format(seconds * 1000),
+        'mongo;dur={:.1f};desc="{} commands"'.format(stats.mongo_seconds * 1000,
+                                                    stats.mongo_commands),
+        'orm-load;dur={:.1f}'.format(stats.orm_load_seconds * 1000),
+        'orm-dump;dur={:.1f}'.format(stats.orm_dump_seconds * 1000)])
+
+
+def _request_route():
+    return request.url_rule.rule if request.url_rule is not None else UNMATCHED_ROUTE
+
+
+def _record_request(method, route, status, stats):
+    if stats.recorded:
+        return
+    stats.recorded = True
+    if _current_stats() is stats:
+        _local.stats = None
+    registry.record(method, route, status, time.time() - stats.start, stats)
+
+
+def init_app(app, server_timing=False):
+    '''Records metrics for every request to app, and serves them at /metrics.
+    With server_timing, every response also gets a Server-Timing header.'''
+    instrument_orm()
+
+    @app.before_request
+    def start_request_metrics():
+        _local.stats = RequestStats()
+
+    @app.after_request
+    def record_request_metrics(resp):
+        stats = _current_stats()
+        if stats is None:
+            return resp
+
+        # the header only covers the time until the body starts, the metrics
+        # are recorded once it has been sent (streamed bodies run after this)
+        if server_timing:
+            resp.headers['Server-Timing'] = server_timing_header(
+                stats, time.time() - stats.start)
+        method, route, status = request.method, _request_route(), resp.status_code
+        resp.call_on_close(lambda: _record_request(method, route, status, stats))
+        return resp
+
+    @app.teardown_request
+    def record_failed_request_metrics(exc):
+        # requests that raised never get to after_request
+        stats = _current_stats()
+        if stats is not None and exc is not None:
+            _record_request(request.method, _request_route(), 500, stats)
+
+    def metrics():
+        return Response(registry.render(), content_type=METRICS_CONTENT_TYPE)
+
+    app.add_url_rule('/metrics', 'metrics', metrics)
@@ -1,11 +1,17 @@
 from bson.objectid import ObjectId
 
+import codecs
+import json
 import trueskill
 
 import orm
 
 SOURCE_TYPE_CHOICES = ('tio', 'challonge', 'smashgg', 'other')
 ADMIN_LEVEL_CHOICES = ('REGION', 'SUPER')
+RATING_ENGINE_CHOICES = ('trueskill', 'elo', 'glicko2')
+
+# characters of raw scraper text encoded to json at a time (see iter_raw_json)
+RAW_JSON_PIECE_SIZE = 64 * 1024
 # Embedded documents
 
 class AliasMapping(orm.Document):
@@ -77,8 +83,13 @@ MONGO_ID_SELECTOR = {'db': '_id',
                      'web': 'id'}
 
 
+# the dao also stores a change_stamp on every player (see dao.py), and keeps
+# the ids of deleted players in deleted_collection_name. ratings aren't stored
+# on the player, but in their own collection (see PlayerRating); the dao
+# fills them in when it loads players.
 class Player(orm.Document):
     collection_name = 'players'
+    deleted_collection_name = 'deleted_players'
     fields = [('id', orm.ObjectIDField(required=True, load_from=MONGO_ID_SELECTOR,
                                        dump_to=MONGO_ID_SELECTOR)),
               ('name', orm.StringField(required=True)),
@@ -110,8 +121,8 @@ class Player(orm.Document):
             self.aliases = [self.name.lower()]
 
     @classmethod
-    def create_with_default_values(cls, name, region):
-        return cls(id=ObjectId(),
+    def create_with_default_values(cls, name, region, id=None):
+        return cls(id=id or ObjectId(),
                    name=name,
                    aliases=[name.lower()],
                    ratings={},
@@ -133,7 +144,9 @@ class Tournament(orm.Document):
               ('matches', orm.ListField(orm.DocumentField(Match))),
               ('players', orm.ListField(orm.ObjectIDField())),
               ('orig_ids', orm.ListField(orm.ObjectIDField())),
-              ('excluded', orm.BooleanField(default=False))]
+              ('excluded', orm.BooleanField(default=False)),
+              # bumped on every write, for optimistic concurrency
+              ('version', orm.IntField())]
 
     def validate_document(self):
         # check: set of players in players = set of players in matches
@@ -244,7 +257,10 @@ class PendingTournament(orm.Document):
               ('matches', orm.ListField(orm.DocumentField(AliasMatch))),
               ('players', orm.ListField(orm.StringField())),
               ('alias_to_id_map', orm.ListField(orm.DocumentField(AliasMapping))),
-              ('excluded', orm.BooleanField(default=False))]
+              ('excluded', orm.BooleanField(default=False)),
+              # ids of the players an in progress finalize is creating (see
+              # Dao.finalize_pending_tournament)
+              ('new_player_ids', orm.ListField(orm.ObjectIDField()))]
 
     def validate_document(self):
         # check: set of aliases = set of aliases in matches
@@ -291,8 +307,8 @@ class PendingTournament(orm.Document):
 
     @classmethod
     def from_scraper(cls, type, scraper, region_id):
-        raw_file = RawFile(id=ObjectId(),
-                           data=str(scraper.get_raw()))
+        raw_file = RawFile(id=ObjectId())
+        raw_file.data_pieces = iter_raw_json(scraper.get_raw())
         pending_tournament = cls(
             id=ObjectId(),
             name=scraper.get_name(),
@@ -321,11 +337,56 @@ class PendingTournament(orm.Document):
 # used to store large blobs of data (e.g. raw tournament data) so we don't
 # need to carry around tournament data as much. (might eventually be replaced
 # with something like S3)
+# data is json. the dao stores it compressed in chunks_collection_name and
+# only keeps the metadata here; old raw files still have data inline (with
+# compression unset). a new raw file can have its data in data_pieces
+# instead, an iterable of pieces of json written as they come.
 class RawFile(orm.Document):
     collection_name = 'raw_files'
+    chunks_collection_name = 'raw_file_chunks'
     fields = [('id', orm.ObjectIDField(required=True, load_from=MONGO_ID_SELECTOR,
                                        dump_to=MONGO_ID_SELECTOR)),
-              ('data', orm.StringField())]
+              ('data', orm.StringField()),
+              ('compression', orm.StringField()),
+              ('length', orm.IntField()),
+              ('num_chunks', orm.IntField())]
+
+    def post_init(self):
+        self.data_pieces = None
+
+
+def _raw_text_encoding(raw):
+    '''utf-8 if raw is valid utf-8, otherwise latin-1 (which any bytes are).
+    .tio files aren't always saved as utf-8.'''
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        for i in xrange(0, len(raw), RAW_JSON_PIECE_SIZE):
+            decoder.decode(raw[i:i + RAW_JSON_PIECE_SIZE])
+        decoder.decode('', final=True)
+    except UnicodeDecodeError:
+        return 'latin-1'
+    return 'utf-8'
+
+
+def iter_raw_json(raw):
+    '''Yields raw (what a scraper got) as json, a piece at a time, so large
+    brackets are never held in memory as a single json string'''
+    if not isinstance(raw, basestring):
+        for piece in json.JSONEncoder().iterencode(raw):
+            yield piece
+        return
+
+    decoder = None
+    if isinstance(raw, str):
+        decoder = codecs.getincrementaldecoder(_raw_text_encoding(raw))()
+    yield '"'
+    for i in xrange(0, len(raw), RAW_JSON_PIECE_SIZE):
+        piece = raw[i:i + RAW_JSON_PIECE_SIZE]
+        if decoder is not None:
+            piece = decoder.decode(piece)
+        # strip the quotes, the string continues in the next piece
+        yield json.encoder.encode_basestring_ascii(piece)[1:-1]
+    yield '"'
 
 class Ranking(orm.Document):
     collection_name = 'rankings'
@@ -343,7 +404,9 @@ class Region(orm.Document):
               ('display_name', orm.StringField(required=True)),
               ('ranking_num_tourneys_attended', orm.IntField(required=True, default=2)),
               ('ranking_activity_day_limit', orm.IntField(required=True, default=60)),
-              ('tournament_qualified_day_limit', orm.IntField(required=True, default=999))]
+              ('tournament_qualified_day_limit', orm.IntField(required=True, default=999)),
+              ('rating_engine', orm.StringField(required=True, default='trueskill',
+                                                validators=[orm.validate_choices(RATING_ENGINE_CHOICES)]))]
 
 
 class User(orm.Document):
@@ -360,13 +423,20 @@ class User(orm.Document):
 
 
 class Merge(orm.Document):
+    '''A merge of source into target, and what it changed (so it can be
+    undone exactly): the aliases and regions target got from source, and the
+    tournaments rewritten from source's ids to target's (see
+    Dao.compact_merges)'''
     collection_name = 'merges'
     fields = [('id', orm.ObjectIDField(required=True, load_from=MONGO_ID_SELECTOR,
                                        dump_to=MONGO_ID_SELECTOR)),
               ('requester_user_id', orm.StringField()),
               ('source_player_obj_id', orm.ObjectIDField(required=True)),
               ('target_player_obj_id', orm.ObjectIDField(required=True)),
-              ('time', orm.DateTimeField())]
+              ('time', orm.DateTimeField()),
+              ('aliases_added', orm.ListField(orm.StringField())),
+              ('regions_added', orm.ListField(orm.StringField())),
+              ('rewritten_tournaments', orm.ListField(orm.ObjectIDField()))]
 
     def validate_document(self):
         if self.source_player_obj_id == self.target_player_obj_id:
@@ -376,6 +446,68 @@ class Merge(orm.Document):
 
 
 class Session(orm.Document):
+    '''We only keep a hash of the session id (the token in the client's
+    cookie), so the sessions collection is no good to anyone who reads it.
+    Expires (see dao) once it hasn't been seen for a while.'''
     collection_name = 'sessions'
-    fields = [('session_id', orm.StringField(required=True)),
-              ('user_id', orm.StringField(required=True))]
+    fields = [('token_hash', orm.StringField(required=True)),
+              ('user_id', orm.StringField(required=True)),
+              ('created', orm.DateTimeField()),
+              ('last_seen', orm.DateTimeField())]
+
+
+class HeadToHead(orm.Document):
+    '''Record of player against opponent in the tournaments of region, kept up
+    to date by the dao whenever a tournament's matches change. Every pair of
+    players who have played each other has two of these per region, one from
+    each side.'''
+    collection_name = 'head_to_head'
+    fields = [('player', orm.ObjectIDField(required=True)),
+              ('opponent', orm.ObjectIDField(required=True)),
+              ('region', orm.StringField(required=True)),
+              ('wins', orm.IntField(required=True, default=0)),
+              ('losses', orm.IntField(required=True, default=0)),
+              ('excluded', orm.IntField(required=True, default=0)),
+              ('last_played', orm.DateTimeField())]
+
+
+class PlayerRating(orm.Document):
+    '''Rating of player in region, one per (player, region). Kept apart from
+    the player so a ranking run only writes the ratings of its own region.'''
+    collection_name = 'ratings'
+    fields = [('player', orm.ObjectIDField(required=True)),
+              ('region', orm.StringField(required=True)),
+              ('rating', orm.DocumentField(Rating, required=True))]
+
+
+class BestWin(orm.Document):
+    collection_name = None
+    fields = [('opponent', orm.ObjectIDField(required=True)),
+              ('rating', orm.FloatField(required=True)),
+              ('tournament', orm.ObjectIDField()),
+              ('date', orm.DateTimeField())]
+
+
+class RatingHistoryEntry(orm.Document):
+    collection_name = None
+    fields = [('time', orm.DateTimeField(required=True)),
+              ('rating', orm.FloatField(required=True)),
+              # None if the player wasn't ranked (e.g. inactive)
+              ('rank', orm.IntField())]
+
+
+class PlayerStats(orm.Document):
+    '''Career totals of a player (whose id this has). Records and attendance
+    are kept up to date by the dao as tournaments change, best wins and rating
+    history (both by region) by ranking runs.'''
+    collection_name = 'player_stats'
+    fields = [('id', orm.ObjectIDField(required=True, load_from=MONGO_ID_SELECTOR,
+                                       dump_to=MONGO_ID_SELECTOR)),
+              ('wins', orm.IntField(required=True, default=0)),
+              ('losses', orm.IntField(required=True, default=0)),
+              ('tournaments_attended', orm.IntField(required=True, default=0)),
+              ('last_active', orm.DateTimeField()),
+              ('best_wins', orm.DictField(orm.StringField(),
+                                          orm.ListField(orm.DocumentField(BestWin)))),
+              ('rating_history', orm.DictField(orm.StringField(),
+                                               orm.ListField(orm.DocumentField(RatingHistoryEntry))))]
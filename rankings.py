@@ -1,20 +1,61 @@
 from bson.objectid import ObjectId
 from datetime import datetime, timedelta
 
-import trueskill
-
 import model
 import rating_calculators
 
-
-def generate_ranking(dao, now=datetime.now(), day_limit=60, num_tourneys=2, tournament_qualified_day_limit=999):
-    player_date_map = {}
-    player_id_to_player_map = {}
-
+# best wins kept in each player's stats, per region
+BEST_WINS_LIMIT = 10
+
+
+class RatingReplay(object):
+    '''Everyone's rating after replaying a region's qualified tournaments,
+    and what the ranking criteria need to know about them. Replaying doesn't
+    write anything to the db.'''
+
+    def __init__(self, region_id, tournaments, engine):
+        self.region_id = region_id
+        self.engine = engine
+        # every tournament in the region, qualified or not
+        self.tournaments = tournaments
+        # player id -> Player
+        self.players = {}
+        # player id -> their rating, in whatever form the engine keeps it
+        self.ratings = {}
+        # player id -> date of the last qualified tournament they entered
+        self.last_active = {}
+        # player id -> dates of every tournament they entered
+        self.attended = {}
+        # winner id -> {loser id -> last tournament they beat them in}
+        self.wins = {}
+
+    def rating(self, player_id):
+        return self.engine.expose(self.ratings[player_id])
+
+
+def replay_ratings(dao, now=datetime.now(), tournament_qualified_day_limit=999,
+                   rating_engine='trueskill'):
+    '''Replays the region's qualified tournaments, oldest first, each one as a
+    rating period. Replayed players get their new rating in
+    player.ratings[region].'''
     tournament_qualified_date = (now - timedelta(days=tournament_qualified_day_limit))
     print('Qualified Date: ' + str(tournament_qualified_date))
 
     tournaments = dao.get_all_tournaments(regions=[dao.region_id])
+    replay = RatingReplay(dao.region_id, tournaments,
+                          rating_calculators.get_rating_engine(rating_engine))
+
+    # load everyone who played in a qualified tournament at once
+    player_ids = set()
+    for tournament in tournaments:
+        for player_id in tournament.players:
+            replay.attended.setdefault(player_id, []).append(tournament.date)
+        if tournament.excluded is not True and tournament_qualified_date <= tournament.date:
+            for match in tournament.matches:
+                player_ids.add(match.winner)
+                player_ids.add(match.loser)
+    db_players = {player.id: player for player in dao.get_players_by_ids(player_ids)}
+
     for tournament in tournaments:
         if tournament.excluded is True:
             print 'Tournament Excluded:'
@@ -24,9 +65,9 @@ def generate_ranking(dao, now=datetime.now(), day_limit=60, num_tourneys=2, tour
         if tournament_qualified_date <= tournament.date:
             print 'Processing:', tournament.name.encode('utf-8'), str(tournament.date)
             for player_id in tournament.players:
-                player_date_map[player_id] = tournament.date
+                replay.last_active[player_id] = tournament.date
 
-            # TODO add a default rating entry when we add it to the map
+            matches = []
             for match in tournament.matches:
                 if match.excluded is True:
                     print('match excluded:')
@@ -35,61 +76,105 @@ def generate_ranking(dao, now=datetime.now(), day_limit=60, num_tourneys=2, tour
                     continue
 
                 # don't count matches where either player is OOR
-                winner = dao.get_player_by_id(match.winner)
-                if dao.region_id not in winner.regions:
+                winner = db_players.get(match.winner)
+                if winner is None or dao.region_id not in winner.regions:
                     continue
-                loser = dao.get_player_by_id(match.loser)
-                if dao.region_id not in loser.regions:
+                loser = db_players.get(match.loser)
+                if loser is None or dao.region_id not in loser.regions:
                     continue
 
-                if match.winner not in player_id_to_player_map:
-                    db_player = dao.get_player_by_id(match.winner)
-                    db_player.ratings[dao.region_id] = model.Rating()
-                    player_id_to_player_map[match.winner] = db_player
+                for player in (winner, loser):
+                    if player.id not in replay.players:
+                        replay.players[player.id] = player
+                        replay.ratings[player.id] = replay.engine.initial_rating()
 
-                if match.loser not in player_id_to_player_map:
-                    db_player = dao.get_player_by_id(match.loser)
-                    db_player.ratings[dao.region_id] = model.Rating()
-                    player_id_to_player_map[match.loser] = db_player
+                replay.wins.setdefault(match.winner, {})[match.loser] = tournament
+                matches.append((match.winner, match.loser))
 
-                winner = player_id_to_player_map[match.winner]
-                loser = player_id_to_player_map[match.loser]
+            replay.engine.rate_period(replay.ratings, matches)
 
+    for player_id, player in replay.players.iteritems():
+        player.ratings[dao.region_id] = replay.engine.to_rating(replay.ratings[player_id])
 
-                rating_calculators.update_trueskill_ratings(
-                    dao.region_id, winner=winner, loser=loser)
+    return replay
 
-    print 'Checking for player inactivity...'
-    rank = 1
-    players = player_id_to_player_map.values()
+
+def rank_players(replay, now=datetime.now(), day_limit=60, num_tourneys=2):
+    '''Returns the ranking entries for the players in replay who meet the
+    activity criteria'''
+    active_date = now - timedelta(days=day_limit)
     sorted_players = sorted(
-        players,
-        key=lambda player: trueskill.expose(player.ratings[dao.region_id].trueskill_rating()), reverse=True)
+        replay.players.values(),
+        key=lambda player: replay.rating(player.id), reverse=True)
+
     ranking = []
     for player in sorted_players:
-        player_last_active_date = player_date_map.get(player.id)
-        if player_last_active_date is None or \
-                dao.is_inactive(player, now, day_limit, num_tourneys) or \
-                dao.region_id not in player.regions:
+        num_attended = len([d for d in replay.attended.get(player.id, []) if d >= active_date])
+        if replay.last_active.get(player.id) is None or \
+                num_attended < num_tourneys or \
+                replay.region_id not in player.regions:
             pass  # do nothing, skip this player
         else:
             ranking.append(model.RankingEntry(
-                rank=rank,
-                player=player.id, rating=trueskill.expose(player.ratings[dao.region_id].trueskill_rating())))
-            rank += 1
+                rank=len(ranking) + 1,
+                player=player.id, rating=replay.rating(player.id)))
+    return ranking
+
+
+def simulate_rankings(dao, criteria_sets, now=datetime.now()):
+    '''Returns the ranking each of criteria_sets (dicts with the same keys as
+    the region's ranking criteria) would give, in the same order. The region
+    is replayed once per tournament_qualified_day_limit and rating_engine,
+    since those are the only criteria that change the ratings. Nothing is
+    written to the db.'''
+    replays = {}
+    rankings = []
+    for criteria in criteria_sets:
+        key = (criteria['tournament_qualified_day_limit'],
+               criteria.get('rating_engine', 'trueskill'))
+        if key not in replays:
+            replays[key] = replay_ratings(
+                dao, now=now, tournament_qualified_day_limit=key[0], rating_engine=key[1])
+        rankings.append(rank_players(replays[key], now=now,
+                                     day_limit=criteria['ranking_activity_day_limit'],
+                                     num_tourneys=criteria['ranking_num_tourneys_attended']))
+    return rankings
+
+
+def generate_ranking(dao, now=datetime.now(), day_limit=60, num_tourneys=2, tournament_qualified_day_limit=999,
+                     rating_engine='trueskill'):
+    replay = replay_ratings(dao, now=now,
+                            tournament_qualified_day_limit=tournament_qualified_day_limit,
+                            rating_engine=rating_engine)
 
-    print 'Updating players...'
-    for i, p in enumerate(players, start=1):
-        dao.update_player(p)
-        # TODO: log somewhere later
-        # print 'Updated player %d of %d' % (i, len(players))
+    print 'Checking for player inactivity...'
+    ranking = rank_players(replay, now=now, day_limit=day_limit, num_tourneys=num_tourneys)
+
+    print 'Updating ratings...'
+    players = replay.players.values()
+    dao.update_ratings({player.id: player.ratings[dao.region_id] for player in players})
+
+    print 'Updating player stats...'
+    ranks = {entry.player: entry.rank for entry in ranking}
+    ratings = {player.id: replay.rating(player.id) for player in players}
+    rating_history = {player_id: model.RatingHistoryEntry(time=now, rating=rating,
+                                                          rank=ranks.get(player_id))
+                      for player_id, rating in ratings.iteritems()}
+    best_wins = {}
+    for player_id, wins in replay.wins.iteritems():
+        best_wins[player_id] = sorted(
+            [model.BestWin(opponent=loser_id, rating=ratings[loser_id],
+                           tournament=tournament.id, date=tournament.date)
+             for loser_id, tournament in wins.iteritems()],
+            key=lambda win: win.rating, reverse=True)[:BEST_WINS_LIMIT]
+    dao.record_ranking_stats(rating_history, best_wins)
 
     print 'Inserting new ranking...'
     dao.insert_ranking(model.Ranking(
         id=ObjectId(),
         region=dao.region_id,
         time=now,
-        tournaments=[t.id for t in tournaments],
+        tournaments=[t.id for t in replay.tournaments],
         ranking=ranking))
 
     print 'Done!'
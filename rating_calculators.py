@@ -1,4 +1,6 @@
+import math
 import trueskill
+
 from model import Rating
 
 def update_trueskill_ratings(region_id, winner=None, loser=None):
@@ -12,3 +14,200 @@ def update_trueskill_ratings(region_id, winner=None, loser=None):
 
     winner_ratings_dict[region_id] = Rating.from_trueskill(new_winner_rating)
     loser_ratings_dict[region_id] = Rating.from_trueskill(new_loser_rating)
+
+
+# rating engines. an engine rates players from batches of matches: each batch
+# is a rating period (for us, a tournament), and holds (winner id, loser id)
+# pairs in the order they were played. engines keep whatever state they need
+# per player while replaying, and convert it to a model.Rating at the end.
+
+class RatingEngine(object):
+    name = None
+
+    def initial_rating(self):
+        '''The state of a player who hasn't played yet'''
+        raise NotImplementedError
+
+    def rate_period(self, ratings, matches):
+        '''Updates ratings (player id -> state) in place with the matches
+        played in one rating period. Every player in matches must be in
+        ratings.'''
+        raise NotImplementedError
+
+    def expose(self, rating):
+        '''The number players are ranked by'''
+        raise NotImplementedError
+
+    def win_probability(self, rating, opponent_rating):
+        '''How likely a player with rating is to beat one with opponent_rating'''
+        raise NotImplementedError
+
+    def to_rating(self, rating):
+        '''The model.Rating stored for a player'''
+        raise NotImplementedError
+
+
+class TrueSkillEngine(RatingEngine):
+    '''TrueSkill, one match at a time'''
+    name = 'trueskill'
+
+    def initial_rating(self):
+        return trueskill.Rating()
+
+    def rate_period(self, ratings, matches):
+        for winner, loser in matches:
+            ratings[winner], ratings[loser] = trueskill.rate_1vs1(ratings[winner], ratings[loser])
+
+    def expose(self, rating):
+        return trueskill.expose(rating)
+
+    def win_probability(self, rating, opponent_rating):
+        beta = trueskill.global_env().beta
+        spread = math.sqrt(2 * beta ** 2 + rating.sigma ** 2 + opponent_rating.sigma ** 2)
+        return 0.5 * (1 + math.erf((rating.mu - opponent_rating.mu) / (spread * math.sqrt(2))))
+
+    def to_rating(self, rating):
+        return Rating.from_trueskill(rating)
+
+
+class EloEngine(RatingEngine):
+    '''Plain Elo, one match at a time. Elo has no uncertainty, so stored
+    ratings have a sigma of 0.'''
+    name = 'elo'
+
+    def __init__(self, initial=1500., k_factor=32.):
+        self.initial = initial
+        self.k_factor = k_factor
+
+    def initial_rating(self):
+        return self.initial
+
+    def rate_period(self, ratings, matches):
+        for winner, loser in matches:
+            change = self.k_factor * (1 - self.win_probability(ratings[winner], ratings[loser]))
+            ratings[winner] += change
+            ratings[loser] -= change
+
+    def expose(self, rating):
+        return rating
+
+    def win_probability(self, rating, opponent_rating):
+        return 1. / (1 + 10 ** ((opponent_rating - rating) / 400.))
+
+    def to_rating(self, rating):
+        return Rating(mu=rating, sigma=0.)
+
+
+# glicko-2 works on its own scale: rating = GLICKO2_SCALE * mu + initial rating
+GLICKO2_SCALE = 173.7178
+GLICKO2_CONVERGENCE = 0.000001
+
+
+class Glicko2Engine(RatingEngine):
+    '''Glicko-2 (http://www.glicko.net/glicko/glicko2.pdf). All the matches of
+    a period are rated against everyone's rating from before the period, and
+    the deviation of players who sat a period out grows. Ratings are
+    (mu, phi, volatility) on the glicko-2 scale; stored ratings are the usual
+    rating and rating deviation.'''
+    name = 'glicko2'
+
+    def __init__(self, initial=1500., deviation=350., volatility=0.06, tau=0.5):
+        self.initial = initial
+        self.deviation = deviation
+        self.volatility = volatility
+        self.tau = tau
+
+    def initial_rating(self):
+        return (0., self.deviation / GLICKO2_SCALE, self.volatility)
+
+    def rate_period(self, ratings, matches):
+        results = {}
+        for winner, loser in matches:
+            results.setdefault(winner, []).append((loser, 1.))
+            results.setdefault(loser, []).append((winner, 0.))
+
+        new_ratings = {}
+        for player_id, rating in ratings.iteritems():
+            mu, phi, volatility = rating
+            if player_id not in results:
+                new_ratings[player_id] = (mu, math.sqrt(phi ** 2 + volatility ** 2), volatility)
+                continue
+
+            v_inv = 0.
+            improvement = 0.
+            for opponent_id, score in results[player_id]:
+                opponent_mu, opponent_phi, _ = ratings[opponent_id]
+                g = _glicko2_g(opponent_phi)
+                e = _glicko2_e(mu, opponent_mu, g)
+                v_inv += g ** 2 * e * (1 - e)
+                improvement += g * (score - e)
+            v = 1. / v_inv
+            delta = v * improvement
+
+            volatility = self._new_volatility(phi, volatility, v, delta)
+            phi_star = math.sqrt(phi ** 2 + volatility ** 2)
+            phi = 1. / math.sqrt(1. / phi_star ** 2 + 1. / v)
+            new_ratings[player_id] = (mu + phi ** 2 * improvement, phi, volatility)
+
+        ratings.update(new_ratings)
+
+    def _new_volatility(self, phi, volatility, v, delta):
+        # the illinois algorithm, as in step 5 of the paper
+        a = math.log(volatility ** 2)
+
+        def f(x):
+            ex = math.exp(x)
+            return ex * (delta ** 2 - phi ** 2 - v - ex) / (2 * (phi ** 2 + v + ex) ** 2) - \
+                (x - a) / self.tau ** 2
+
+        x_a = a
+        if delta ** 2 > phi ** 2 + v:
+            x_b = math.log(delta ** 2 - phi ** 2 - v)
+        else:
+            k = 1
+            while f(a - k * self.tau) < 0:
+                k += 1
+            x_b = a - k * self.tau
+
+        f_a, f_b = f(x_a), f(x_b)
+        while abs(x_b - x_a) > GLICKO2_CONVERGENCE:
+            c = x_a + (x_a - x_b) * f_a / (f_b - f_a)
+            f_c = f(c)
+            if f_c * f_b < 0:
+                x_a, f_a = x_b, f_b
+            else:
+                f_a /= 2
+            x_b, f_b = c, f_c
+        return math.exp(x_a / 2)
+
+    def expose(self, rating):
+        # like trueskill.expose, a conservative estimate
+        mu, phi, _ = rating
+        return self.initial + GLICKO2_SCALE * (mu - 2 * phi)
+
+    def win_probability(self, rating, opponent_rating):
+        mu, phi, _ = rating
+        opponent_mu, opponent_phi, _ = opponent_rating
+        return _glicko2_e(mu, opponent_mu, _glicko2_g(math.sqrt(phi ** 2 + opponent_phi ** 2)))
+
+    def to_rating(self, rating):
+        mu, phi, _ = rating
+        return Rating(mu=self.initial + GLICKO2_SCALE * mu, sigma=GLICKO2_SCALE * phi)
+
+
+def _glicko2_g(phi):
+    return 1. / math.sqrt(1 + 3 * phi ** 2 / math.pi ** 2)
+
+
+def _glicko2_e(mu, opponent_mu, g):
+    return 1. / (1 + math.exp(-g * (mu - opponent_mu)))
+
+
+RATING_ENGINES = {engine.name: engine for engine in
+                  (TrueSkillEngine, EloEngine, Glicko2Engine)}
+
+
+def get_rating_engine(name):
+    if name not in RATING_ENGINES:
+        raise ValueError('unknown rating engine: {}'.format(name))
+    return RATING_ENGINES[name]()
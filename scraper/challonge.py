@@ -2,6 +2,7 @@ import iso8601
 import os
 import requests
 import parse
+import urlparse
 
 from config import config
 from model import AliasMatch
@@ -97,6 +98,20 @@ class ChallongeScraper(object):
                 if p['participant']['name'] else p['participant']['username'].strip()
                 for p in self.get_raw()['participants']]
 
+    @staticmethod
+    def get_tournament_id_from_url(url):
+        '''Converts a bracket url (e.g. sub.challonge.com/bracket) into the
+        tournament id the api expects (e.g. sub-bracket).'''
+        if '://' not in url:
+            url = 'http://' + url
+        parsed = urlparse.urlparse(url)
+        host = parsed.netloc.split(':')[0]
+        bracket = parsed.path.strip('/').split('/')[0]
+        subdomain = host[:-len('challonge.com')].rstrip('.')
+        if subdomain in ('', 'www'):
+            return bracket
+        return '%s-%s' % (subdomain, bracket)
+
     def _check_for_200(self, response):
         response.raise_for_status()
         return response
@@ -1,8 +1,28 @@
-from bs4 import BeautifulSoup
+from io import BytesIO
+from lxml import etree
 from model import AliasMatch
 from dateutil import parser
 
 
+def _text(element):
+    return u''.join(element.itertext())
+
+
+def _find_text(element, tag):
+    found = element.find('.//' + tag)
+    return _text(found) if found is not None else None
+
+
+def _free(element):
+    # drop the subtree (and any already-processed siblings) so memory stays
+    # flat on large multi-bracket files
+    element.clear()
+    parent = element.getparent()
+    if parent is not None:
+        while element.getprevious() is not None:
+            del parent[0]
+
+
 class TioScraper(object):
 
     def __init__(self, raw, bracket_name):
@@ -13,9 +33,11 @@ class TioScraper(object):
         self.players = None
 
         self.text = raw
-        self.soup = BeautifulSoup(self.text, 'xml')
         self.url = None  # no url for Tio
 
+        self._parsed = False
+        self._bracket_found = False
+
     @classmethod
     def from_file(cls, filepath, bracket_name):
         with open(filepath) as f:
@@ -29,31 +51,101 @@ class TioScraper(object):
         return self.url
 
     def get_name(self):
-        return self.soup.Event.Name.text
+        self._parse()
+        return self.name
 
     def get_date(self):
-        return parser.parse(self.soup.Event.StartDate.text)
-
-    def get_matches(self):
-        player_map = dict((p.ID.text, p.Nickname.text.strip())
-                          for p in self.soup.find_all('Player'))
-
-        bracket = None
-        for b in self.soup.find_all('Game'):
-            if b.Name.text == self.bracket_name:
-                bracket = b
-                break
-
-        if bracket is None:
-            raise ValueError('Bracket name %s not found!' % self.bracket_name)
-
+        self._parse()
+        return self.date
+
+    def _parse(self):
+        '''Single streaming pass over the TIO xml. Builds the player map and
+        collects the requested bracket's matches, freeing nodes as we go.'''
+        if self._parsed:
+            return
+
+        raw = self.text
+        if isinstance(raw, unicode):
+            raw = raw.encode('utf-8')
+
+        player_map = {}
+        bracket_matches = []
+
+        date_text = None
+
+        event_depth = 0
+        events_seen = 0
+        game_depth = 0
+        game_name = None
+        in_bracket = False
+        player_depth = 0
+
+        for event, element in etree.iterparse(BytesIO(raw),
+                                              events=('start', 'end'),
+                                              huge_tree=True):
+            tag = element.tag
+
+            if event == 'start':
+                if tag == 'Event':
+                    event_depth += 1
+                    events_seen += 1
+                elif tag == 'Game':
+                    if game_depth == 0:
+                        game_name = None
+                    game_depth += 1
+                elif tag == 'Player':
+                    player_depth += 1
+                continue
+
+            if tag == 'Name':
+                if game_depth > 0 and game_name is None:
+                    game_name = _text(element)
+                    in_bracket = (not self._bracket_found and
+                                  game_name == self.bracket_name)
+                elif event_depth > 0 and events_seen == 1 and self.name is None:
+                    self.name = _text(element)
+            elif tag == 'StartDate':
+                if event_depth > 0 and events_seen == 1 and date_text is None:
+                    date_text = _text(element)
+            elif tag == 'Event':
+                event_depth -= 1
+            elif tag == 'Match':
+                if in_bracket:
+                    bracket_matches.append((
+                        _find_text(element, 'Player1'),
+                        _find_text(element, 'Player2'),
+                        _find_text(element, 'Winner'),
+                        _find_text(element, 'IsChampionship'),
+                        _find_text(element, 'IsSecondChampionship')))
+                _free(element)
+            elif tag == 'Game':
+                game_depth -= 1
+                if game_depth == 0:
+                    if in_bracket:
+                        self._bracket_found = True
+                        in_bracket = False
+                    _free(element)
+            elif tag == 'Player':
+                player_depth -= 1
+                if player_depth == 0:
+                    # nested Player nodes are picked up (in document order)
+                    # by their outermost Player
+                    for p in element.iter('Player'):
+                        player_map[_find_text(p, 'ID')] = \
+                            _find_text(p, 'Nickname').strip()
+                    _free(element)
+
+        if date_text is not None:
+            self.date = parser.parse(date_text)
+        self.matches = self._build_matches(player_map, bracket_matches)
+        self._parsed = True
+
+    def _build_matches(self, player_map, bracket_matches):
         matches = []
         grand_finals_first_set = None
         grand_finals_second_set = None
-        for match in bracket.find_all('Match'):
-            player_1_id = match.Player1.text
-            player_2_id = match.Player2.text
-            winner_id = match.Winner.text
+        for player_1_id, player_2_id, winner_id, is_championship, \
+                is_second_championship in bracket_matches:
             loser_id = player_1_id if winner_id == player_2_id else player_2_id
 
             try:
@@ -61,9 +153,9 @@ class TioScraper(object):
                 loser = player_map[loser_id]
                 match_result = AliasMatch(winner=winner, loser=loser)
 
-                if match.IsChampionship.text == 'True':
+                if is_championship == 'True':
                     grand_finals_first_set = match_result
-                elif match.IsSecondChampionship.text == 'True':
+                elif is_second_championship == 'True':
                     grand_finals_second_set = match_result
                 else:
                     matches.append(match_result)
@@ -82,6 +174,14 @@ class TioScraper(object):
 
         return matches
 
+    def get_matches(self):
+        self._parse()
+
+        if not self._bracket_found:
+            raise ValueError('Bracket name %s not found!' % self.bracket_name)
+
+        return list(self.matches)
+
     def get_players(self):
         if not self.players:
             self.players = set()
@@ -0,0 +1,439 @@
+# benchmarks for the slow paths of the backend: ranking generation, merges,
+# alias lookups on imports and the heaviest read endpoints. a synthetic data
+# set (regions x players x tournaments x matches) is generated first, then each
+# scenario is timed a few times. results are written as json, so runs on two
+# commits can be compared with --compare.
+#
+# by default everything runs against an in-memory mongomock database, which is
+# good for spotting regressions in our own code. pass --mongo-url to run
+# against a real (scratch) mongod instead. the data set is written to the
+# configured database name, so the benchmark refuses to run against a database
+# that already has players in it, and drops it when done.
+#
+# usage:
+#   python scripts/benchmark.py --output before.json
+#   python scripts/benchmark.py --output after.json --compare before.json
+#   python scripts/benchmark.py --players 5000 --tournaments 500 --scenario generate_ranking
+#   python scripts/benchmark.py --mongo-url mongodb://localhost:27018
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+from bson.objectid import ObjectId
+from datetime import datetime, timedelta
+
+# add root directory to python path
+sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/../'))
+
+import mongomock
+from pymongo import MongoClient
+
+import alias_service
+import dao as D
+import model as M
+import rankings
+import server
+
+DEFAULT_NUM_REGIONS = 2
+DEFAULT_NUM_PLAYERS = 1000  # per region
+DEFAULT_NUM_TOURNAMENTS = 100  # per region
+DEFAULT_NUM_MATCHES = 64  # per tournament
+DEFAULT_NUM_ENTRANTS = 1000  # aliases in the alias_service scenario
+DEFAULT_REPEAT = 5
+DEFAULT_SEED = 0
+
+# a scenario whose median is this many times slower than in the baseline is
+# reported as a regression
+DEFAULT_REGRESSION_THRESHOLD = 1.2
+
+SYLLABLES = ['ka', 'zo', 'mi', 'ra', 'to', 'shi', 'ne', 'lu', 'xa', 'vo',
+             'den', 'ji', 'ro', 'ba', 'ke', 'fa', 'po', 'su', 'gri', 'ma']
+SPONSORS = ['', '', '', 'c9', 'tsm', 'liquid', 'mvg', 'eg']
+
+
+def random_name(rand):
+    name = ''.join(rand.choice(SYLLABLES) for _ in xrange(rand.randint(2, 3)))
+    sponsor = rand.choice(SPONSORS)
+    if sponsor:
+        name = sponsor + ' | ' + name
+    return name
+
+
+class BenchmarkData(object):
+    '''Ids of everything generate_data wrote, for scenarios to pick from'''
+
+    def __init__(self):
+        self.region_ids = []
+        self.player_ids = {}  # region id -> player ids
+        self.player_names = {}  # player id -> name
+        self.tournament_ids = {}  # region id -> tournament ids
+        self.opponents = {}  # player id -> ids of players they've played
+        self.tournaments_entered = {}  # player id -> ids of tournaments they entered
+
+
+def generate_data(mongo_client, num_regions=DEFAULT_NUM_REGIONS,
+                  num_players=DEFAULT_NUM_PLAYERS,
+                  num_tournaments=DEFAULT_NUM_TOURNAMENTS,
+                  num_matches=DEFAULT_NUM_MATCHES, seed=DEFAULT_SEED):
+    rand = random.Random(seed)
+    db = mongo_client[D.DATABASE_NAME]
+    data = BenchmarkData()
+    now = datetime.now()
+
+    for r in xrange(num_regions):
+        region_id = 'region{}'.format(r)
+        D.Dao.insert_region(M.Region(id=region_id, display_name='Region {}'.format(r)),
+                            mongo_client)
+        data.region_ids.append(region_id)
+
+        players = [M.Player.create_with_default_values(random_name(rand), region_id)
+                   for _ in xrange(num_players)]
+        D.Dao(region_id, mongo_client).insert_players(players)
+        player_ids = [p.id for p in players]
+        data.player_ids[region_id] = player_ids
+        data.player_names.update((p.id, p.name) for p in players)
+
+        tournaments = []
+        for t in xrange(num_tournaments):
+            # a bracket has roughly as many entrants as it has matches
+            entrants = rand.sample(player_ids, min(len(player_ids), max(2, num_matches)))
+            matches = []
+            for match_id in xrange(num_matches):
+                winner, loser = rand.sample(entrants, 2)
+                matches.append(M.Match(match_id=match_id, winner=winner, loser=loser))
+                data.opponents.setdefault(winner, set()).add(loser)
+                data.opponents.setdefault(loser, set()).add(winner)
+            tournament = M.Tournament(
+                id=ObjectId(),
+                name='{} weekly #{}'.format(region_id, t),
+                type='tio',
+                date=now - timedelta(days=rand.randint(0, 365)),
+                regions=[region_id],
+                matches=matches,
+                players=list({p for m in matches for p in (m.winner, m.loser)}))
+            for player_id in tournament.players:
+                data.tournaments_entered.setdefault(player_id, set()).add(tournament.id)
+            tournaments.append(tournament)
+        db[M.Tournament.collection_name].insert_many(
+            [t.dump(context='db') for t in tournaments])
+        data.tournament_ids[region_id] = [t.id for t in tournaments]
+
+    dao = D.Dao(None, mongo_client)
+    dao.rebuild_head_to_head()
+    dao.rebuild_player_stats()
+    return data
+
+
+class Benchmark(object):
+    '''What a scenario gets: the data set, a dao per region, a flask test
+    client, and timed(), which wraps the part of the scenario to measure'''
+
+    def __init__(self, mongo_client, data, num_entrants=DEFAULT_NUM_ENTRANTS,
+                 seed=DEFAULT_SEED):
+        self.mongo_client = mongo_client
+        self.data = data
+        self.num_entrants = num_entrants
+        self.rand = random.Random(seed)
+        self.client = server.app.test_client()
+        self.region_id = data.region_ids[0]
+        self.dao = D.Dao(self.region_id, mongo_client)
+        self.times = []
+        # players merged by the merge_players scenario
+        self.merged_player_ids = set()
+
+    def timed(self):
+        return _Timer(self.times)
+
+    def random_player_id(self):
+        return self.rand.choice(self.data.player_ids[self.region_id])
+
+    def random_tournament_id(self):
+        return self.rand.choice(self.data.tournament_ids[self.region_id])
+
+
+class _Timer(object):
+
+    def __init__(self, times):
+        self.times = times
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *args):
+        self.times.append(time.time() - self.start)
+
+
+# scenarios. each one is run --repeat times, and must time exactly one block
+# with bench.timed() per run (anything outside of it is setup).
+
+def bench_generate_ranking(bench):
+    with bench.timed():
+        rankings.generate_ranking(bench.dao)
+
+
+def bench_simulate_rankings(bench):
+    # a handful of criteria sets an admin might compare, sharing one replay
+    criteria_sets = [{'ranking_activity_day_limit': day_limit,
+                      'ranking_num_tourneys_attended': num_tourneys,
+                      'tournament_qualified_day_limit': 999}
+                     for day_limit in (30, 60, 90) for num_tourneys in (1, 2)]
+    with bench.timed():
+        rankings.simulate_rankings(bench.dao, criteria_sets)
+
+
+def bench_merge_players(bench):
+    # merged players can't be merged again, and players who have been in the
+    # same tournament can't be merged, so every run needs a fresh pair
+    merged = bench.merged_player_ids
+    entered = bench.data.tournaments_entered
+    while True:
+        source, target = bench.rand.sample(bench.data.player_ids[bench.region_id], 2)
+        if source not in merged and target not in merged and \
+                not entered.get(source, set()) & entered.get(target, set()):
+            break
+    merged.update([source, target])
+
+    merge = M.Merge(id=ObjectId(),
+                    requester_user_id='benchmark',
+                    source_player_obj_id=source,
+                    target_player_obj_id=target,
+                    time=datetime.now())
+    with bench.timed():
+        bench.dao.merge_players(merge)
+
+
+def bench_alias_service_batch(bench):
+    # a big bracket: mostly known players, some with their name in a different
+    # case/spacing, and some new players
+    known = bench.data.player_ids[bench.region_id]
+    aliases = set()
+    while len(aliases) < bench.num_entrants:
+        roll = bench.rand.random()
+        name = bench.data.player_names[bench.rand.choice(known)]
+        if roll < 0.6:
+            aliases.add(name)
+        elif roll < 0.8:
+            aliases.add(name.upper().replace(' ', ''))
+        else:
+            aliases.add(random_name(bench.rand) + str(bench.rand.randint(0, 99)))
+    aliases = list(aliases)
+
+    with bench.timed():
+        alias_service.get_alias_to_id_map_in_list_format(bench.dao, aliases)
+
+
+def bench_player_typeahead(bench):
+    name = bench.data.player_names[bench.random_player_id()].split(' | ')[-1]
+    with bench.timed():
+        rv = bench.client.get('/{}/players?query={}'.format(bench.region_id, name[:3]))
+    assert rv.status_code == 200, rv.data
+
+
+def bench_all_players(bench):
+    with bench.timed():
+        rv = bench.client.get('/{}/players?all=true'.format(bench.region_id))
+        # streamed, so reading the body is part of the request
+        rv.data
+    assert rv.status_code == 200, rv.data
+
+
+def bench_tournament_list(bench):
+    with bench.timed():
+        rv = bench.client.get('/{}/tournaments'.format(bench.region_id))
+        rv.data
+    assert rv.status_code == 200, rv.data
+
+
+def bench_tournament_page(bench):
+    # what the webapp asks for first
+    with bench.timed():
+        rv = bench.client.get('/{}/tournaments?order=newest&limit=100'.format(bench.region_id))
+    assert rv.status_code == 200, rv.data
+
+
+def bench_matches(bench):
+    # players in a tournament always have matches
+    player_id = bench.random_player_id()
+    while player_id not in bench.data.opponents:
+        player_id = bench.random_player_id()
+    with bench.timed():
+        rv = bench.client.get('/{}/matches/{}'.format(bench.region_id, player_id))
+    assert rv.status_code == 200, rv.data
+
+
+def bench_head_to_head(bench):
+    player_id = bench.random_player_id()
+    while player_id not in bench.data.opponents:
+        player_id = bench.random_player_id()
+    opponent_id = bench.rand.choice(list(bench.data.opponents[player_id]))
+    with bench.timed():
+        rv = bench.client.get('/{}/headtohead/{}?opponent={}'.format(
+            bench.region_id, player_id, opponent_id))
+    assert rv.status_code == 200, rv.data
+
+
+def bench_player_stats(bench):
+    with bench.timed():
+        rv = bench.client.get('/{}/players/{}/stats'.format(bench.region_id,
+                                                            bench.random_player_id()))
+    assert rv.status_code == 200, rv.data
+
+
+def bench_convert_tournament_to_response(bench):
+    tournament = bench.dao.get_tournament_by_id(bench.random_tournament_id())
+    with bench.timed():
+        server.convert_tournament_to_response(tournament, bench.dao)
+
+
+SCENARIOS = [('generate_ranking', bench_generate_ranking),
+             ('simulate_rankings', bench_simulate_rankings),
+             ('merge_players', bench_merge_players),
+             ('alias_service_batch', bench_alias_service_batch),
+             ('player_typeahead', bench_player_typeahead),
+             ('all_players', bench_all_players),
+             ('tournament_list', bench_tournament_list),
+             ('tournament_page', bench_tournament_page),
+             ('matches', bench_matches),
+             ('head_to_head', bench_head_to_head),
+             ('player_stats', bench_player_stats),
+             ('convert_tournament_to_response', bench_convert_tournament_to_response)]
+
+
+def summarize(times):
+    times = sorted(times)
+    n = len(times)
+    median = times[n // 2] if n % 2 else (times[n // 2 - 1] + times[n // 2]) / 2
+    ms = lambda seconds: round(seconds * 1000, 2)
+    return {'runs': n,
+            'min_ms': ms(times[0]),
+            'median_ms': ms(median),
+            'mean_ms': ms(sum(times) / n),
+            'max_ms': ms(times[-1])}
+
+
+def run_scenarios(bench, names, repeat=DEFAULT_REPEAT):
+    results = {}
+    scenarios = dict(SCENARIOS)
+    for name in names:
+        bench.times = []
+        # the code under test prints a lot, keep it out of the timings
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            for _ in xrange(repeat):
+                scenarios[name](bench)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        results[name] = summarize(bench.times)
+        print '{:<35}{:>12.2f} ms'.format(name, results[name]['median_ms'])
+    return results
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold=DEFAULT_REGRESSION_THRESHOLD):
+    '''Prints the change in median time of every scenario against baseline.
+    Returns the names of the scenarios that regressed.'''
+    regressions = []
+    print
+    print 'compared to {} ({})'.format(baseline.get('commit'), baseline.get('date'))
+    print '{:<35}{:>12}{:>12}{:>10}'.format('scenario', 'before ms', 'after ms', 'ratio')
+    for name, result in sorted(results.iteritems()):
+        before = baseline['results'].get(name)
+        if before is None or not before['median_ms']:
+            print '{:<35}{:>12}{:>12.2f}{:>10}'.format(name, '-', result['median_ms'], '-')
+            continue
+        ratio = result['median_ms'] / before['median_ms']
+        flag = ''
+        if ratio > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print '{:<35}{:>12.2f}{:>12.2f}{:>10.2f}{}'.format(
+            name, before['median_ms'], result['median_ms'], ratio, flag)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--regions', type=int, default=DEFAULT_NUM_REGIONS)
+    parser.add_argument('--players', type=int, default=DEFAULT_NUM_PLAYERS,
+                        help='players per region')
+    parser.add_argument('--tournaments', type=int, default=DEFAULT_NUM_TOURNAMENTS,
+                        help='tournaments per region')
+    parser.add_argument('--matches', type=int, default=DEFAULT_NUM_MATCHES,
+                        help='matches per tournament')
+    parser.add_argument('--entrants', type=int, default=DEFAULT_NUM_ENTRANTS,
+                        help='aliases looked up in the alias_service scenario')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--scenario', action='append', dest='scenarios',
+                        choices=[name for name, _ in SCENARIOS],
+                        help='scenario to run (can be repeated, defaults to all)')
+    parser.add_argument('--mongo-url', help='run against this (scratch) mongod instead of mongomock')
+    parser.add_argument('--output', help='write the results to this json file')
+    parser.add_argument('--compare', help='json results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_REGRESSION_THRESHOLD,
+                        help='slowdown ratio reported as a regression')
+    args = parser.parse_args()
+
+    if args.mongo_url:
+        mongo_client = MongoClient(host=args.mongo_url)
+        if mongo_client[D.DATABASE_NAME][M.Player.collection_name].find_one() is not None:
+            print 'Database {} already has players in it, refusing to benchmark against it'.format(
+                D.DATABASE_NAME)
+            sys.exit(1)
+    else:
+        mongo_client = mongomock.MongoClient()
+    server.mongo_client = mongo_client
+
+    params = {'regions': args.regions,
+              'players': args.players,
+              'tournaments': args.tournaments,
+              'matches': args.matches,
+              'entrants': args.entrants,
+              'repeat': args.repeat,
+              'seed': args.seed,
+              'db': 'mongo' if args.mongo_url else 'mongomock'}
+
+    try:
+        start = time.time()
+        data = generate_data(mongo_client, num_regions=args.regions,
+                             num_players=args.players, num_tournaments=args.tournaments,
+                             num_matches=args.matches, seed=args.seed)
+        print 'generated data in {:.1f}s'.format(time.time() - start)
+
+        bench = Benchmark(mongo_client, data, num_entrants=args.entrants, seed=args.seed)
+        results = run_scenarios(bench, args.scenarios or [name for name, _ in SCENARIOS],
+                                repeat=args.repeat)
+    finally:
+        mongo_client.drop_database(D.DATABASE_NAME)
+
+    output = {'commit': get_git_commit(),
+              'date': datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+              'params': params,
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('params') != params:
+            print 'warning: baseline was run with different parameters: {}'.format(
+                baseline.get('params'))
+        if compare(results, baseline, threshold=args.threshold):
+            sys.exit(1)
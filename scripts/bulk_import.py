@@ -0,0 +1,88 @@
+# script to import a batch of brackets into a region as pending tournaments
+# usage:
+#   python scripts/bulk_import.py norcal --type tio --bracket Singles a.tio b.tio
+#   python scripts/bulk_import.py norcal --type challonge --list urls.txt
+
+import argparse
+import json
+import os
+import sys
+
+from pymongo import MongoClient
+
+# add root directory to python path
+sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/../'))
+
+from config.config import Config
+from dao import Dao
+import import_service
+
+
+def read_sources(sources, list_path):
+    sources = list(sources)
+    if list_path:
+        with open(list_path) as f:
+            sources.extend([line.strip() for line in f if line.strip()])
+    return sources
+
+
+def build_items(type, sources, bracket=None):
+    items = []
+    for source in sources:
+        item = {'type': type, 'source': source, 'bracket': bracket}
+        if type == 'tio':
+            with open(source) as f:
+                item['data'] = f.read()
+        else:
+            item['data'] = source
+        items.append(item)
+    return items
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('region', help='region to import into')
+    parser.add_argument('sources', nargs='*',
+                        help='tio files, or challonge/smash.gg bracket urls')
+    parser.add_argument('--type', required=True,
+                        choices=['tio', 'challonge', 'smashgg'])
+    parser.add_argument('--bracket', help='bracket name (tio only)')
+    parser.add_argument('--list', help='file with one source per line')
+    parser.add_argument('--workers', type=int,
+                        default=import_service.DEFAULT_NUM_WORKERS)
+    parser.add_argument('--json', help='print the report as json',
+                        action='store_true')
+    args = parser.parse_args()
+
+    if args.type == 'tio' and not args.bracket:
+        print 'tio imports need a --bracket name'
+        sys.exit(1)
+
+    sources = read_sources(args.sources, args.list)
+    if not sources:
+        print 'nothing to import'
+        sys.exit(1)
+
+    config = Config()
+    mongo_client = MongoClient(host=config.get_mongo_url())
+    dao = Dao(args.region, mongo_client)
+    if not dao:
+        print 'invalid region:', args.region
+        sys.exit(1)
+
+    report = import_service.import_tournaments(
+        dao, build_items(args.type, sources, bracket=args.bracket),
+        num_workers=args.workers)
+
+    if args.json:
+        print json.dumps(report, indent=2)
+    else:
+        for r in report:
+            if r['status'] == import_service.STATUS_SUCCESS:
+                print '[OK]', r['source'], '->', r['id'], r['name']
+            else:
+                print '[ERROR]', r['source'], r['error']
+
+    num_ok = len([r for r in report
+                  if r['status'] == import_service.STATUS_SUCCESS])
+    print '%d of %d tournaments imported' % (num_ok, len(report))
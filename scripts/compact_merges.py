@@ -0,0 +1,35 @@
+# rewrites the tournaments that still have the ids of merged players (merges
+# don't touch the tournaments, reads resolve the merged ids) with the ids of
+# the players they were merged into. optional: it only saves reads the work of
+# resolving them. meant to be run in the background, e.g. nightly; don't run
+# it while merges are being undone.
+#
+# usage:
+#   python scripts/compact_merges.py
+#   python scripts/compact_merges.py --mongo-url mongodb://localhost:27018
+
+import argparse
+import os
+import sys
+
+from pymongo import MongoClient
+
+# add root directory to python path
+sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/../'))
+
+from config.config import Config
+from dao import Dao
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mongo-url', help='use this mongod instead of the configured one')
+    args = parser.parse_args()
+
+    config = Config()
+    mongo_client = MongoClient(host=args.mongo_url or config.get_mongo_url())
+
+    # tournaments don't depend on the region
+    dao = Dao(None, mongo_client, database_name=config.get_db_name())
+
+    print 'compacted {} tournaments'.format(dao.compact_merges())
@@ -0,0 +1,116 @@
+# compares the rating engines on a region's history. tournaments are replayed
+# oldest first, one rating period each. before each tournament is rated, every
+# engine predicts the winner of its matches (between players who have been
+# rated before) from the ratings so far, so each engine is scored on matches it
+# hasn't seen yet. we report how often the favorite won, the log loss and
+# brier score of the predicted win probabilities, and how long rating took.
+#
+# usage:
+#   python scripts/compare_rating_engines.py norcal
+#   python scripts/compare_rating_engines.py norcal --engine trueskill --engine glicko2
+#   python scripts/compare_rating_engines.py norcal --mongo-url mongodb://localhost:27018
+
+import argparse
+import math
+import os
+import sys
+import time
+
+from pymongo import MongoClient
+
+# add root directory to python path
+sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/../'))
+
+from config.config import Config
+from dao import Dao
+import model as M
+import rating_calculators
+
+# predicted probabilities are clamped to this, so one confident miss doesn't
+# make the log loss infinite
+MIN_PROBABILITY = 1e-6
+
+
+class EngineScore(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.predicted = 0
+        self.correct = 0.
+        self.log_loss = 0.
+        self.brier = 0.
+        self.seconds = 0.
+
+    def add(self, probability):
+        '''probability is what the engine gave the player who won'''
+        self.predicted += 1
+        if probability > .5:
+            self.correct += 1
+        elif probability == .5:
+            self.correct += .5
+        self.log_loss -= math.log(max(probability, MIN_PROBABILITY))
+        self.brier += (1 - probability) ** 2
+
+
+def load_periods(dao):
+    '''Returns a list of rating periods (lists of (winner id, loser id)), one
+    per tournament in the region, oldest first. Skips the same tournaments,
+    matches and out of region players as the rankings.'''
+    region_players = {p.id for p in dao.get_all_players(include_merged=True)}
+    periods = []
+    for tournament in dao.get_all_tournaments(regions=[dao.region_id]):
+        if tournament.excluded is True:
+            continue
+        periods.append([(match.winner, match.loser) for match in tournament.matches
+                        if match.excluded is not True and
+                        match.winner in region_players and match.loser in region_players])
+    return periods
+
+
+def score_engine(engine, periods):
+    score = EngineScore(engine.name)
+    ratings = {}
+    for matches in periods:
+        for winner, loser in matches:
+            if winner in ratings and loser in ratings:
+                score.add(engine.win_probability(ratings[winner], ratings[loser]))
+
+        start = time.time()
+        for winner, loser in matches:
+            for player_id in (winner, loser):
+                if player_id not in ratings:
+                    ratings[player_id] = engine.initial_rating()
+        engine.rate_period(ratings, matches)
+        score.seconds += time.time() - start
+    return score
+
+
+def print_scores(scores):
+    print '{:<12}{:>10}{:>10}{:>10}{:>10}{:>10}'.format(
+        'engine', 'matches', 'accuracy', 'log loss', 'brier', 'seconds')
+    for score in scores:
+        n = max(score.predicted, 1)
+        print '{:<12}{:>10}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.2f}'.format(
+            score.name, score.predicted, score.correct / n, score.log_loss / n,
+            score.brier / n, score.seconds)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('region')
+    parser.add_argument('--engine', action='append', dest='engines',
+                        choices=M.RATING_ENGINE_CHOICES,
+                        help='engine to compare (can be repeated, defaults to all)')
+    parser.add_argument('--mongo-url', help='read from this mongod instead of the configured one')
+    args = parser.parse_args()
+
+    config = Config()
+    mongo_client = MongoClient(host=args.mongo_url or config.get_mongo_url())
+    dao = Dao(args.region, mongo_client, database_name=config.get_db_name())
+
+    periods = load_periods(dao)
+    print 'replaying {} tournaments ({} matches)'.format(
+        len(periods), sum(len(matches) for matches in periods))
+
+    print_scores([score_engine(rating_calculators.get_rating_engine(name), periods)
+                  for name in args.engines or M.RATING_ENGINE_CHOICES])
@@ -0,0 +1,116 @@
+# load test for comparing api serving modes (see serve_api.py). hammers a set
+# of read endpoints on every target with the same number of concurrent clients
+# and reports throughput and latency side by side.
+# usage:
+#   python scripts/loadtest.py twisted=https://localhost:3000 uwsgi=https://localhost:3001
+#   python scripts/loadtest.py twisted=https://localhost:3000 --concurrency 32 --duration 60 --json
+
+import argparse
+import json
+import threading
+import time
+
+import requests
+
+DEFAULT_PATHS = ['/regions',
+                 '/norcal/players',
+                 '/norcal/rankings',
+                 '/norcal/tournaments']
+
+DEFAULT_CONCURRENCY = 16
+DEFAULT_DURATION = 30
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_client(base_url, paths, deadline, latencies, errors, lock, verify):
+    session = requests.Session()
+    i = 0
+    while time.time() < deadline:
+        path = paths[i % len(paths)]
+        i += 1
+        start = time.time()
+        try:
+            ok = session.get(base_url + path, verify=verify).status_code == 200
+        except requests.exceptions.RequestException:
+            ok = False
+        elapsed = time.time() - start
+        with lock:
+            if ok:
+                latencies.append(elapsed)
+            else:
+                errors[0] += 1
+
+
+def load_test(base_url, paths=DEFAULT_PATHS, concurrency=DEFAULT_CONCURRENCY,
+              duration=DEFAULT_DURATION, verify=False):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    start = time.time()
+    deadline = start + duration
+    threads = [threading.Thread(target=run_client,
+                                args=(base_url, paths, deadline, latencies, errors, lock, verify))
+               for _ in xrange(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    latencies.sort()
+    ms = lambda seconds: round(seconds * 1000, 1) if seconds is not None else None
+    return {'url': base_url,
+            'requests': len(latencies),
+            'errors': errors[0],
+            'requests_per_second': round(len(latencies) / elapsed, 1),
+            'mean_ms': ms(sum(latencies) / len(latencies)) if latencies else None,
+            'p50_ms': ms(percentile(latencies, 50)),
+            'p90_ms': ms(percentile(latencies, 90)),
+            'p99_ms': ms(percentile(latencies, 99))}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('targets', nargs='+',
+                        help='name=base url of a running api, e.g. uwsgi=https://localhost:3000')
+    parser.add_argument('--path', action='append', dest='paths',
+                        help='endpoint to request (can be repeated)')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument('--duration', type=int, default=DEFAULT_DURATION,
+                        help='seconds to run against each target')
+    parser.add_argument('--verify-ssl', action='store_true')
+    parser.add_argument('--json', help='print the results as json',
+                        action='store_true')
+    args = parser.parse_args()
+
+    if not args.verify_ssl:
+        requests.packages.urllib3.disable_warnings()
+
+    results = {}
+    for target in args.targets:
+        name, _, url = target.partition('=')
+        if not url:
+            # no name given, label it with the url
+            name = url = target
+        # targets are tested one after the other so they don't compete
+        results[name] = load_test(url.rstrip('/'),
+                                  paths=args.paths or DEFAULT_PATHS,
+                                  concurrency=args.concurrency,
+                                  duration=args.duration,
+                                  verify=args.verify_ssl)
+
+    if args.json:
+        print json.dumps(results, indent=2)
+    else:
+        columns = ['requests', 'errors', 'requests_per_second',
+                   'mean_ms', 'p50_ms', 'p90_ms', 'p99_ms']
+        print '{:<20}'.format('mode') + ''.join('{:>20}'.format(c) for c in columns)
+        for name, result in results.iteritems():
+            print '{:<20}'.format(name) + ''.join('{:>20}'.format(result[c]) for c in columns)
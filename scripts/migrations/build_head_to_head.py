@@ -0,0 +1,31 @@
+# builds the head_to_head collection from the tournaments. the dao keeps it up
+# to date after that, but this can be rerun at any time to rebuild it.
+import os
+import sys
+
+from pymongo import MongoClient
+
+# add root directory to python path
+sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/../../'))
+
+from config.config import Config
+from dao import Dao
+import model as M
+
+config = Config()
+mongo_client = MongoClient(host=config.get_mongo_url())
+
+DATABASE_NAME = config.get_db_name()
+
+# head to head records used to be kept per pair of players, not per region
+head_to_head_col = mongo_client[DATABASE_NAME][M.HeadToHead.collection_name]
+if 'player_1_opponent_1' in head_to_head_col.index_information():
+    head_to_head_col.drop_index('player_1_opponent_1')
+head_to_head_col.delete_many({})
+
+Dao.ensure_indexes(mongo_client, database_name=DATABASE_NAME)
+
+# rebuilds the records of every region
+dao = Dao(None, mongo_client, database_name=DATABASE_NAME)
+
+print 'built {} head to head records'.format(dao.rebuild_head_to_head())
@@ -0,0 +1,24 @@
+# builds the player_stats collection: records and attendance from the
+# tournaments, rating history from past rankings. best wins are filled in by
+# the next ranking run. the dao keeps the stats up to date after that, but
+# this can be rerun at any time to rebuild them.
+import os
+import sys
+
+from pymongo import MongoClient
+
+# add root directory to python path
+sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/../../'))
+
+from config.config import Config
+from dao import Dao
+
+config = Config()
+mongo_client = MongoClient(host=config.get_mongo_url())
+
+DATABASE_NAME = config.get_db_name()
+
+# player stats don't depend on the region
+dao = Dao(None, mongo_client, database_name=DATABASE_NAME)
+
+print 'built stats for {} players'.format(dao.rebuild_player_stats())
@@ -0,0 +1,45 @@
+# moves raw files stored inline in the raw_files collection into compressed
+# chunks, converting the data to json along the way (old raw files hold the
+# python repr of what the scraper returned)
+import ast
+import json
+import os
+import sys
+
+from pymongo import MongoClient
+
+# add root directory to python path
+sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/../../'))
+
+from config.config import Config
+from dao import Dao
+import model as M
+
+
+def to_json(data):
+    try:
+        return json.dumps(ast.literal_eval(data))
+    except (ValueError, SyntaxError):
+        # tio files were stored as the xml itself
+        return json.dumps(data)
+
+
+config = Config()
+mongo_client = MongoClient(host=config.get_mongo_url())
+
+DATABASE_NAME = config.get_db_name()
+
+Dao.ensure_indexes(mongo_client, database_name=DATABASE_NAME)
+
+# update_raw_file doesn't depend on the region
+dao = Dao(None, mongo_client, database_name=DATABASE_NAME)
+raw_files_col = mongo_client[DATABASE_NAME][M.RawFile.collection_name]
+
+count = 0
+for rf in raw_files_col.find({'compression': None}):
+    raw_file = M.RawFile.load(rf, context='db')
+    raw_file.data = to_json(raw_file.data or '')
+    dao.update_raw_file(raw_file)
+    count += 1
+
+print 'compressed {} raw files'.format(count)
@@ -0,0 +1,37 @@
+# rewrites every stored ranking in the delta encoding (a full ranking every
+# RANKING_KEYFRAME_INTERVAL rankings, and only what changed in between).
+# rankings from before the delta encoding are read as full rankings, so this
+# is safe to rerun.
+import os
+import sys
+
+import pymongo
+from pymongo import MongoClient
+
+# add root directory to python path
+sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/../../'))
+
+from config.config import Config
+from dao import Dao, decode_rankings, encode_ranking
+
+config = Config()
+mongo_client = MongoClient(host=config.get_mongo_url())
+
+DATABASE_NAME = config.get_db_name()
+
+dao = Dao(None, mongo_client, database_name=DATABASE_NAME)
+
+for region_id in dao.rankings_col.distinct('region'):
+    # read everything up front, we rewrite the documents as we go
+    docs = list(dao.rankings_col.find({'region': region_id}).sort(
+        [('time', pymongo.ASCENDING), ('depth', pymongo.ASCENDING)]))
+
+    previous, previous_doc = None, None
+    num_rankings = 0
+    for ranking in decode_rankings(docs):
+        doc = encode_ranking(ranking, previous=previous, previous_doc=previous_doc)
+        dao.rankings_col.replace_one({'_id': ranking.id}, doc)
+        previous, previous_doc = ranking, doc
+        num_rankings += 1
+
+    print 'encoded {} rankings in {}'.format(num_rankings, region_id)
@@ -0,0 +1,27 @@
+# sessions used to store the session id itself, and never expired. this
+# replaces the ids with their hashes and gives the sessions a last_seen, so
+# the TTL index expires them. safe to rerun.
+import os
+import sys
+
+from pymongo import MongoClient
+
+# add root directory to python path
+sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/../../'))
+
+from config.config import Config
+from dao import Dao
+
+config = Config()
+mongo_client = MongoClient(host=config.get_mongo_url())
+
+DATABASE_NAME = config.get_db_name()
+
+# sessions don't depend on the region
+dao = Dao(None, mongo_client, database_name=DATABASE_NAME)
+
+# ensure_indexes does this too, before building the unique index on
+# token_hash
+print 'hashed {} sessions'.format(dao.hash_session_ids())
+
+Dao.ensure_indexes(mongo_client, database_name=DATABASE_NAME)
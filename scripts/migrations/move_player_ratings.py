@@ -0,0 +1,24 @@
+# moves the ratings stored on players (from before the ratings collection)
+# into the ratings collection, and drops them from the players. safe to rerun.
+import os
+import sys
+
+from pymongo import MongoClient
+
+# add root directory to python path
+sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/../../'))
+
+from config.config import Config
+from dao import Dao
+
+config = Config()
+mongo_client = MongoClient(host=config.get_mongo_url())
+
+DATABASE_NAME = config.get_db_name()
+
+Dao.ensure_indexes(mongo_client, database_name=DATABASE_NAME)
+
+# players don't depend on the region
+dao = Dao(None, mongo_client, database_name=DATABASE_NAME)
+
+print 'moved the ratings of {} players'.format(dao.move_player_ratings())
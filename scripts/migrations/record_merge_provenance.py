@@ -0,0 +1,25 @@
+# merges now record the tournaments they rewrote, so undoing them only has to
+# touch those. this records them for merges from before, which rewrote every
+# tournament source played in. safe to rerun.
+import os
+import sys
+
+from pymongo import MongoClient
+
+# add root directory to python path
+sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/../../'))
+
+from config.config import Config
+from dao import Dao
+
+config = Config()
+mongo_client = MongoClient(host=config.get_mongo_url())
+
+DATABASE_NAME = config.get_db_name()
+
+Dao.ensure_indexes(mongo_client, database_name=DATABASE_NAME)
+
+# merges don't depend on the region
+dao = Dao(None, mongo_client, database_name=DATABASE_NAME)
+
+print 'recorded the tournaments of {} merges'.format(dao.record_merge_provenance())
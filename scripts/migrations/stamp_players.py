@@ -0,0 +1,24 @@
+# gives every player from before change stamps one, so clients that sync
+# players with /<region>/players/changes see them change. safe to rerun.
+import os
+import sys
+
+from pymongo import MongoClient
+
+# add root directory to python path
+sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/../../'))
+
+from config.config import Config
+from dao import Dao
+
+config = Config()
+mongo_client = MongoClient(host=config.get_mongo_url())
+
+DATABASE_NAME = config.get_db_name()
+
+Dao.ensure_indexes(mongo_client, database_name=DATABASE_NAME)
+
+# players don't depend on the region
+dao = Dao(None, mongo_client, database_name=DATABASE_NAME)
+
+print 'stamped {} players'.format(dao.stamp_players())
@@ -1,45 +1,244 @@
+import argparse
 import datetime
 import dropbox
+import json
 import os
 import sys
 import subprocess
 
+from bson.objectid import ObjectId
+from multiprocessing.pool import ThreadPool
+from pymongo import DESCENDING, MongoClient
+
 # add root directory to python path
 sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/../'))
 
 from config.config import Config
 
-# script take backup, saves in dumps directory, and uploads to dropbox
-if __name__=='__main__':
+# script to take a backup. mongodump writes a gzipped archive to stdout, which
+# we upload to dropbox (or copy to a local directory) chunk by chunk, so the
+# backup never touches scratch disk.
+#
+# usage:
+#   python scripts/take_backup.py                    full backup
+#   python scripts/take_backup.py --incremental      documents inserted since the last backup
+#   python scripts/take_backup.py --oplog            oplog entries since the last backup
+#   python scripts/take_backup.py --parallel         one archive per collection, dumped concurrently
+#   python scripts/take_backup.py --local-dir DIR    write to DIR instead of dropbox
+
+# dropbox wants upload session appends to be under 150MB
+CHUNK_SIZE = 8 * 1024 * 1024
+
+DEFAULT_NUM_WORKERS = 4
+
+# when the last backup was taken (and how far into the oplog it got), kept in
+# the backups directory
+STATE_FILE_NAME = 'last_backup.json'
+
+OPLOG_DB_NAME = 'local'
+OPLOG_COLLECTION_NAME = 'oplog.rs'
+
+
+class DropboxUploader(object):
+    '''Uploads a file to dropbox in chunks, through an upload session'''
+
+    def __init__(self, access_token, path):
+        self.client = dropbox.Dropbox(access_token)
+        self.path = path
+        self.session_id = None
+        self.offset = 0
+
+    def write(self, chunk):
+        if self.session_id is None:
+            self.session_id = self.client.files_upload_session_start(chunk).session_id
+        else:
+            self.client.files_upload_session_append_v2(
+                chunk, dropbox.files.UploadSessionCursor(self.session_id, self.offset))
+        self.offset += len(chunk)
+
+    def close(self):
+        if self.session_id is None:
+            self.session_id = self.client.files_upload_session_start('').session_id
+        self.client.files_upload_session_finish(
+            '',
+            dropbox.files.UploadSessionCursor(self.session_id, self.offset),
+            dropbox.files.CommitInfo(
+                self.path, mode=dropbox.files.WriteMode.overwrite))
+
+
+class LocalUploader(object):
+    '''Stand-in for DropboxUploader that writes to a local directory'''
+
+    def __init__(self, directory, path):
+        full_path = os.path.join(directory, path.lstrip('/'))
+        if not os.path.isdir(os.path.dirname(full_path)):
+            os.makedirs(os.path.dirname(full_path))
+        self.f = open(full_path, 'wb')
+
+    def write(self, chunk):
+        self.f.write(chunk)
+
+    def close(self):
+        self.f.close()
+
+
+def mongodump_command(config, db_name, collection=None, query=None):
+    command = ['mongodump',
+               '--archive',
+               '--gzip',
+               '-d', db_name,
+               '-u', config.get_db_user(),
+               '-p', config.get_db_password(),
+               '--authenticationDatabase', config.get_auth_db_name()]
+    if collection is not None:
+        command += ['-c', collection]
+    if query is not None:
+        command += ['-q', json.dumps(query)]
+    return command
+
+
+def stream_dump(command, uploader, chunk_size=CHUNK_SIZE):
+    '''Pipes the output of command into uploader. Returns the number of bytes
+    uploaded.'''
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    size = 0
     try:
-        config = Config()
-        
-        backups_directory = config.get_environment_backups_directory()
-        db_name = config.get_db_name()
-        db_user = config.get_db_user()
-        db_password = config.get_db_password()
-        auth_db_name = config.get_auth_db_name()
-
-        os.chdir(backups_directory)
-        subprocess.check_call(['sudo',
-                               'mongodump',
-                               '-d', db_name,
-                               '-u', db_user,
-                               '-p', db_password,
-                               '--authenticationDatabase', auth_db_name])
-        backup_name = datetime.date.today().isoformat() + '.zip'
-        subprocess.check_call(['sudo',
-                               'zip',
-                               '-r', backup_name,
-                               'dump/'])
-        subprocess.check_call(['sudo', 'rm', '-r', 'dump/'])
-
-        # upload to dropbox
-        access_token = config.get_dropbox_access_token()
-
-        client = dropbox.client.DropboxClient(access_token)
-        client.put_file(backup_name, open(backup_name, 'rb'), overwrite=True)
+        for chunk in iter(lambda: process.stdout.read(chunk_size), ''):
+            uploader.write(chunk)
+            size += len(chunk)
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command[0])
+    uploader.close()
+    return size
+
+
+def load_state(backups_directory):
+    path = os.path.join(backups_directory, STATE_FILE_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(backups_directory, state):
+    with open(os.path.join(backups_directory, STATE_FILE_NAME), 'w') as f:
+        json.dump(state, f)
+
 
+def get_latest_oplog_ts(mongo_client):
+    entry = mongo_client[OPLOG_DB_NAME][OPLOG_COLLECTION_NAME].find(
+        {}, {'ts': 1}).sort('$natural', DESCENDING).limit(1)
+    for e in entry:
+        return {'t': e['ts'].time, 'i': e['ts'].inc}
+
+
+def has_object_ids(col):
+    doc = col.find_one({}, {'_id': 1})
+    return doc is None or isinstance(doc['_id'], ObjectId)
+
+
+def plan_dumps(config, mongo_client, mode, parallel, since=None, oplog_ts=None):
+    '''Returns a list of (name, mongodump command) to run'''
+    db_name = config.get_db_name()
+
+    if mode == 'oplog':
+        query = {'ts': {'$gt': {'$timestamp': oplog_ts}}} if oplog_ts else None
+        return [('oplog', mongodump_command(
+            config, OPLOG_DB_NAME, collection=OPLOG_COLLECTION_NAME, query=query))]
+
+    if mode == 'full' and not parallel:
+        return [(db_name, mongodump_command(config, db_name))]
+
+    db = mongo_client[db_name]
+    dumps = []
+    for collection in sorted(db.collection_names(include_system_collections=False)):
+        query = None
+        # ObjectIds start with their creation time, so they tell us what was
+        # inserted since the last backup. collections keyed on something else
+        # (e.g. regions) are small, and always dumped in full.
+        if mode == 'incremental' and since is not None and has_object_ids(db[collection]):
+            query = {'_id': {'$gte': {'$oid': str(ObjectId.from_datetime(since))}}}
+        dumps.append((collection, mongodump_command(
+            config, db_name, collection=collection, query=query)))
+    return dumps
+
+
+def take_backup(config, mode='full', parallel=False, local_dir=None,
+                num_workers=DEFAULT_NUM_WORKERS):
+    backups_directory = config.get_environment_backups_directory()
+    mongo_client = MongoClient(host=config.get_mongo_url())
+    now = datetime.datetime.utcnow()
+
+    state = load_state(backups_directory)
+    since = None
+    if state.get('date'):
+        since = datetime.datetime.strptime(state['date'], '%Y-%m-%dT%H:%M:%S')
+    if mode in ('incremental', 'oplog') and not state:
+        print 'No previous backup found, backing up everything'
+
+    # grab the oplog position before dumping so nothing falls in between (on a
+    # standalone server there is no oplog, and this is None)
+    oplog_ts = get_latest_oplog_ts(mongo_client)
+
+    dumps = plan_dumps(config, mongo_client, mode, parallel,
+                       since=since, oplog_ts=state.get('oplog_ts'))
+
+    backup_name = now.date().isoformat()
+    if mode != 'full':
+        backup_name += '-' + mode
+
+    def run(dump):
+        name, command = dump
+        path = '/{}/{}.archive.gz'.format(backup_name, name) if len(dumps) > 1 \
+            else '/{}.archive.gz'.format(backup_name)
+        if local_dir is not None:
+            uploader = LocalUploader(local_dir, path)
+        else:
+            uploader = DropboxUploader(config.get_dropbox_access_token(), path)
+        size = stream_dump(command, uploader)
+        print 'uploaded {} ({} bytes)'.format(path, size)
+        return size
+
+    pool = ThreadPool(max(1, min(num_workers, len(dumps))))
+    try:
+        sizes = pool.map(run, dumps)
+    finally:
+        pool.close()
+        pool.join()
+
+    state['date'] = now.strftime('%Y-%m-%dT%H:%M:%S')
+    if oplog_ts is not None:
+        state['oplog_ts'] = oplog_ts
+    save_state(backups_directory, state)
+
+    return sum(sizes)
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    mode_group = parser.add_mutually_exclusive_group()
+    mode_group.add_argument('--incremental', action='store_true',
+                            help='only documents inserted since the last backup')
+    mode_group.add_argument('--oplog', action='store_true',
+                            help='only oplog entries since the last backup (needs a replica set)')
+    parser.add_argument('--parallel', action='store_true',
+                        help='dump each collection separately and concurrently')
+    parser.add_argument('--workers', type=int, default=DEFAULT_NUM_WORKERS)
+    parser.add_argument('--local-dir', help='write backups here instead of uploading to dropbox')
+    args = parser.parse_args()
+
+    mode = 'full'
+    if args.incremental:
+        mode = 'incremental'
+    elif args.oplog:
+        mode = 'oplog'
+
+    try:
+        take_backup(Config(), mode=mode, parallel=args.parallel,
+                    local_dir=args.local_dir, num_workers=args.workers)
     except Exception as e:
         print 'Error taking backup'
         print e
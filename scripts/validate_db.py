@@ -2,333 +2,508 @@
 #   be handled by document-wide validation)
 # this script is resource-intensive: should only be run once per day/week or
 #   when significant modifications are made to model.py
+#
+# every collection is streamed from a cursor, and the collection checks run in
+# parallel; the checks that delete documents run one at a time after them.
+# with --fix, fixes are queued up and written in bulk, and only write the
+# fields they repair.
+# --report writes a json summary (counts and timings per check).
 
 import argparse
+import json
 import os
 import sys
+import threading
+import time
 
-from pymongo import MongoClient
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+from pymongo import DeleteOne, MongoClient, UpdateOne
 
 # add root directory to python path
 sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/../'))
 
 from config.config import Config
+from dao import Dao
 
 import model as M
 
-def validate(fix=False):
-    config = Config()
-    mongo_client = MongoClient(host=config.get_mongo_url())
-    database_name = config.get_db_name()
-
-    # db collections
-    players_col = mongo_client[database_name][M.Player.collection_name]
-    tournaments_col = mongo_client[database_name][M.Tournament.collection_name]
-    rankings_col = mongo_client[database_name][M.Ranking.collection_name]
-    users_col = mongo_client[database_name][M.User.collection_name]
-    pending_tournaments_col = mongo_client[database_name][M.PendingTournament.collection_name]
-    merges_col = mongo_client[database_name][M.Merge.collection_name]
-    sessions_col = mongo_client[database_name][M.Session.collection_name]
-    raw_files_col = mongo_client[database_name][M.RawFile.collection_name]
-    regions_col = mongo_client[database_name][M.Region.collection_name]
-
-    # get sets of ids for cross-referencing
-    player_ids = set([p.get('_id') for p in players_col.find()])
-    tournament_ids = set([t.get('_id') for t in tournaments_col.find()])
-    ranking_ids = set([r.get('_id') for r in rankings_col.find()])
-    user_ids = set([u.get('_id') for u in users_col.find()])
-    pending_tournament_ids = set([pt.get('_id') for pt in pending_tournaments_col.find()])
-    merge_ids = set([m.get('_id') for m in merges_col.find()])
-    raw_file_ids = set([rf.get('_id')
-        for rf in raw_files_col.find({}, {'data': 0})])
-    region_ids = set([r.get('_id') for r in regions_col.find()])
-
-    # Player checks
-    for p in players_col.find():
+# documents fetched per round trip while streaming a collection
+CURSOR_BATCH_SIZE = 1000
+
+# fixes sent per bulk_write
+BULK_WRITE_BATCH_SIZE = 500
+
+# pymongo clients are thread safe, so threads are enough to keep the db busy
+DEFAULT_NUM_WORKERS = 4
+
+print_lock = threading.Lock()
+
+
+class Check(object):
+    '''Bookkeeping for one collection check: counts, queued fixes and timing.'''
+
+    def __init__(self, name, col, fix):
+        self.name = name
+        self.col = col
+        self.fix = fix
+        self.checked = 0
+        self.errors = 0
+        self.fixed = 0
+        self.deleted = 0
+        self.ops = []
+        self.start = time.time()
+
+    def error(self, error_header, message):
+        self.errors += 1
+        with print_lock:
+            print error_header, message
+
+    def manual_fix(self):
+        if self.fix:
+            with print_lock:
+                print '[FIX] fix manually'
+
+    def update(self, error_header, doc, fields):
+        '''Writes fields of doc (the ones the check repaired), leaving the
+        rest of the stored document as it is'''
+        with print_lock:
+            print error_header, 'fixing {}..'.format(self.name)
+        self.fixed += 1
+        self._queue(UpdateOne({'_id': doc.id}, {'$set': doc.dump(context='db', only=fields)}))
+
+    def delete(self, error_header, selector, what):
+        with print_lock:
+            print error_header, 'deleting {}...'.format(what)
+        self.deleted += 1
+        self._queue(DeleteOne(selector))
+
+    def _queue(self, op):
+        self.ops.append(op)
+        if len(self.ops) >= BULK_WRITE_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.ops:
+            self.col.bulk_write(self.ops)
+            self.ops = []
+
+    def finish(self):
+        self.flush()
+        return {'check': self.name,
+                'checked': self.checked,
+                'errors': self.errors,
+                'fixed': self.fixed,
+                'deleted': self.deleted,
+                'seconds': round(time.time() - self.start, 3)}
+
+
+def stream(col, projection=None):
+    return col.find({}, projection, batch_size=CURSOR_BATCH_SIZE)
+
+
+def get_ids(col):
+    return set(d['_id'] for d in stream(col, {'_id': 1}))
+
+
+def check_players(db, ids, fix):
+    check = Check('player', db[M.Player.collection_name], fix)
+    fixed_players = []
+    merges_fixed = False
+    for p in stream(check.col):
+        check.checked += 1
         player = M.Player.load(p, context='db')
         error_header = '[ERROR player "{}" ({})]'.format(player.id, player.name)
-        modified = False
+        fixed_fields = set()
 
         # check: player valid
         valid, validate_errors = player.validate()
         if not valid:
-            print error_header, validate_errors
+            check.error(error_header, validate_errors)
 
         # check: player regions are all valid regions
         for r in player.regions:
-            if r not in region_ids:
-                print error_header, 'invalid region {}'.format(r)
+            if r not in ids['regions']:
+                check.error(error_header, 'invalid region {}'.format(r))
         if fix:
             # fix: remove invalid regions from player regions
-            if any([r not in region_ids for r in player.regions]):
-                modified = True
-                player.regions = [r for r in player.regions if r in region_ids]
-
-
-        # check: ratings all have valid regions
-        for r in player.ratings.keys():
-            if r not in region_ids:
-                print error_header, 'invalid rating region {}'.format(r)
-                if fix:
-                    # fix: remove rating from player
-                    del player.ratings[r]
-                    modified = True
+            if any([r not in ids['regions'] for r in player.regions]):
+                fixed_fields.add('regions')
+                player.regions = [r for r in player.regions if r in ids['regions']]
 
         # check: merge_parent is real player if exists
         if player.merge_parent is not None:
-            if player.merge_parent not in player_ids:
-                print error_header, 'invalid merge_parent {}'.format(player.merge_parent)
+            if player.merge_parent not in ids['players']:
+                check.error(error_header, 'invalid merge_parent {}'.format(player.merge_parent))
                 if fix:
                     # fix: set merge_parent to None, unset merged
                     player.merge_parent = None
                     player.merged = False
+                    fixed_fields.update(['merge_parent', 'merged'])
 
         # check: merge_children are real players
         for mc in player.merge_children:
-            if mc not in player_ids:
-                print error_header, 'invalid merge_child {}'.format(mc)
+            if mc not in ids['players']:
+                check.error(error_header, 'invalid merge_child {}'.format(mc))
         if fix:
             # fix: remove child from merge_children
-            if any([mc not in player_ids for mc in player.merge_children]):
-                modified = True
-                player.merge_children = [mc for mc in player.merge_children if mc in player_ids]
+            if any([mc not in ids['players'] for mc in player.merge_children]):
+                fixed_fields.add('merge_children')
+                player.merge_children = [mc for mc in player.merge_children if mc in ids['players']]
+
+        if fix and fixed_fields:
+            check.update(error_header, player, fixed_fields)
+            fixed_players.append(player.id)
+            if 'merge_parent' in fixed_fields:
+                merges_fixed = True
+
+    result = check.finish()
 
-        if fix and modified:
-            print error_header, 'fixing player..'
-            players_col.update({'_id': player.id}, player.dump(context='db'))
+    # give the fixed players new change stamps, so clients pick them up
+    if fixed_players:
+        dao = Dao(None, db.client, database_name=db.name)
+        dao.restamp_players(fixed_players)
+        if merges_fixed:
+            dao.merge_forest_changed()
 
+    return result
 
-    # Tournament checks
-    for t in tournaments_col.find():
+
+def check_tournaments(db, ids, fix):
+    check = Check('tournament', db[M.Tournament.collection_name], fix)
+    for t in stream(check.col):
+        check.checked += 1
         tournament = M.Tournament.load(t, context='db')
         error_header = '[ERROR tournament "{}" ({})]'.format(tournament.id, tournament.name)
-        modified = False
+        fixed_fields = set()
 
         # check: tournament valid
         valid, validate_errors = tournament.validate()
         if not valid:
-            print error_header, validate_errors
+            check.error(error_header, validate_errors)
             if fix:
                 # fix: set players equal to set of players in matches
-                modified = True
+                fixed_fields.update(['players', 'orig_ids'])
                 tournament.players = list({match.winner for match in tournament.matches} | \
                               {match.loser for match in tournament.matches})
                 tournament.orig_ids = list(tournament.players)
 
         # check: tournament empty
         if len(tournament.matches)==0 or len(tournament.players)==0:
-            print error_header, 'tournament empty'
+            check.error(error_header, 'tournament empty')
 
         # check: tournament regions are all valid regions
         for r in tournament.regions:
-            if r not in region_ids:
-                print error_header, 'invalid region {}'.format(r)
+            if r not in ids['regions']:
+                check.error(error_header, 'invalid region {}'.format(r))
         if fix:
             # fix: remove invalid regions
-            if any([r not in region_ids for r in tournament.regions]):
-                modified = True
-                tournament.regions = [r for r in tournament.regions if r in region_ids]
+            if any([r not in ids['regions'] for r in tournament.regions]):
+                fixed_fields.add('regions')
+                tournament.regions = [r for r in tournament.regions if r in ids['regions']]
 
         # check: raw_id maps to real raw_file if exists
         if tournament.raw_id is not None:
-            if tournament.raw_id not in raw_file_ids:
-                print error_header, 'invalid raw_file_id {}'.format(tournament.raw_id)
+            if tournament.raw_id not in ids['raw_files']:
+                check.error(error_header, 'invalid raw_file_id {}'.format(tournament.raw_id))
                 if fix:
                     # fix: set raw_id to None
-                    modified = True
+                    fixed_fields.add('raw_id')
                     tournament.raw_id = None
 
         # check: all players are valid players
         for p in tournament.players:
-            if p not in player_ids:
-                print error_header, 'invalid player {}'.format(p)
-                if fix:
-                    # fix: FIX MANUALLY
-                    print '[FIX] fix manually'
+            if p not in ids['players']:
+                check.error(error_header, 'invalid player {}'.format(p))
+                # fix: FIX MANUALLY
+                check.manual_fix()
 
         # check: all original ids are valid players
         for p in tournament.orig_ids:
-            if p not in player_ids:
-                print error_header, 'invalid orig_id {}'.format(p)
+            if p not in ids['players']:
+                check.error(error_header, 'invalid orig_id {}'.format(p))
 
         # TODO: check that orig_ids end up merging to players?
 
-        if fix and modified:
-            print error_header, 'fixing tournament..'
-            tournaments_col.update({'_id': tournament.id}, tournament.dump(context='db'))
+        if fix and fixed_fields:
+            check.update(error_header, tournament, fixed_fields)
 
+    return check.finish()
 
-    # Pending Tournament checks
-    for pt in pending_tournaments_col.find():
+
+def check_pending_tournaments(db, ids, fix):
+    check = Check('pending_tournament', db[M.PendingTournament.collection_name], fix)
+    for pt in stream(check.col):
+        check.checked += 1
         tournament = M.PendingTournament.load(pt, context='db')
         error_header = '[ERROR pending_tournament "{}" ({})]'.format(tournament.id, tournament.name)
 
         # check: pt valid
         valid, validate_errors = tournament.validate()
         if not valid:
-            print error_header, validate_errors
+            check.error(error_header, validate_errors)
 
         # check: tournament empty
         if len(tournament.matches)==0 or len(tournament.players)==0:
-            print error_header, 'tournament empty'
+            check.error(error_header, 'tournament empty')
 
         # check: tournament regions are all valid regions
         for r in tournament.regions:
-            if r not in region_ids:
-                print error_header, 'invalid region {}'.format(r)
+            if r not in ids['regions']:
+                check.error(error_header, 'invalid region {}'.format(r))
 
         # check: raw_id maps to real raw_file if exists
         if tournament.raw_id is not None:
-            if tournament.raw_id not in raw_file_ids:
-                print error_header, 'invalid raw_file_id {}'.format(tournament.raw_id)
-
-        if fix and modified:
-            print error_header, 'fixing ranking..'
-            rankings_col.update({'_id': ranking.id}, ranking.dump(context='db'))
+            if tournament.raw_id not in ids['raw_files']:
+                check.error(error_header, 'invalid raw_file_id {}'.format(tournament.raw_id))
 
+    return check.finish()
 
 
-    # Ranking checks
-    for r in rankings_col.find():
+def check_rankings(db, ids, fix):
+    check = Check('ranking', db[M.Ranking.collection_name], fix)
+    for r in stream(check.col):
+        check.checked += 1
         ranking = M.Ranking.load(r, context='db')
         error_header = '[ERROR ranking ({})]'.format(ranking.id)
-        modified = False
+        fixed_fields = set()
 
         # check: ranking valid
         valid, validate_errors = ranking.validate()
         if not valid:
-            print error_header, validate_errors
+            check.error(error_header, validate_errors)
 
         # check: ranking region is valid region
-        if ranking.region not in region_ids:
-            print error_header, 'invalid region {}'.format(ranking.region)
-            if fix:
-                # fix: FIX MANUALLY
-                print '[FIX] fix manually'
+        if ranking.region not in ids['regions']:
+            check.error(error_header, 'invalid region {}'.format(ranking.region))
+            # fix: FIX MANUALLY
+            check.manual_fix()
 
         # check: ranking tournaments are valid tournaments
         for t in ranking.tournaments:
-            if t not in tournament_ids:
-                print error_header, 'invalid tournament {}'.format(t)
+            if t not in ids['tournaments']:
+                check.error(error_header, 'invalid tournament {}'.format(t))
         if fix:
             # fix: remove invalid tournaments from ranking
-            if any([t not in tournament_ids for t in ranking.tournaments]):
-                modified = True
-                ranking.tournaments = [t for t in ranking.tournaments if t in tournament_ids]
+            if any([t not in ids['tournaments'] for t in ranking.tournaments]):
+                fixed_fields.add('tournaments')
+                ranking.tournaments = [t for t in ranking.tournaments if t in ids['tournaments']]
+
+        if fix and fixed_fields:
+            check.update(error_header, ranking, fixed_fields)
 
-        if fix and modified:
-            print error_header, 'fixing ranking..'
-            rankings_col.update({'_id': ranking.id}, ranking.dump(context='db'))
+    return check.finish()
 
 
-    # User checks
-    for u in users_col.find():
+def check_users(db, ids, fix):
+    check = Check('user', db[M.User.collection_name], fix)
+    for u in stream(check.col):
+        check.checked += 1
         user = M.User.load(u, context='db')
         error_header = '[ERROR user "{}" ({})]'.format(user.username, user.id)
-        modified = False
+        fixed_fields = set()
 
         # check: user valid
         valid, validate_errors = user.validate()
         if not valid:
-            print error_header, validate_errors
+            check.error(error_header, validate_errors)
 
         # check: admin_regions are valid regions
         for r in user.admin_regions:
-            if r not in region_ids:
-                print error_header, 'invalid region {}'.format(r)
+            if r not in ids['regions']:
+                check.error(error_header, 'invalid region {}'.format(r))
         if fix:
             # fix: remove invalid regions from admin_regions
-            if any([r not in region_ids for r in user.admin_regions]):
-                modified = True
-                user.admin_regions = [r for r in user.admin_regions if r in region_ids]
+            if any([r not in ids['regions'] for r in user.admin_regions]):
+                fixed_fields.add('admin_regions')
+                user.admin_regions = [r for r in user.admin_regions if r in ids['regions']]
 
-        if fix and modified:
-            print error_header, 'fixing user..'
-            users_col.update({'_id': user.id}, user.dump(context='db'))
+        if fix and fixed_fields:
+            check.update(error_header, user, fixed_fields)
 
-    # Session checks
-    for s in sessions_col.find():
+    return check.finish()
+
+
+def check_sessions(db, ids, fix):
+    check = Check('session', db[M.Session.collection_name], fix)
+    for s in stream(check.col):
+        check.checked += 1
         session = M.Session.load(s, context='db')
-        error_header = '[ERROR session ({})]'.format(session.session_id)
+        error_header = '[ERROR session ({})]'.format(session.token_hash)
 
         # check: session valid
         valid, validate_errors = session.validate()
         if not valid:
-            print error_header, validate_errors
+            check.error(error_header, validate_errors)
 
         # check: session user is valid user
-        if session.user_id not in user_ids:
-            print error_header, 'invalid user_id {}'.format(session.user_id)
+        if session.user_id not in ids['users']:
+            check.error(error_header, 'invalid user_id {}'.format(session.user_id))
             if fix:
                 # fix: delete session
-                print error_header, 'deleting session...'
-                sessions_col.remove({'session_id': session.session_id})
+                check.delete(error_header, {'token_hash': session.token_hash}, 'session')
+
+    return check.finish()
+
+
+def check_ratings(db, ids, fix):
+    check = Check('rating', db[M.PlayerRating.collection_name], fix)
+    for r in stream(check.col):
+        check.checked += 1
+        rating = M.PlayerRating.load(r, context='db')
+        error_header = '[ERROR rating "{}" ({})]'.format(rating.player, rating.region)
+
+        # check: rating valid
+        valid, validate_errors = rating.validate()
+        if not valid:
+            check.error(error_header, validate_errors)
 
-    # Merge checks
-    for m in merges_col.find():
+        # check: rating is of a valid player, in a valid region
+        if rating.player not in ids['players'] or rating.region not in ids['regions']:
+            check.error(error_header, 'invalid player or region')
+            if fix:
+                # fix: delete rating
+                check.delete(error_header, {'_id': r['_id']}, 'rating')
+
+    return check.finish()
+
+
+def check_merges(db, ids, fix):
+    check = Check('merge', db[M.Merge.collection_name], fix)
+    for m in stream(check.col):
+        check.checked += 1
         merge = M.Merge.load(m, context='db')
         error_header = '[ERROR merge ({})]'.format(merge.id)
-        modified = False
+        fixed_fields = set()
 
         # check: merge valid
         valid, validate_errors = merge.validate()
         if not valid:
-            print error_header, validate_errors
+            check.error(error_header, validate_errors)
 
         # check: requester is a valid user
-        if merge.requester_user_id is not None and merge.requester_user_id not in user_ids:
-            print error_header, 'invalid requester {}'.format(merge.requester_user_id)
+        if merge.requester_user_id is not None and merge.requester_user_id not in ids['users']:
+            check.error(error_header, 'invalid requester {}'.format(merge.requester_user_id))
             if fix:
                 # fix: set requester to None
                 merge.requester_user_id = None
-                modified = True
+                fixed_fields.add('requester_user_id')
 
         # check: source_player is a valid player
-        if merge.source_player_obj_id not in player_ids:
-            print error_header, 'invalid source player {}'.format(merge.source_player_obj_id)
-            if fix:
-                # fix: FIX MANUALLY
-                print '[FIX] fix manually'
+        if merge.source_player_obj_id not in ids['players']:
+            check.error(error_header, 'invalid source player {}'.format(merge.source_player_obj_id))
+            # fix: FIX MANUALLY
+            check.manual_fix()
 
         # check: target_player is a valid player
-        if merge.target_player_obj_id not in player_ids:
-            print error_header, 'invalid target player {}'.format(merge.target_player_obj_id)
-            if fix:
-                # fix: FIX MANUALLY
-                print '[FIX] fix manually'
+        if merge.target_player_obj_id not in ids['players']:
+            check.error(error_header, 'invalid target player {}'.format(merge.target_player_obj_id))
+            # fix: FIX MANUALLY
+            check.manual_fix()
 
-        if fix and modified:
-            print error_header, 'fixing merge..'
-            merges_col.update({'_id': merge.id}, merge.dump(context='db'))
+        if fix and fixed_fields:
+            check.update(error_header, merge, fixed_fields)
 
-    # Fancier checks
+    return check.finish()
 
-    # check: no player with no tournaments
-    pt_lists = {pid: [] for pid in player_ids}
-    for t in tournaments_col.find():
-        tournament = M.Tournament.load(t, context='db')
-        for player in tournament.players:
-            if player in player_ids:
-                pt_lists[player].append(tournament.id)
 
-    for p in players_col.find():
-        player = M.Player.load(p, context='db')
-        error_header = '[ERROR player "{}" ({})]'.format(player.id, player.name)
-        if len(pt_lists[player.id]) == 0 and not player.merged:
-            print error_header, 'player has no tournaments'
-            if fix:
-                print error_header, 'deleting player...'
-                players_col.remove({'_id': player.id})
+# Fancier checks
 
-    print 'db validation complete'
+def check_players_without_tournaments(db, ids, fix):
+    # check: no player with no tournaments
+    check = Check('player_tournaments', db[M.Player.collection_name], fix)
+
+    dao = Dao(None, db.client, database_name=db.name)
+
+    players_in_tournaments = set()
+    for t in stream(db[M.Tournament.collection_name], {'players': 1}):
+        players_in_tournaments.update(t.get('players', []))
+
+    # fix: delete the players (through the dao, so their ratings go too and
+    # clients see them go), a batch at a time
+    players_to_delete = []
+    for p in stream(check.col, {'name': 1, 'merged': 1}):
+        check.checked += 1
+        if p.get('merged'):
+            continue
+        # tournaments keep the ids of the players merged into p
+        if players_in_tournaments.isdisjoint(dao.get_merged_ids(p['_id'])):
+            error_header = '[ERROR player "{}" ({})]'.format(p['_id'], p.get('name'))
+            check.error(error_header, 'player has no tournaments')
+            if fix:
+                with print_lock:
+                    print error_header, 'deleting player...'
+                check.deleted += 1
+                players_to_delete.append(M.Player.load(p, context='db'))
+                if len(players_to_delete) >= BULK_WRITE_BATCH_SIZE:
+                    dao.delete_players(players_to_delete)
+                    players_to_delete = []
+    dao.delete_players(players_to_delete)
+
+    return check.finish()
+
+
+CHECKS = [check_players,
+          check_tournaments,
+          check_pending_tournaments,
+          check_rankings,
+          check_users,
+          check_merges]
+
+# checks that delete documents. they run one at a time after the rest, so
+# nothing is deleted from under another check
+DELETING_CHECKS = [check_sessions,
+                   check_ratings,
+                   check_players_without_tournaments]
+
+# collections we need the set of ids of, for cross-referencing
+ID_SETS = {'players': M.Player.collection_name,
+           'tournaments': M.Tournament.collection_name,
+           'users': M.User.collection_name,
+           'raw_files': M.RawFile.collection_name,
+           'regions': M.Region.collection_name}
+
+
+def validate(fix=False, num_workers=DEFAULT_NUM_WORKERS, report_path=None):
+    config = Config()
+    mongo_client = MongoClient(host=config.get_mongo_url())
+    db = mongo_client[config.get_db_name()]
+
+    start = time.time()
+    pool = ThreadPool(num_workers)
+    try:
+        # get sets of ids for cross-referencing
+        names = ID_SETS.keys()
+        ids = dict(zip(names, pool.map(lambda name: get_ids(db[ID_SETS[name]]), names)))
+        id_sets_seconds = round(time.time() - start, 3)
+
+        results = pool.map(lambda check: check(db, ids, fix), CHECKS)
+        results += [check(db, ids, fix) for check in DELETING_CHECKS]
+    finally:
+        pool.close()
+        pool.join()
+
+    report = {'date': datetime.utcnow().isoformat(),
+              'fix': fix,
+              'id_sets_seconds': id_sets_seconds,
+              'seconds': round(time.time() - start, 3),
+              'errors': sum(r['errors'] for r in results),
+              'checks': results}
+
+    if report_path:
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    print 'db validation complete ({} errors in {}s)'.format(report['errors'], report['seconds'])
+    return report
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--fix', help='fix errors in place',
                         action='store_true')
+    parser.add_argument('--workers', type=int, default=DEFAULT_NUM_WORKERS,
+                        help='number of checks to run at once')
+    parser.add_argument('--report', help='write a json report to this file')
     args = parser.parse_args()
 
-    if args.fix:
-        validate(fix=True)
-    else:
-        validate()
+    validate(fix=args.fix, num_workers=args.workers, report_path=args.report)
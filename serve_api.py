@@ -0,0 +1,44 @@
+# starts the api in the serving mode set in config.ini:
+#   twisted: a single process (serve_api.tac), requests run on a thread pool of
+#            [server] min_threads to max_threads threads
+#   uwsgi:   [server] processes pre-forked worker processes (wsgi.py), with
+#            [server] threads threads each
+# usage: python serve_api.py [--logfile logs/api.log]
+import argparse
+import os
+
+from config.config import Config
+
+# bytes uwsgi reads a request's headers into (the default is 4 KB). big
+# query strings, like players:batch ids, don't fit in the default
+UWSGI_BUFFER_SIZE = 32768
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--logfile', help='log to this file instead of stdout')
+    args = parser.parse_args()
+
+    config = Config()
+    mode = config.get_server_mode()
+
+    if mode == 'twisted':
+        command = ['twistd', '--nodaemon', '--pidfile=', '-oy', 'serve_api.tac']
+        if args.logfile:
+            command.insert(1, '--logfile=' + args.logfile)
+    elif mode == 'uwsgi':
+        command = ['uwsgi',
+                   '--master',
+                   '--processes', str(config.get_server_processes()),
+                   '--threads', str(config.get_server_threads()),
+                   '--https', ':{},{},{}'.format(config.get_environment_api_port(),
+                                                 config.get_ssl_cert_path(),
+                                                 config.get_ssl_key_path()),
+                   '--module', 'wsgi:app',
+                   '--buffer-size', str(UWSGI_BUFFER_SIZE),
+                   '--die-on-term']
+        if args.logfile:
+            command += ['--logto', args.logfile]
+    else:
+        raise ValueError('Unknown server mode {} (expected twisted or uwsgi)'.format(mode))
+
+    os.execvp(command[0], command)
@@ -1,5 +1,5 @@
 from bson.objectid import ObjectId
-from datetime import datetime
+from datetime import datetime, timedelta
 from flask import Flask, request, Response, jsonify
 from flask.ext import restful
 from flask.ext.restful import reqparse, abort
@@ -10,27 +10,49 @@ import re
 import sys
 
 import alias_service
+import compression
+import credentials
+import import_service
+import metrics
 import model as M
 import rankings
+import streaming
 
 from config.config import Config
-from dao import Dao
-from scraper.tio import TioScraper
-from scraper.challonge import ChallongeScraper
+from dao import ConcurrentUpdateException, Dao
 from scraper.smashgg import SmashGGScraper
 
 TYPEAHEAD_PLAYER_LIMIT = 20
+# largest page the paginated list endpoints (limit=...) will return
+MAX_PAGE_SIZE = 1000
+# most ids the batch endpoints (players:batch, tournaments:batch) resolve at once
+MAX_BATCH_SIZE = 500
 BASE_REGION = 'newjersey'
+RANKING_CRITERIA = ('ranking_activity_day_limit',
+                    'ranking_num_tourneys_attended',
+                    'tournament_qualified_day_limit')
 
 
 # parse config file
 config = Config()
 
-mongo_client = MongoClient(host=config.get_mongo_url())
+
+
+def create_mongo_client():
+    # connect lazily, so a client created before a fork (see wsgi.py) never
+    # has sockets or monitor threads to share with the workers
+    return MongoClient(host=config.get_mongo_url(), connect=False,
+                       event_listeners=[metrics.MongoCommandListener()])
+
+mongo_client = create_mongo_client()
 print "parsed config: ", config.get_mongo_url()
 
 app = Flask(__name__)
 api = restful.Api(app)
+metrics.init_app(app, server_timing=config.get_server_timing())
+compression.init_app(app)
+credentials.init_pool(num_workers=config.get_password_hash_workers(),
+                      max_pending=config.get_max_pending_password_hashes())
 
 
 def err(error_message, status_code=400):
@@ -45,6 +67,58 @@ def get_dao(region):
     return dao
 
 
+def check_page_limit(limit):
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        err('limit must be between 1 and {}'.format(MAX_PAGE_SIZE))
+
+
+def parse_batch_ids(ids):
+    '''Parses a comma separated list of ObjectIds, dropping duplicates'''
+    object_ids = []
+    for id in ids.split(','):
+        try:
+            object_id = ObjectId(id)
+        except:
+            err('Invalid ObjectID')
+        if object_id not in object_ids:
+            object_ids.append(object_id)
+
+    if len(object_ids) > MAX_BATCH_SIZE:
+        err('At most {} ids per request'.format(MAX_BATCH_SIZE))
+    return object_ids
+
+
+def parse_fields(fields, *document_classes):
+    '''Parses fields=a,b,... into the names of the fields (of any of
+    document_classes) to return, always with id. None if fields wasn't
+    given.'''
+    if fields is None:
+        return None
+
+    field_names = {field_name for document_class in document_classes
+                   for field_name, _ in document_class.fields}
+    parsed = ['id']
+    for field in fields.split(','):
+        if field not in field_names:
+            err('Unknown field: ' + field)
+        if field not in parsed:
+            parsed.append(field)
+    return tuple(parsed)
+
+
+def dump_fields(document, fields, exclude=None):
+    '''Dumps document for the web, with just fields if they're given. The
+    document was then loaded with just those fields, so we don't validate it.'''
+    if fields is None:
+        return document.dump(context='web', exclude=exclude)
+    return document.dump(context='web', only=fields, validate_on_dump=False)
+
+
+def throttled(retry_after):
+    return ({'message': 'Too many attempts, try again later'}, 429,
+            {'Retry-After': str(retry_after)})
+
+
 def auth_user(request, dao, check_regions=True, needs_super=False):
     session_id = request.cookies.get('session_id')
     user = dao.get_user_by_session_id_or_none(session_id)
@@ -136,57 +210,131 @@ class PlayerListResource(restful.Resource):
         parser = reqparse.RequestParser() \
             .add_argument('alias', type=str) \
             .add_argument('query', type=str) \
-            .add_argument('all', type=bool)
+            .add_argument('all', type=bool) \
+            .add_argument('limit', type=int) \
+            .add_argument('after', type=str) \
+            .add_argument('fields', type=str)
 
         args = parser.parse_args()
 
         return_dict = {}
         exclude_properties = ['aliases']
+        fields = parse_fields(args['fields'], M.Player)
+
+        if args['limit'] is not None and not (args['alias'] or args['query']):
+            check_page_limit(args['limit'])
+            try:
+                players, next_cursor = dao.get_players_page(
+                    args['limit'], after=args['after'], all_regions=bool(args['all']),
+                    fields=fields)
+            except ValueError:
+                err('Invalid cursor')
+            return_dict['players'] = [dump_fields(p, fields, exclude=exclude_properties)
+                                      for p in players]
+            return_dict['next'] = next_cursor
+            return return_dict
 
         # single player matching alias within region
         if args['alias']:
             return_dict['players'] = []
             db_player = dao.get_player_by_alias(args['alias'])
             if db_player:
-                return_dict['players'].append(db_player.dump(context='web',
-                                                             exclude=exclude_properties))
+                return_dict['players'].append(dump_fields(db_player, fields,
+                                                          exclude=exclude_properties))
         # search multiple players by name across all regions
         elif args['query']:
             # TODO: none checks on below list comprehensions
             all_players = dao.get_all_players(all_regions=True)
-            return_dict['players'] = [p.dump(context='web',
-                                             exclude=exclude_properties)
+            return_dict['players'] = [dump_fields(p, fields, exclude=exclude_properties)
                                       for p in self._get_players_matching_query(all_players, args['query'])]
         # get all players in all regions
         elif args['all']:
-            all_players = dao.get_all_players(all_regions=True)
-            return_dict['players'] = [p.dump(context='web',
-                                             exclude=exclude_properties)
-                                      for p in sorted(all_players, key=lambda player: player.name.lower())]
+            # read the stamp before the players, so anything written while we
+            # load them is in the client's next sync
+            change_stamp = dao.get_player_change_stamp()
+            etag = 'players-{}'.format(change_stamp)
+            headers = {'ETag': '"{}"'.format(etag), 'Cache-Control': 'no-cache'}
+            # compressed responses carry a weak version of the etag
+            if request.if_none_match.contains_weak(etag):
+                return Response(status=304, headers=headers)
+
+            return streaming.stream_json(
+                {'change_stamp': change_stamp}, 'players',
+                (dump_fields(p, fields, exclude=exclude_properties)
+                 for p in dao.iter_all_players(all_regions=True, fields=fields)),
+                headers=headers)
         # all players within region
         else:
-            return_dict['players'] = [p.dump(context='web',
-                                             exclude=exclude_properties)
-                                      for p in sorted(dao.get_all_players(),
-                                                      key=lambda player: player.name.lower())]
+            return streaming.stream_json(
+                {}, 'players',
+                (dump_fields(p, fields, exclude=exclude_properties)
+                 for p in dao.iter_all_players(fields=fields)))
 
         return return_dict
 
 
+class PlayerChangesResource(restful.Resource):
+
+    def get(self, region):
+        """ Players in every region written since the change stamp since (as
+            returned by this or by /players?all=true), and the ids of players
+            deleted or merged since. change_stamp is what to pass as since
+            next time. """
+        dao = get_dao(region)
+
+        parser = reqparse.RequestParser() \
+            .add_argument('since', type=int, required=True)
+        args = parser.parse_args()
+
+        change_stamp = dao.get_player_change_stamp()
+        players, removed_ids = dao.get_player_changes(args['since'])
+
+        return {'change_stamp': change_stamp,
+                'players': [p.dump(context='web', exclude=['aliases'])
+                            for p in players if not p.merged],
+                'removed': [str(p.id) for p in players if p.merged] +
+                           [str(player_id) for player_id in removed_ids]}
+
+
+class PlayerBatchResource(restful.Resource):
+
+    def get(self, region):
+        """ Returns the players with the given ids (ids=<id>,<id>,...), in the
+            order asked for, along with the ids of any that don't exist. """
+        dao = get_dao(region)
+
+        parser = reqparse.RequestParser() \
+            .add_argument('ids', type=str, required=True) \
+            .add_argument('fields', type=str)
+        args = parser.parse_args()
+
+        ids = parse_batch_ids(args['ids'])
+        fields = parse_fields(args['fields'], M.Player)
+        players = {p.id: p for p in dao.get_players_by_ids(ids, fields=fields)}
+
+        return {'players': [dump_fields(players[id], fields) for id in ids if id in players],
+                'not_found': [str(id) for id in ids if id not in players]}
+
+
 class PlayerResource(restful.Resource):
 
     def get(self, region, id):
         dao = get_dao(region)
 
+        parser = reqparse.RequestParser() \
+            .add_argument('fields', type=str)
+        args = parser.parse_args()
+        fields = parse_fields(args['fields'], M.Player)
+
         player = None
         try:
-            player = dao.get_player_by_id(ObjectId(id))
+            player = dao.get_player_by_id(ObjectId(id), fields=fields)
         except:
             err('Invalid ObjectID')
         if not player:
             err('Player not found')
 
-        return player.dump(context='web')
+        return dump_fields(player, fields)
 
     def put(self, region, id):
         dao = get_dao(region)
@@ -251,10 +399,9 @@ class TournamentSeedResource(restful.Resource):
 
         try:
 
-            if type == 'challonge':
-                scraper = ChallongeScraper(data)
-            else:
+            if type != 'challonge':
                 err("Unknown type")
+            scraper = import_service.get_scraper(type, data)
             pending_tournament, raw_file = M.PendingTournament.from_scraper(
                 type, scraper, region)
         except Exception as ex:
@@ -274,49 +421,80 @@ class TournamentListResource(restful.Resource):
         dao = get_dao(region)
 
         parser = reqparse.RequestParser() \
-            .add_argument('includePending', type=str, default='false')
+            .add_argument('includePending', type=str, default='false') \
+            .add_argument('limit', type=int) \
+            .add_argument('after', type=str) \
+            .add_argument('order', type=str, default='oldest', choices=('oldest', 'newest')) \
+            .add_argument('fields', type=str)
         args = parser.parse_args()
 
         if args['includePending'] == 'true':
             auth_user(request, dao)
 
-        tournaments = dao.get_all_tournaments(regions=[region])
-        only_properties = ('id',
-                           'name',
-                           'date',
-                           'regions',
-                           'excluded')
-
-        # temporary fix
-        all_tournament_jsons = []
-        for t in tournaments:
-            try:
-                all_tournament_jsons.append(t.dump(context='web',
-                                                   only=only_properties))
-
-            except:
-                print 'error inserting tournament', t
-
-        if args['includePending'] == 'true':
-            # add a pending field for all existing tournaments
-            for t in all_tournament_jsons:
-                t['pending'] = False
-
-            pending_tournaments = dao.get_all_pending_tournaments(regions=[region])
-            if pending_tournaments:
-                for p in pending_tournaments:
-                    try:
-                        p = p.dump(context='web',
-                                   only=only_properties)
-                        p['pending'] = True
-                        all_tournament_jsons.append(p)
-                    except:
-                        print 'error inserting pending tournament', p
-
-        return_dict = {}
-        return_dict['tournaments'] = all_tournament_jsons
+        include_pending = args['includePending'] == 'true'
+        only_properties = parse_fields(args['fields'], M.Tournament)
+        # tournaments loaded with fields asked for aren't validated (see
+        # dump_fields)
+        validate = only_properties is None
+        if only_properties is None:
+            only_properties = ('id',
+                               'name',
+                               'date',
+                               'regions',
+                               'excluded')
+
+        def tournament_jsons(tournaments, pending_tournaments):
+            # temporary fix
+            for t in tournaments:
+                try:
+                    t_json = t.dump(context='web', only=only_properties, validate_on_dump=validate)
+                except:
+                    print 'error inserting tournament', t
+                    continue
+                if include_pending:
+                    t_json['pending'] = False
+                yield t_json
 
-        return return_dict
+            for p in pending_tournaments:
+                try:
+                    p_json = p.dump(context='web', only=only_properties, validate_on_dump=validate)
+                except:
+                    print 'error inserting pending tournament', p
+                    continue
+                p_json['pending'] = True
+                yield p_json
+
+        if args['limit'] is None:
+            pending_tournaments = []
+            if include_pending:
+                pending_tournaments = dao.iter_pending_tournaments(
+                    regions=[region], fields=only_properties)
+            return streaming.stream_json({}, 'tournaments', tournament_jsons(
+                dao.iter_tournaments(regions=[region], fields=only_properties),
+                pending_tournaments))
+
+        # paginated. pending tournaments are few, and all come with the first
+        # page, after the tournaments (before them when newest first).
+        check_page_limit(args['limit'])
+        newest_first = args['order'] == 'newest'
+        try:
+            tournaments, next_cursor = dao.get_tournaments_page(
+                args['limit'], after=args['after'], regions=[region],
+                fields=only_properties, newest_first=newest_first)
+        except ValueError:
+            err('Invalid cursor')
+
+        pending_tournaments = []
+        if include_pending and args['after'] is None:
+            pending_tournaments = list(dao.iter_pending_tournaments(
+                regions=[region], fields=only_properties))
+
+        if newest_first:
+            tournament_list = list(tournament_jsons([], reversed(pending_tournaments)))
+            tournament_list += tournament_jsons(tournaments, [])
+        else:
+            tournament_list = list(tournament_jsons(tournaments, pending_tournaments))
+        return {'tournaments': tournament_list, 'next': next_cursor}
 
     def post(self, region):
         dao = get_dao(region)
@@ -344,19 +522,9 @@ class TournamentListResource(restful.Resource):
         pending_tournament = None
 
         try:
-            if type == 'tio':
-                if args['bracket'] is None:
-                    err("Missing bracket name")
-                data_bytes = bytes(data)
-                if data_bytes[0] == '\xef':
-                    data = data[:3]
-                scraper = TioScraper(data, args['bracket'])
-            elif type == 'challonge':
-                scraper = ChallongeScraper(data)
-            elif type == 'smashgg':
-                scraper = SmashGGScraper(data, included_phases)
-            else:
-                err("Unknown tournament type")
+            scraper = import_service.get_scraper(type, data,
+                                                 bracket=args['bracket'],
+                                                 included_phases=included_phases)
             pending_tournament, raw_file = M.PendingTournament.from_scraper(
                 type, scraper, region)
         except Exception as ex:
@@ -371,15 +539,11 @@ class TournamentListResource(restful.Resource):
         except:
             err('Alias service encountered an error')
 
-        # If the tournament is too large, don't insert the raw file into the db.
-        if len(pending_tournament.players) < 1000:
-            try:
-                raw_file = dao.insert_raw_file(raw_file)
-            except Exception as ex:
-                print ex
-                err('Dao insert_raw_file encountered an error')
-        else:
-            print 'Skipping inserting raw file for tournament because it is too large'
+        try:
+            dao.insert_raw_file(raw_file)
+        except Exception as ex:
+            print ex
+            err('Dao insert_raw_file encountered an error')
 
         try:
             new_id = dao.insert_pending_tournament(pending_tournament)
@@ -392,49 +556,123 @@ class TournamentListResource(restful.Resource):
 
         err('Unknown error!')
 
+
+class TournamentImportResource(restful.Resource):
+    """ Imports a batch of brackets as pending tournaments.
+        Route restricted to admins for this region. """
+
+    def post(self, region):
+        dao = get_dao(region)
+        auth_user(request, dao)
+
+        parser = reqparse.RequestParser() \
+            .add_argument('tournaments', type=list, location='json')
+        args = parser.parse_args()
+
+        if not args['tournaments']:
+            err("Tournament list required.")
+
+        for item in args['tournaments']:
+            if not isinstance(item, dict) or not item.get('type') or \
+                    not item.get('data'):
+                err("Each tournament must have a type and data.")
+
+        return {'results': import_service.import_tournaments(
+            dao, args['tournaments'])}
+
 # TODO: we shouldn't be doing this, instead we should pass the relevant player/
 # match information in different objects
 
 
-def convert_tournament_to_response(tournament, dao):
-    return_dict = tournament.dump(context='web', exclude=('orig_ids',))
+def get_tournament_player_ids(tournament):
+    player_ids = set(tournament.players)
+    for match in tournament.matches:
+        player_ids.update([match.winner, match.loser])
+    return player_ids
+
+
+def convert_tournament_to_response(tournament, dao, players=None, fields=None):
+    '''players maps ids to players, and must have everyone in tournament.
+    Looked up if None. With fields, only those are returned (see
+    dump_fields).'''
+    if players is None:
+        player_ids = get_tournament_player_ids(tournament)
+        players = {p.id: p for p in dao.get_players_by_ids(player_ids, fields=('name',))} \
+            if player_ids else {}
+
+    return_dict = dump_fields(tournament, fields, exclude=('orig_ids', 'version'))
+
+    if 'players' in return_dict:
+        return_dict['players'] = [{
+            'id': p,
+            'name': players[ObjectId(p)].name
+        } for p in return_dict['players']]
+
+    if 'matches' in return_dict:
+        return_dict['matches'] = [{
+            'winner_id': m['winner'],
+            'loser_id': m['loser'],
+            'winner_name': players[ObjectId(m['winner'])].name,
+            'loser_name': players[ObjectId(m['loser'])].name,
+            'match_id': m['match_id'],
+            'excluded': m['excluded']
+        } for m in return_dict['matches']]
 
-    return_dict['players'] = [{
-        'id': p,
-        'name': dao.get_player_by_id(ObjectId(p)).name
-    } for p in return_dict['players']]
+    return return_dict
 
-    return_dict['matches'] = [{
-        'winner_id': m['winner'],
-        'loser_id': m['loser'],
-        'winner_name': dao.get_player_by_id(ObjectId(m['winner'])).name,
-        'loser_name': dao.get_player_by_id(ObjectId(m['loser'])).name,
-        'match_id': m['match_id'],
-        'excluded': m['excluded']
-    } for m in return_dict['matches']]
 
-    return return_dict
+class TournamentBatchResource(restful.Resource):
+
+    def get(self, region):
+        """ Like PlayerBatchResource, for (finalized) tournaments. """
+        dao = get_dao(region)
+
+        parser = reqparse.RequestParser() \
+            .add_argument('ids', type=str, required=True) \
+            .add_argument('fields', type=str)
+        args = parser.parse_args()
+
+        ids = parse_batch_ids(args['ids'])
+        fields = parse_fields(args['fields'], M.Tournament)
+        tournaments = {t.id: t for t in dao.get_tournaments_by_ids(ids, fields=fields)}
+
+        # one lookup for the players of every tournament
+        player_ids = set()
+        for tournament in tournaments.itervalues():
+            player_ids.update(get_tournament_player_ids(tournament))
+        players = {p.id: p for p in dao.get_players_by_ids(player_ids, fields=('name',))}
+
+        return {'tournaments': [convert_tournament_to_response(tournaments[id], dao,
+                                                               players=players, fields=fields)
+                                for id in ids if id in tournaments],
+                'not_found': [str(id) for id in ids if id not in tournaments]}
 
 
 class TournamentResource(restful.Resource):
 
     def get(self, region, id):
         dao = get_dao(region)
+
+        parser = reqparse.RequestParser() \
+            .add_argument('fields', type=str)
+        args = parser.parse_args()
+        fields = parse_fields(args['fields'], M.Tournament, M.PendingTournament)
+
         response = None
         tournament = None
         try:
-            tournament = dao.get_tournament_by_id(ObjectId(id))
+            tournament = dao.get_tournament_by_id(ObjectId(id), fields=fields)
         except:
             err('Invalid ObjectID')
         if tournament is not None:
-            response = convert_tournament_to_response(tournament, dao)
+            response = convert_tournament_to_response(tournament, dao, fields=fields)
         else:
             auth_user(request, dao)
 
-            pending_tournament = dao.get_pending_tournament_by_id(ObjectId(id))
+            pending_tournament = dao.get_pending_tournament_by_id(ObjectId(id), fields=fields)
             if not pending_tournament:
                 err('Not found!')
-            response = pending_tournament.dump(context='web')
+            response = dump_fields(pending_tournament, fields, exclude=('new_player_ids',))
 
         return response
 
@@ -612,7 +850,8 @@ class PendingTournamentResource(restful.Resource):
 
         try:
             dao.update_pending_tournament(pending_tournament)
-            return pending_tournament.dump(context='web')
+            return pending_tournament.dump(context='web',
+                                           exclude=('new_player_ids',))
         except:
             err('Encountered an error inserting pending tournament')
 
@@ -634,37 +873,11 @@ class FinalizeTournamentResource(restful.Resource):
             err('No pending tournament found with that id.')
         auth_user(request, dao)
 
-        new_player_names = []
-        for mapping in pending_tournament.alias_to_id_map:
-            if mapping.player_id is None:
-                new_player_names.append(mapping.player_alias)
-
-        for player_name in new_player_names:
-            player = M.Player.create_with_default_values(player_name, region)
-            player_id = dao.insert_player(player)
-            pending_tournament.set_alias_id_mapping(player_name, player_id)
-
-        # validate players in this tournament
-        for mapping in pending_tournament.alias_to_id_map:
-            try:
-                player_id = mapping.player_id
-                # TODO: reduce queries to DB by batching
-                player = dao.get_player_by_id(player_id)
-                if player.merged:
-                    err('Player {} has already been merged'.format(player.name))
-            except:
-                err('Not all player ids are valid')
-
         try:
-            dao.update_pending_tournament(pending_tournament)
-            tournament = M.Tournament.from_pending_tournament(
-                pending_tournament)
-            tournament_id = dao.insert_tournament(tournament)
-            dao.delete_pending_tournament(pending_tournament)
+            tournament_id = dao.finalize_pending_tournament(pending_tournament)
             return {"success": True, "tournament_id": str(tournament_id)}
         except ValueError as e:
-            print e
-            err('Not all player aliases in this pending tournament have been mapped to player ids.')
+            err(str(e))
         except:
             err('Dao threw an error somewhere')
 
@@ -684,10 +897,12 @@ class AddTournamentMatchResource(restful.Resource):
             .add_argument('loser_id', type=str)
 
         args = parser.parse_args()
-        tournament = dao.get_tournament_by_id(ObjectId(id))
+        tournament = dao.get_tournament_by_id(ObjectId(id), fields=('regions',))
 
         if not user:
             err('Permission denied', 403)
+        if tournament is None:
+            err('Tournament not found', 404)
         if not is_user_admin_for_regions(user, tournament.regions):
             err('Permission denied', 403)
 
@@ -700,6 +915,8 @@ class AddTournamentMatchResource(restful.Resource):
         try:
             dao.add_match_by_tournament_id(
                 ObjectId(id), ObjectId(winner_id), ObjectId(loser_id))
+        except ConcurrentUpdateException as e:
+            err(str(e), 409)
         except Exception as e:
             print 'error adding match to tournament: ' + str(e)
             err('error adding match to tournament: ' + str(e))
@@ -721,10 +938,12 @@ class ExcludeTournamentMatchResource(restful.Resource):
 
         args = parser.parse_args()
         try:
-            tournament = dao.get_tournament_by_id(ObjectId(id))
+            tournament = dao.get_tournament_by_id(ObjectId(id), fields=('regions',))
         except:
             err('Casting error')
 
+        if tournament is None:
+            err('Tournament not found', 404)
         if not is_user_admin_for_regions(user, tournament.regions):
             err('Permission denied', 403)
 
@@ -734,6 +953,8 @@ class ExcludeTournamentMatchResource(restful.Resource):
         try:
             dao.set_match_exclusion_by_tournament_id_and_match_id(
                 ObjectId(id), match_id, excluded)
+        except ConcurrentUpdateException as e:
+            err(str(e), 409)
         except Exception as e:
             print e
             err('Match exclusion failed')
@@ -757,14 +978,18 @@ class SwapWinnerLoserMatchResource(restful.Resource):
         tournament_id = args['tournament_id']
         match_id = int(args['match_id'])
 
-        tournament = dao.get_tournament_by_id(ObjectId(tournament_id))
+        tournament = dao.get_tournament_by_id(ObjectId(tournament_id), fields=('regions',))
 
+        if tournament is None:
+            err('Tournament not found', 404)
         if not is_user_admin_for_regions(user, tournament.regions):
             err('Permission denied')
 
         try:
             dao.swap_winner_loser_by_tournament_id_and_match_id(
                 ObjectId(tournament_id), match_id)
+        except ConcurrentUpdateException as e:
+            err(str(e), 409)
         except Exception as e:
             err('Swap Winner Loser failed: ' + str(e))
 
@@ -774,21 +999,28 @@ class RankingsResource(restful.Resource):
     def get(self, region):
         dao = get_dao(region)
 
-        return_dict = dao.get_latest_ranking().dump(context='web')
-        if not return_dict:
-            err('Dao couldnt give us rankings')
+        parser = reqparse.RequestParser() \
+            .add_argument('fields', type=str)
+        args = parser.parse_args()
+        fields = parse_fields(args['fields'], M.Ranking)
 
-        ranking_list = []
-        for r in return_dict['ranking']:
-            player = dao.get_player_by_id(ObjectId(r['player']))
-            if player:
-                r['name'] = player.name
-                r['id'] = str(r.pop('player'))
-                ranking_list.append(r)
+        ranking = dao.get_latest_ranking()
+        if ranking is None:
+            err('Dao couldnt give us rankings')
+        return_dict = dump_fields(ranking, fields)
+
+        if 'ranking' in return_dict:
+            ranking_list = []
+            for r in return_dict['ranking']:
+                player = dao.get_player_by_id(ObjectId(r['player']))
+                if player:
+                    r['name'] = player.name
+                    r['id'] = str(r.pop('player'))
+                    ranking_list.append(r)
+            return_dict['ranking'] = ranking_list
 
         ranking_criteria = dao.get_region_ranking_criteria(region)
 
-        return_dict['ranking'] = ranking_list
         return_dict['ranking_criteria'] = ranking_criteria
 
         return return_dict
@@ -800,7 +1032,8 @@ class RankingsResource(restful.Resource):
         parser = reqparse.RequestParser() \
             .add_argument('ranking_activity_day_limit', type=str) \
             .add_argument('ranking_num_tourneys_attended', type=str) \
-            .add_argument('tournament_qualified_day_limit', type=str)
+            .add_argument('tournament_qualified_day_limit', type=str) \
+            .add_argument('rating_engine', type=str)
 
         args = parser.parse_args()
 
@@ -822,7 +1055,8 @@ class RankingsResource(restful.Resource):
             dao.update_region_ranking_criteria(region,
                                                ranking_num_tourneys_attended=ranking_num_tourneys_attended,
                                                ranking_activity_day_limit=ranking_activity_day_limit,
-                                               tournament_qualified_day_limit=tournament_qualified_day_limit)
+                                               tournament_qualified_day_limit=tournament_qualified_day_limit,
+                                               rating_engine=args['rating_engine'])
         except Exception as e:
             err('There was an error updating the region rankings criteria:' + str(e))
 
@@ -841,6 +1075,7 @@ class RankingsResource(restful.Resource):
 
         # we pass in now so we can mock it out in tests
         now = datetime.now()
+        rating_engine = dao.get_region_ranking_criteria(region)['rating_engine']
 
         try:
             try:
@@ -865,9 +1100,10 @@ class RankingsResource(restful.Resource):
                 rankings.generate_ranking(dao, now=now,
                                           day_limit=ranking_activity_day_limit,
                                           num_tourneys=ranking_num_tourneys_attended,
-                                          tournament_qualified_day_limit=tournament_qualified_day_limit)
+                                          tournament_qualified_day_limit=tournament_qualified_day_limit,
+                                          rating_engine=rating_engine)
             except:
-                rankings.generate_ranking(dao, now=now)
+                rankings.generate_ranking(dao, now=now, rating_engine=rating_engine)
         except Exception as e:
             print str(e)
             err('There was an error updating rankings')
@@ -875,6 +1111,113 @@ class RankingsResource(restful.Resource):
         return self.get(region)
 
 
+class RankingSimulationResource(restful.Resource):
+    """ Dry run of the rankings: the ranking each set of criteria would give,
+        side by side. Criteria left out of a set default to the region's.
+        Nothing is saved. Route restricted to admins for this region. """
+
+    def post(self, region):
+        dao = get_dao(region)
+        auth_user(request, dao)
+
+        parser = reqparse.RequestParser() \
+            .add_argument('criteria', type=list, location='json')
+        args = parser.parse_args()
+
+        if not args['criteria']:
+            err('Criteria list required.')
+
+        region_criteria = dao.get_region_ranking_criteria(region)
+        criteria_sets = []
+        for item in args['criteria']:
+            if not isinstance(item, dict):
+                err('Each set of criteria must be an object.')
+            criteria = {}
+            for key in RANKING_CRITERIA:
+                try:
+                    criteria[key] = int(item.get(key, region_criteria[key]))
+                except (TypeError, ValueError):
+                    err('Invalid {}'.format(key))
+            criteria['rating_engine'] = item.get('rating_engine', region_criteria['rating_engine'])
+            if criteria['rating_engine'] not in M.RATING_ENGINE_CHOICES:
+                err('Invalid rating_engine')
+            criteria_sets.append(criteria)
+
+        # we pass in now so we can mock it out in tests
+        now = datetime.now()
+        ranking_lists = rankings.simulate_rankings(dao, criteria_sets, now=now)
+
+        player_ids = {entry.player for ranking in ranking_lists for entry in ranking}
+        names = {p.id: p.name for p in dao.get_players_by_ids(player_ids)}
+
+        return {'rankings': [{
+            'ranking_criteria': criteria,
+            'ranking': [{'rank': entry.rank,
+                         'id': str(entry.player),
+                         'name': names.get(entry.player),
+                         'rating': entry.rating} for entry in ranking]
+        } for criteria, ranking in zip(criteria_sets, ranking_lists)]}
+
+
+class RankingHistoryResource(restful.Resource):
+
+    def get(self, region):
+        """ Rank and rating of players (every player, or the ones given with
+            player=) in each ranking between since and until (or in the last
+            limit rankings). rank_change is how many places a player moved up
+            since the ranking before, if they were ranked in it. """
+        dao = get_dao(region)
+
+        parser = reqparse.RequestParser() \
+            .add_argument('player', type=str, action='append') \
+            .add_argument('since', type=str) \
+            .add_argument('until', type=str) \
+            .add_argument('limit', type=int)
+
+        args = parser.parse_args()
+
+        try:
+            player_ids = {ObjectId(p) for p in args['player']} if args['player'] else None
+        except:
+            err('Invalid ObjectID')
+
+        if args['limit'] is not None:
+            check_page_limit(args['limit'])
+
+        try:
+            since = datetime.strptime(args['since'].strip(), '%m/%d/%y') if args['since'] else None
+            until = datetime.strptime(args['until'].strip(), '%m/%d/%y') if args['until'] else None
+        except ValueError:
+            err('Invalid date format')
+        if until is not None:
+            # include rankings from that day
+            until += timedelta(days=1)
+
+        previous, history = dao.get_ranking_history(since=since, until=until, limit=args['limit'],
+                                                    with_previous=True)
+
+        trajectories = {}
+        # so the first ranking asked for has rank changes too
+        last_ranks = {entry.player: entry.rank for entry in previous.ranking} if previous else {}
+        for ranking in history:
+            ranks = {}
+            for entry in ranking.ranking:
+                ranks[entry.player] = entry.rank
+                if player_ids is not None and entry.player not in player_ids:
+                    continue
+                last_rank = last_ranks.get(entry.player)
+                trajectories.setdefault(str(entry.player), []).append({
+                    'ranking_id': str(ranking.id),
+                    'time': ranking.time.strftime('%x'),
+                    'rank': entry.rank,
+                    'rating': entry.rating,
+                    'rank_change': last_rank - entry.rank if last_rank is not None else None})
+            last_ranks = ranks
+
+        return {'rankings': [{'id': str(r.id), 'time': r.time.strftime('%x')} for r in history],
+                'players': trajectories}
+
+
 class MatchesResource(restful.Resource):
 
     def get(self, region, id):
@@ -914,9 +1257,25 @@ class MatchesResource(restful.Resource):
             # no need to look up tournaments for merged players
             return return_dict
 
-        tournaments = dao.get_all_tournaments(players=player_list)
+        # the record comes from the head to head records. two players who
+        # never played each other in this region have none, and no
+        # tournaments to go through
+        if opponent_id is not None:
+            head_to_heads = [h for h in [dao.get_head_to_head(player.id, opponent.id)] if h]
+            if not head_to_heads:
+                return return_dict
+        else:
+            head_to_heads = dao.get_head_to_heads_for_player(player.id)
+        return_dict['wins'] = sum(h.wins for h in head_to_heads)
+        return_dict['losses'] = sum(h.losses for h in head_to_heads)
+
+        tournaments = dao.get_all_tournaments(players=player_list, regions=[region])
         if not tournaments:
             err('No tournaments found')
+        opponent_names = {h.opponent: None for h in head_to_heads}
+        for p in dao.get_players_by_ids(opponent_names.keys(), fields=('name',)):
+            opponent_names[p.id] = p.name
+
         for tournament in tournaments:
             for match in tournament.matches:
                 if (opponent_id is not None and match.contains_players(player.id, opponent.id)) or \
@@ -926,28 +1285,70 @@ class MatchesResource(restful.Resource):
                     match_dict['tournament_name'] = tournament.name
                     match_dict[
                         'tournament_date'] = tournament.date.strftime("%x")
-                    match_dict['opponent_id'] = str(
-                        match.get_opposing_player_id(player.id))
-                    try:
-                        match_dict['opponent_name'] = dao.get_player_by_id(
-                            ObjectId(match_dict['opponent_id'])).name
-                    except:
+                    opposing_player_id = match.get_opposing_player_id(player.id)
+                    match_dict['opponent_id'] = str(opposing_player_id)
+                    if opponent_names.get(opposing_player_id) is None:
                         err('Invalid ObjectID')
+                    match_dict['opponent_name'] = opponent_names[opposing_player_id]
 
                     if match.excluded is True:
                         match_dict['result'] = 'excluded'
                     elif match.did_player_win(player.id):
                         match_dict['result'] = 'win'
-                        return_dict['wins'] += 1
                     else:
                         match_dict['result'] = 'lose'
-                        return_dict['losses'] += 1
 
                     match_list.append(match_dict)
 
         return return_dict
 
 
+class HeadToHeadResource(restful.Resource):
+
+    def get(self, region, id):
+        dao = get_dao(region)
+
+        parser = reqparse.RequestParser() \
+            .add_argument('opponent', type=str) \
+            .add_argument('fields', type=str)
+
+        args = parser.parse_args()
+        fields = parse_fields(args['fields'], M.HeadToHead)
+
+        try:
+            player_id = ObjectId(id)
+            opponent_id = ObjectId(args['opponent']) if args['opponent'] else None
+        except:
+            err('Invalid ObjectID')
+
+        if opponent_id is not None:
+            head_to_head = dao.get_head_to_head(player_id, opponent_id) or \
+                M.HeadToHead(player=player_id, opponent=opponent_id, region=region)
+            return dump_fields(head_to_head, fields)
+
+        return {'player': id,
+                'opponents': [dump_fields(h, fields, exclude=('player',))
+                              for h in dao.get_head_to_heads_for_player(player_id)]}
+
+
+class HeadToHeadMatrixResource(restful.Resource):
+
+    def get(self, region):
+        """ Every head to head record between two players in the region
+            (e.g. for seeding tools) """
+        dao = get_dao(region)
+
+        parser = reqparse.RequestParser() \
+            .add_argument('fields', type=str)
+        args = parser.parse_args()
+        fields = parse_fields(args['fields'], M.HeadToHead)
+
+        players = dao.get_all_players()
+        return {'players': [{'id': str(p.id), 'name': p.name} for p in players],
+                'head_to_head': [dump_fields(h, fields) for h in
+                                 dao.get_head_to_head_matrix([p.id for p in players])]}
+
+
 class SmashGGMappingResource(restful.Resource):
 
     def get(self):
@@ -963,24 +1364,66 @@ class SmashGGMappingResource(restful.Resource):
         return id_map
 
 
+class PlayerStatsResource(restful.Resource):
+
+    def get(self, region, id):
+        dao = get_dao(region)
+
+        try:
+            player_id = ObjectId(id)
+        except:
+            err('Invalid ObjectID')
+
+        stats = dao.get_player_stats(player_id) or M.PlayerStats(id=player_id)
+        return stats.dump(context='web')
+
+
 class MergeListResource(restful.Resource):
 
     def get(self, region):
         dao = get_dao(region)
         auth_user(request, dao)
 
-        return_dict = {}
-        return_dict['merges'] = [m.dump(context='web')
-                                 for m in dao.get_all_merges()]
+        parser = reqparse.RequestParser() \
+            .add_argument('limit', type=int) \
+            .add_argument('after', type=str) \
+            .add_argument('fields', type=str)
+        args = parser.parse_args()
+        fields = parse_fields(args['fields'], M.Merge)
 
-        for merge in return_dict['merges']:
-            # TODO: store names in merge object
-            source_player = dao.get_player_by_id(merge['source_player_obj_id'])
-            target_player = dao.get_player_by_id(merge['target_player_obj_id'])
+        return_dict = {}
+        if args['limit'] is None:
+            merges = dao.get_all_merges()
+        else:
+            check_page_limit(args['limit'])
+            try:
+                merges, return_dict['next'] = dao.get_merges_page(
+                    args['limit'], after=args['after'])
+            except ValueError:
+                err('Invalid cursor')
+
+        # the names only go out with the players' ids
+        with_names = fields is None or \
+            ('source_player_obj_id' in fields and 'target_player_obj_id' in fields)
+
+        # TODO: store names in merge object
+        players = {}
+        if with_names:
+            player_ids = set()
+            for merge in merges:
+                player_ids.update([merge.source_player_obj_id, merge.target_player_obj_id])
+            players = {p.id: p for p in dao.get_players_by_ids(player_ids, fields=('name',))}
+
+        return_dict['merges'] = []
+        for merge in merges:
+            merge_json = dump_fields(merge, fields, exclude=('rewritten_tournaments',))
+            source_player = players.get(merge.source_player_obj_id)
+            target_player = players.get(merge.target_player_obj_id)
 
             if source_player is not None and target_player is not None:
-                merge['source_player_name'] = source_player.name
-                merge['target_player_name'] = target_player.name
+                merge_json['source_player_name'] = source_player.name
+                merge_json['target_player_name'] = target_player.name
+            return_dict['merges'].append(merge_json)
 
         return return_dict
 
@@ -1061,9 +1504,20 @@ class SessionResource(restful.Resource):
 
         args = parser.parse_args()
 
-        session_id = dao.check_creds_and_get_session_id_or_none(
-            args['username'], args['password'])
+        # every login from an ip counts, only failed ones count for a username
+        retry_after = max(credentials.ip_throttle.retry_after(request.remote_addr),
+                          credentials.username_throttle.retry_after(args['username']))
+        if retry_after:
+            return throttled(retry_after)
+        credentials.ip_throttle.add(request.remote_addr)
+
+        try:
+            session_id = dao.check_creds_and_get_session_id_or_none(
+                args['username'], args['password'])
+        except credentials.HashPoolBusyException:
+            err('Too many logins right now, try again later', 503)
         if not session_id:
+            credentials.username_throttle.add(args['username'])
             err('Permission denied', 403)
         resp = jsonify({"status": "connected"})
         resp.set_cookie('session_id', session_id)
@@ -1106,12 +1560,19 @@ class UserResource(restful.Resource):
         old_pass = args['old_pass']
         new_pass = args['new_pass']
 
+        retry_after = credentials.username_throttle.retry_after(user.username)
+        if retry_after:
+            return throttled(retry_after)
+
         try:
             if dao.check_creds(user.username, old_pass):
                 dao.change_passwd(user.username, new_pass)
                 return 200
             else:
+                credentials.username_throttle.add(user.username)
                 err('Bad password')
+        except credentials.HashPoolBusyException:
+            err('Too many logins right now, try again later', 503)
         except Exception as ex:
             print ex
             err('Password change not successful')
@@ -1204,17 +1665,26 @@ def add_cors(resp):
 
 api.add_resource(MatchesResource, '/<string:region>/matches/<string:id>')
 
+api.add_resource(HeadToHeadMatrixResource, '/<string:region>/headtohead')
+api.add_resource(HeadToHeadResource, '/<string:region>/headtohead/<string:id>')
+
 api.add_resource(MergeResource, '/<string:region>/merges/<string:id>')
 api.add_resource(MergeListResource, '/<string:region>/merges')
 
 api.add_resource(RegionListResource, '/regions')
 
 api.add_resource(PlayerListResource, '/<string:region>/players')
+api.add_resource(PlayerChangesResource, '/<string:region>/players/changes')
+api.add_resource(PlayerBatchResource, '/<string:region>/players:batch')
 api.add_resource(PlayerResource, '/<string:region>/players/<string:id>')
+api.add_resource(PlayerStatsResource, '/<string:region>/players/<string:id>/stats')
 
 api.add_resource(TournamentSeedResource, '/<string:region>/tournamentseed')
 
 api.add_resource(TournamentListResource, '/<string:region>/tournaments')
+api.add_resource(TournamentBatchResource, '/<string:region>/tournaments:batch')
+api.add_resource(TournamentImportResource,
+                 '/<string:region>/tournaments/bulk')
 api.add_resource(TournamentResource,
                  '/<string:region>/tournaments/<string:id>')
 api.add_resource(PendingTournamentResource,
@@ -1232,6 +1702,8 @@ api.add_resource(AddTournamentMatchResource,
 api.add_resource(SmashGGMappingResource, '/smashGgMap')
 
 api.add_resource(RankingsResource, '/<string:region>/rankings')
+api.add_resource(RankingHistoryResource, '/<string:region>/rankings/history')
+api.add_resource(RankingSimulationResource, '/<string:region>/rankings/simulate')
 
 api.add_resource(SessionResource, '/users/session')
 
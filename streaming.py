@@ -0,0 +1,38 @@
+import json
+
+from flask import Response
+
+# json responses written out a chunk at a time, so list endpoints don't have
+# to build (and serialize) the whole list in memory before sending the first
+# byte. the response has no content length, so it goes out chunked. the
+# request metrics are recorded once the response is closed, so they count the
+# mongo commands made while streaming too.
+
+# list items are buffered until there's about this much to send
+STREAM_CHUNK_SIZE = 16 * 1024
+
+
+def stream_json(fields, list_name, items, status=200, headers=None,
+                chunk_size=STREAM_CHUNK_SIZE):
+    '''Returns a response with the json object fields, plus items (dicts,
+    usually from a generator) as a list under list_name. Items are only
+    pulled from items as the response is written.'''
+    def generate():
+        head = json.dumps(fields)[:-1]
+        buf = ['{}{}{}: ['.format(head, ', ' if fields else '', json.dumps(list_name))]
+        size = 0
+        first = True
+        for item in items:
+            item_json = json.dumps(item)
+            buf.append(item_json if first else ', ' + item_json)
+            first = False
+            size += len(item_json)
+            if size >= chunk_size:
+                yield ''.join(buf)
+                buf = []
+                size = 0
+        buf.append(']}')
+        yield ''.join(buf)
+
+    return Response(generate(), status=status, headers=headers,
+                    content_type='application/json')
@@ -0,0 +1,94 @@
+import gzip
+import json
+import unittest
+import zlib
+
+from flask import Flask, jsonify
+from StringIO import StringIO
+from werkzeug.http import unquote_etag
+
+import compression
+import streaming
+
+
+def gunzip(data):
+    return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        compression.cache.clear()
+        self.pulled = []
+
+        app = Flask(__name__)
+        compression.init_app(app)
+
+        def items(n):
+            for i in xrange(n):
+                self.pulled.append(i)
+                yield {'id': i, 'name': 'player {}'.format(i)}
+
+        @app.route('/players/<int:n>')
+        def players(n):
+            return jsonify({'players': list(items(n))})
+
+        @app.route('/streamed/<int:n>')
+        def streamed(n):
+            return streaming.stream_json({}, 'players', items(n),
+                                         headers={'ETag': '"players-3"'}, chunk_size=64)
+
+        @app.route('/streamed/unversioned/<int:n>')
+        def streamed_unversioned(n):
+            return streaming.stream_json({}, 'players', items(n), chunk_size=64)
+
+        self.app = app.test_client()
+
+    def test_gzip(self):
+        response = self.app.get('/players/100', headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEquals(response.headers['Content-Encoding'], 'gzip')
+        self.assertEquals(response.headers['Vary'], 'Accept-Encoding')
+        self.assertEquals(int(response.headers['Content-Length']), len(response.data))
+        self.assertEquals(json.loads(gunzip(response.data)),
+                          json.loads(self.app.get('/players/100').data))
+
+    def test_deflate(self):
+        response = self.app.get('/players/100', headers={'Accept-Encoding': 'gzip;q=0.5, deflate'})
+        self.assertEquals(response.headers['Content-Encoding'], 'deflate')
+        self.assertEquals(json.loads(zlib.decompress(response.data)),
+                          json.loads(self.app.get('/players/100').data))
+
+    def test_not_compressed(self):
+        # not accepted
+        response = self.app.get('/players/100')
+        self.assertFalse('Content-Encoding' in response.headers)
+        self.assertEquals(len(json.loads(response.data)['players']), 100)
+
+        # too small
+        response = self.app.get('/players/1', headers={'Accept-Encoding': 'gzip'})
+        self.assertFalse('Content-Encoding' in response.headers)
+        self.assertEquals(len(json.loads(response.data)['players']), 1)
+
+    def test_streamed(self):
+        response = self.app.get('/streamed/100', headers={'Accept-Encoding': 'gzip'})
+        self.assertEquals(response.headers['Content-Encoding'], 'gzip')
+        self.assertFalse('Content-Length' in response.headers)
+        self.assertEquals(unquote_etag(response.headers['ETag']), ('players-3', True))
+        self.assertEquals(len(json.loads(gunzip(response.data))['players']), 100)
+        self.assertEquals(len(self.pulled), 100)
+
+        # same etag, so the compressed body comes from the cache and the
+        # items aren't pulled again
+        response = self.app.get('/streamed/100', headers={'Accept-Encoding': 'gzip'})
+        self.assertEquals(len(json.loads(gunzip(response.data))['players']), 100)
+        self.assertEquals(len(self.pulled), 100)
+
+        # cached per encoding
+        response = self.app.get('/streamed/100', headers={'Accept-Encoding': 'deflate'})
+        self.assertEquals(len(json.loads(zlib.decompress(response.data))['players']), 100)
+        self.assertEquals(len(self.pulled), 200)
+
+    def test_streamed_without_etag(self):
+        response = self.app.get('/streamed/unversioned/100', headers={'Accept-Encoding': 'gzip'})
+        self.assertEquals(len(json.loads(gunzip(response.data))['players']), 100)
+        # nothing to key the body on, so it isn't kept
+        self.assertEquals(len(compression.cache.bodies), 0)
@@ -1,7 +1,9 @@
 import unittest
-from config.config import Config
+from config.config import Config, DEFAULT_SERVER_MODE, DEFAULT_SERVER_MAX_THREADS, \
+    DEFAULT_PASSWORD_HASH_WORKERS
 
 TEMPLATE_CONFIG_FILE = 'config/config.ini.template'
+DEV_CONFIG_FILE = 'config/dev-config.ini'
 
 class TestConfig(unittest.TestCase):
     def setUp(self):
@@ -30,3 +32,25 @@ class TestConfig(unittest.TestCase):
 
     def test_get_fb_app_token(self):
         self.assertEquals(self.config.get_fb_app_token(), 'FB_APP_TOKEN')
+
+    def test_get_server_mode(self):
+        self.assertEquals(self.config.get_server_mode(), 'SERVER_MODE')
+
+    def test_get_server_settings(self):
+        config = Config(DEV_CONFIG_FILE)
+        self.assertEquals(config.get_server_mode(), 'twisted')
+        self.assertEquals(config.get_server_min_threads(), 5)
+        self.assertEquals(config.get_server_max_threads(), 20)
+        self.assertEquals(config.get_server_processes(), 4)
+        self.assertEquals(config.get_server_threads(), 4)
+        self.assertTrue(config.get_server_timing())
+        self.assertEquals(config.get_password_hash_workers(), 2)
+        self.assertEquals(config.get_max_pending_password_hashes(), 8)
+
+    def test_get_server_settings_default(self):
+        # older config.ini files have no [server] section
+        config = Config('config/does-not-exist.ini')
+        self.assertEquals(config.get_server_mode(), DEFAULT_SERVER_MODE)
+        self.assertEquals(config.get_server_max_threads(), DEFAULT_SERVER_MAX_THREADS)
+        self.assertFalse(config.get_server_timing())
+        self.assertEquals(config.get_password_hash_workers(), DEFAULT_PASSWORD_HASH_WORKERS)
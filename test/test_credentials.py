@@ -0,0 +1,39 @@
+import hashlib
+import unittest
+
+import credentials
+
+
+class TestCredentials(unittest.TestCase):
+    def tearDown(self):
+        credentials.pool = None
+
+    def test_pbkdf2(self):
+        expected = hashlib.pbkdf2_hmac('sha256', 'rip', 'salt', 1000)
+        self.assertEquals(credentials.pbkdf2('rip', 'salt', 1000), expected)
+
+        credentials.init_pool(num_workers=1)
+        self.assertEquals(credentials.pbkdf2('rip', 'salt', 1000), expected)
+        credentials.pool.close()
+
+    def test_pbkdf2_busy(self):
+        credentials.init_pool(num_workers=1, max_pending=0)
+        with self.assertRaises(credentials.HashPoolBusyException):
+            credentials.pbkdf2('rip', 'salt', 1000)
+
+    def test_throttle(self):
+        throttle = credentials.Throttle(2, window=60)
+        throttle.add('gar', now=100)
+        self.assertEquals(throttle.retry_after('gar', now=100), 0)
+        throttle.add('gar', now=110)
+        self.assertEquals(throttle.retry_after('gar', now=110), 51)
+        self.assertEquals(throttle.retry_after('sfat', now=110), 0)
+
+        # the first attempt is out of the window
+        self.assertEquals(throttle.retry_after('gar', now=161), 0)
+
+    def test_throttle_sweep(self):
+        throttle = credentials.Throttle(2, window=60)
+        throttle.add('gar', now=100)
+        throttle.add('sfat', now=200)
+        self.assertEquals(throttle.attempts.keys(), ['sfat'])
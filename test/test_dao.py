@@ -1,16 +1,20 @@
+import base64
+import os
 import unittest
 
 from bson.objectid import ObjectId
 from ConfigParser import ConfigParser
-from datetime import datetime
+from datetime import datetime, timedelta
 from pymongo.errors import DuplicateKeyError
 from pymongo import MongoClient
+from mock import patch
 
+import dao as dao_module
 from dao import Dao, InvalidRegionsException, \
     InvalidNameException, DuplicateAliasException, DuplicateUsernameException, \
-    verify_password
+    verify_password, hash_session_token
 from model import AliasMapping, AliasMatch, Match, Merge, Player, PendingTournament, \
-                 Ranking, RankingEntry, Rating, Region, Tournament, User
+                 Ranking, RankingEntry, Rating, RawFile, Region, Tournament, User
 
 
 DATABASE_NAME = 'garpr_test'
@@ -366,6 +370,19 @@ class TestDAO(unittest.TestCase):
         self.assertIsNone(self.norcal_dao.get_player_by_id(self.player_2_id))
         self.assertIsNone(self.norcal_dao.get_player_by_id(self.player_3_id))
 
+    def test_delete_players(self):
+        change_stamp = self.norcal_dao.get_player_change_stamp()
+        self.norcal_dao.delete_players([self.player_2, self.player_3])
+
+        self.assertEquals(self.norcal_dao.get_player_by_id(
+            self.player_1_id), self.player_1)
+        self.assertIsNone(self.norcal_dao.get_player_by_id(self.player_2_id))
+        self.assertIsNone(self.norcal_dao.get_player_by_id(self.player_3_id))
+        self.assertEquals(self.norcal_dao.get_ratings([self.player_2_id, self.player_3_id]), {})
+        players, deleted_ids = self.norcal_dao.get_player_changes(change_stamp)
+        self.assertEquals(players, [])
+        self.assertEquals(sorted(deleted_ids), sorted([self.player_2_id, self.player_3_id]))
+
     def test_update_player(self):
         self.assertEquals(self.norcal_dao.get_player_by_id(
             self.player_1_id), self.player_1)
@@ -394,9 +411,190 @@ class TestDAO(unittest.TestCase):
             self.player_2_id), self.player_2)
         self.assertEquals(self.norcal_dao.get_player_by_id(
             self.player_3_id), self.player_3)
+        # the ratings are left to ranking runs
+        player_1_clone.ratings = self.player_1.ratings
         self.assertEquals(self.norcal_dao.get_player_by_id(
             self.player_1_id), player_1_clone)
 
+    def test_iter_all_players(self):
+        self.assertEquals(list(self.norcal_dao.iter_all_players()),
+                          sorted(self.norcal_dao.get_all_players(), key=lambda p: p.name.lower()))
+
+        players = list(self.norcal_dao.iter_all_players(all_regions=True, batch_size=1))
+        self.assertEquals(players,
+                          sorted(self.norcal_dao.get_all_players(all_regions=True),
+                                 key=lambda p: p.name.lower()))
+
+    def test_set_player_sort_names(self):
+        self.norcal_dao.players_col.update_many({}, {'$unset': {'sort_name': ''}})
+
+        self.assertEquals(self.norcal_dao.set_player_sort_names(), len(self.players))
+        self.assertEquals(self.norcal_dao.set_player_sort_names(), 0)
+        self.assertEquals(self.norcal_dao.players_col.find_one({'_id': self.player_1_id})['sort_name'],
+                          'gar')
+
+    def test_insert_players(self):
+        change_stamp = self.norcal_dao.get_player_change_stamp()
+        players = [Player.create_with_default_values(name, 'norcal') for name in ('Zhu', 'axe')]
+        self.norcal_dao.insert_players(players)
+
+        self.assertEquals(self.norcal_dao.get_player_change_stamp(), change_stamp + 2)
+        self.assertEquals(self.norcal_dao.get_players_by_ids([p.id for p in players]), players)
+        self.assertEquals([p.name for p in self.norcal_dao.iter_all_players()],
+                          sorted([p.name for p in self.norcal_dao.get_all_players()], key=lambda name: name.lower()))
+
+    def test_iter_tournaments(self):
+        tournaments = list(self.norcal_dao.iter_tournaments(regions=['norcal']))
+        self.assertEquals(tournaments, self.norcal_dao.get_all_tournaments(regions=['norcal']))
+
+        tournaments = list(self.norcal_dao.iter_tournaments(fields=('id', 'name', 'type', 'date')))
+        self.assertEquals([t.id for t in tournaments],
+                          [t.id for t in self.norcal_dao.get_all_tournaments()])
+        self.assertEquals([t.name for t in tournaments],
+                          [t.name for t in self.norcal_dao.get_all_tournaments()])
+        self.assertTrue(all(t.matches == [] and t.players == [] for t in tournaments))
+
+    def test_get_players_page(self):
+        players = []
+        cursor = None
+        while True:
+            page, cursor = self.norcal_dao.get_players_page(2, after=cursor, all_regions=True)
+            self.assertTrue(len(page) <= 2)
+            players.extend(page)
+            if cursor is None:
+                break
+        self.assertEquals(players, list(self.norcal_dao.iter_all_players(all_regions=True)))
+
+        page, cursor = self.norcal_dao.get_players_page(len(self.players) * 2)
+        self.assertEquals(page, list(self.norcal_dao.iter_all_players()))
+        self.assertIsNone(cursor)
+
+    def test_get_tournaments_page(self):
+        page, cursor = self.norcal_dao.get_tournaments_page(1, regions=['norcal'])
+        self.assertEquals([t.id for t in page], [self.tournament_id_2])
+        self.assertIsNotNone(cursor)
+
+        page, cursor = self.norcal_dao.get_tournaments_page(1, after=cursor, regions=['norcal'])
+        self.assertEquals([t.id for t in page], [self.tournament_id_1])
+        self.assertIsNone(cursor)
+
+        page, cursor = self.norcal_dao.get_tournaments_page(
+            1, fields=('id', 'name', 'type'), newest_first=True)
+        self.assertEquals([t.id for t in page], [self.tournament_id_1])
+        self.assertEquals(page[0].matches, [])
+        page, cursor = self.norcal_dao.get_tournaments_page(1, after=cursor, newest_first=True)
+        self.assertEquals([t.id for t in page], [self.tournament_id_2])
+        self.assertIsNone(cursor)
+
+    def test_get_tournaments_page_invalid_cursor(self):
+        for cursor in ('garbage', base64.urlsafe_b64encode('[1, 2]')):
+            with self.assertRaises(ValueError):
+                self.norcal_dao.get_tournaments_page(1, after=cursor)
+
+    def test_get_player_changes(self):
+        change_stamp = self.norcal_dao.get_player_change_stamp()
+        self.assertEquals(self.norcal_dao.get_player_changes(change_stamp), ([], []))
+
+        self.player_1.name = 'garrr'
+        self.norcal_dao.update_player(self.player_1)
+        self.norcal_dao.delete_player(self.player_2)
+        self.assertEquals(self.norcal_dao.get_player_change_stamp(), change_stamp + 2)
+
+        players, deleted_ids = self.norcal_dao.get_player_changes(change_stamp)
+        self.assertEquals(players, [self.player_1])
+        self.assertEquals(deleted_ids, [self.player_2_id])
+
+        # only what changed after the delete
+        players, deleted_ids = self.norcal_dao.get_player_changes(change_stamp + 1)
+        self.assertEquals(players, [])
+        self.assertEquals(deleted_ids, [self.player_2_id])
+
+        # putting a player back clears their tombstone
+        self.norcal_dao.insert_player(self.player_2)
+        players, deleted_ids = self.norcal_dao.get_player_changes(change_stamp)
+        self.assertEquals(sorted(p.id for p in players), sorted([self.player_1_id, self.player_2_id]))
+        self.assertEquals(deleted_ids, [])
+
+    def test_get_player_change_stamp_pending_write(self):
+        dao = self.norcal_dao
+        change_stamp = dao.get_player_change_stamp()
+
+        with dao._reserve_player_change_stamps() as first_stamp:
+            self.assertEquals(first_stamp, change_stamp + 1)
+            # a write that starts later and lands first
+            self.player_1.name = 'garrr'
+            dao.update_player(self.player_1)
+            # clients don't skip the write still in flight
+            self.assertEquals(dao.get_player_change_stamp(), change_stamp)
+        self.assertEquals(dao.get_player_change_stamp(), change_stamp + 2)
+
+    def test_get_player_change_stamp_dead_write(self):
+        dao = self.norcal_dao
+        change_stamp = dao.get_player_change_stamp()
+        started = datetime.utcnow() - dao_module.PLAYER_CHANGE_STAMP_TIMEOUT
+        dao.counters_col.update_one({'_id': dao_module.PLAYER_CHANGE_STAMP_COUNTER},
+                                    {'$set': {'value': change_stamp + 1,
+                                              'pending.%d' % (change_stamp + 1): started}})
+        self.assertEquals(dao.get_player_change_stamp(), change_stamp + 1)
+
+        # and the next write clears it out
+        dao.update_player(self.player_1)
+        self.assertEquals(dao.counters_col.find_one(
+            {'_id': dao_module.PLAYER_CHANGE_STAMP_COUNTER})['pending'], {})
+
+    def test_stamp_players(self):
+        self.norcal_dao.players_col.update_many({}, {'$unset': {'change_stamp': ''}})
+        change_stamp = self.norcal_dao.get_player_change_stamp()
+
+        self.assertEquals(self.norcal_dao.stamp_players(), len(self.players))
+        self.assertEquals(self.norcal_dao.stamp_players(), 0)
+
+        stamps = [p['change_stamp'] for p in self.norcal_dao.players_col.find()]
+        self.assertEquals(sorted(stamps), range(change_stamp + 1, change_stamp + len(self.players) + 1))
+        players, _ = self.norcal_dao.get_player_changes(change_stamp)
+        self.assertEquals(len(players), len(self.players))
+
+    def test_update_ratings(self):
+        player_doc = self.norcal_dao.players_col.find_one({'_id': self.player_1_id})
+        self.assertFalse('ratings' in player_doc)
+        change_stamp = self.norcal_dao.get_player_change_stamp()
+
+        self.norcal_dao.update_ratings({self.player_1_id: Rating(mu=30., sigma=2.)})
+
+        # only the norcal rating changes, and only the change stamp of the player
+        player = self.norcal_dao.get_player_by_id(self.player_1_id)
+        self.assertEquals(player.ratings, {'norcal': Rating(mu=30., sigma=2.),
+                                           'texas': Rating()})
+        new_player_doc = self.norcal_dao.players_col.find_one({'_id': self.player_1_id})
+        self.assertEquals(new_player_doc.pop('change_stamp'), change_stamp + 1)
+        player_doc.pop('change_stamp')
+        self.assertEquals(new_player_doc, player_doc)
+        self.assertEquals(self.norcal_dao.get_player_changes(change_stamp)[0], [player])
+
+    def test_get_ratings(self):
+        self.assertEquals(self.norcal_dao.get_ratings([self.player_1_id, ObjectId()]),
+                          {self.player_1_id: {'norcal': Rating(), 'texas': Rating()}})
+        self.assertEquals(self.norcal_dao.get_player_by_id(self.player_1_id, fields=['name']).ratings, {})
+
+    def test_move_player_ratings(self):
+        self.norcal_dao.ratings_col.delete_many({})
+        self.norcal_dao.players_col.update_one({'_id': self.player_1_id},
+                                               {'$set': {'ratings': {'norcal': Rating(mu=2.).dump(context='db')}}})
+        self.norcal_dao.ratings_col.insert({'player': self.player_1_id, 'region': 'norcal',
+                                            'rating': Rating(mu=3.).dump(context='db')})
+        self.norcal_dao.players_col.update_one({'_id': self.player_2_id},
+                                               {'$set': {'ratings': {'texas': Rating(mu=4.).dump(context='db')}}})
+
+        self.assertEquals(self.norcal_dao.move_player_ratings(), 2)
+        self.assertEquals(self.norcal_dao.move_player_ratings(), 0)
+
+        # the rating already in the collection wins
+        self.assertEquals(self.norcal_dao.get_player_by_id(self.player_1_id).ratings,
+                          {'norcal': Rating(mu=3.)})
+        self.assertEquals(self.norcal_dao.get_player_by_id(self.player_2_id).ratings,
+                          {'texas': Rating(mu=4.)})
+        self.assertEquals(self.norcal_dao.players_col.find({'ratings': {'$exists': True}}).count(), 0)
+
     def test_add_alias_to_player(self):
         new_alias = 'gaRRR'
         old_expected_aliases = ['gar', 'garr']
@@ -694,6 +892,97 @@ class TestDAO(unittest.TestCase):
         self.assertEquals(tournament.players, self.tournament_players_2)
         self.assertEquals(tournament.regions, self.tournament_regions_2)
 
+    def _set_match_ids(self, tournament):
+        for i, match in enumerate(tournament.matches):
+            match.match_id = i
+        self.norcal_dao.update_tournament(tournament)
+
+    def test_set_match_exclusion_by_tournament_id_and_match_id(self):
+        self._set_match_ids(self.tournament_1)
+
+        self.assertTrue(self.norcal_dao.set_match_exclusion_by_tournament_id_and_match_id(
+            self.tournament_id_1, 1, True))
+        self.assertFalse(self.norcal_dao.set_match_exclusion_by_tournament_id_and_match_id(
+            self.tournament_id_1, 5, True))
+
+        tournament = self.norcal_dao.get_tournament_by_id(self.tournament_id_1)
+        self.assertEquals([m.excluded for m in tournament.matches], [False, True])
+        self.assertEquals(tournament.version, self.tournament_1.version + 1)
+
+    def test_swap_winner_loser_by_tournament_id_and_match_id(self):
+        self._set_match_ids(self.tournament_1)
+
+        self.norcal_dao.swap_winner_loser_by_tournament_id_and_match_id(
+            self.tournament_id_1, 0)
+
+        match = self.norcal_dao.get_match_by_tournament_id_and_match_id(
+            self.tournament_id_1, 0)
+        self.assertEquals(match.winner, self.player_2_id)
+        self.assertEquals(match.loser, self.player_1_id)
+
+        tournament = self.norcal_dao.get_tournament_by_id(self.tournament_id_1)
+        self.assertEquals(tournament.matches[1], self.tournament_matches_1[1])
+
+    def test_swap_winner_loser_invalid_match(self):
+        self._set_match_ids(self.tournament_1)
+
+        with self.assertRaises(ValueError):
+            self.norcal_dao.swap_winner_loser_by_tournament_id_and_match_id(
+                self.tournament_id_1, 5)
+
+    def test_swap_winner_loser_concurrent_update(self):
+        self._set_match_ids(self.tournament_1)
+        find_one = self.norcal_dao.tournaments_col.find_one
+
+        # another write sneaks in between our read and our write, once
+        def find_one_and_interfere(*args, **kwargs):
+            ret = find_one(*args, **kwargs)
+            if mock_find_one.call_count == 1:
+                self.norcal_dao.tournaments_col.update_one(
+                    {'_id': self.tournament_id_1},
+                    {'$set': {'matches.0.excluded': True}, '$inc': {'version': 1}})
+            return ret
+
+        with patch.object(self.norcal_dao.tournaments_col, 'find_one',
+                          side_effect=find_one_and_interfere) as mock_find_one:
+            self.norcal_dao.swap_winner_loser_by_tournament_id_and_match_id(
+                self.tournament_id_1, 0)
+            self.assertEquals(mock_find_one.call_count, 2)
+
+        match = self.norcal_dao.get_match_by_tournament_id_and_match_id(
+            self.tournament_id_1, 0)
+        self.assertEquals(match.winner, self.player_2_id)
+        self.assertTrue(match.excluded)
+
+    def test_match_updates_without_version(self):
+        # tournaments from insert_tournament are stored with version null
+        self.assertIsNone(self.norcal_dao.tournaments_col.find_one(
+            {'_id': self.tournament_id_1})['version'])
+        self.norcal_dao.tournaments_col.update_one({'_id': self.tournament_id_1},
+                                                   {'$set': {'matches.0.match_id': 0,
+                                                             'matches.1.match_id': 1}})
+
+        self.assertTrue(self.norcal_dao.set_match_exclusion_by_tournament_id_and_match_id(
+            self.tournament_id_1, 1, True))
+        self.norcal_dao.swap_winner_loser_by_tournament_id_and_match_id(self.tournament_id_1, 0)
+        self.norcal_dao.add_match_by_tournament_id(
+            self.tournament_id_1, self.player_5_id, self.player_1_id)
+        self.assertEquals(self.norcal_dao.get_tournament_by_id(self.tournament_id_1).version, 3)
+
+    def test_add_match_by_tournament_id(self):
+        self._set_match_ids(self.tournament_1)
+
+        match_id = self.norcal_dao.add_match_by_tournament_id(
+            self.tournament_id_1, self.player_5_id, self.player_1_id)
+        self.assertEquals(match_id, 2)
+
+        tournament = self.norcal_dao.get_tournament_by_id(self.tournament_id_1)
+        self.assertEquals(tournament.matches[2], Match(
+            match_id=2, winner=self.player_5_id, loser=self.player_1_id, excluded=False))
+        self.assertEquals(tournament.players, self.tournament_players_1 + [self.player_5_id])
+        self.assertEquals(len(tournament.orig_ids), len(tournament.players))
+        self.assertTrue(tournament.validate()[0])
+
     def test_get_tournament_by_id(self):
         tournament_1 = self.norcal_dao.get_tournament_by_id(
             self.tournament_id_1)
@@ -743,6 +1032,292 @@ class TestDAO(unittest.TestCase):
         self.assertTrue(any(player.name == "gaR" for player in dao.get_players_with_similar_alias(
             "garpr goog youtube gar")))
 
+    def test_get_players_with_similar_aliases(self):
+        players = self.norcal_dao.get_players_with_similar_aliases(
+            ['gar', 'miom | sfat'])
+        self.assertEquals(players, [self.player_1, self.player_2, self.player_3])
+
+        self.assertEquals(
+            self.norcal_dao.get_players_with_similar_aliases([]), [])
+
+    def test_insert_pending_tournaments(self):
+        pending_tournament_2 = PendingTournament(
+            id=ObjectId(),
+            name='pending tournament 2',
+            type='tio',
+            date=datetime(2013, 10, 12),
+            regions=['norcal'],
+            players=self.pending_tournament_players_1,
+            matches=self.pending_tournament_matches_1)
+        pending_tournament_3 = PendingTournament(
+            id=ObjectId(),
+            name='pending tournament 3',
+            type='tio',
+            date=datetime(2013, 10, 13),
+            regions=['norcal'],
+            players=self.pending_tournament_players_1,
+            matches=self.pending_tournament_matches_1)
+
+        ids = self.norcal_dao.insert_pending_tournaments(
+            [pending_tournament_2, pending_tournament_3])
+
+        self.assertEquals(ids, [pending_tournament_2.id, pending_tournament_3.id])
+        self.assertEquals(self.norcal_dao.get_pending_tournament_by_id(
+            pending_tournament_2.id), pending_tournament_2)
+        self.assertEquals(self.norcal_dao.get_pending_tournament_by_id(
+            pending_tournament_3.id), pending_tournament_3)
+
+    def test_insert_raw_file(self):
+        # incompressible, so it spans several chunks
+        data = os.urandom(3 * dao_module.RAW_FILE_CHUNK_SIZE).encode('hex')
+        raw_file = RawFile(id=ObjectId(), data=data)
+
+        self.assertEquals(self.norcal_dao.insert_raw_file(raw_file), raw_file.id)
+
+        doc = self.norcal_dao.raw_files_col.find_one({'_id': raw_file.id})
+        self.assertFalse('data' in doc)
+        self.assertEquals(doc['compression'], 'zlib')
+        self.assertEquals(doc['length'], len(data))
+        self.assertTrue(doc['num_chunks'] > 1)
+        self.assertEquals(self.norcal_dao.raw_file_chunks_col.find(
+            {'raw_id': raw_file.id}).count(), doc['num_chunks'])
+
+        self.assertEquals(self.norcal_dao.get_raw_file_by_id(raw_file.id).data, data)
+
+    def test_insert_raw_file_pieces(self):
+        raw_file = RawFile(id=ObjectId())
+        raw_file.data_pieces = iter(['{"participants": ', '["gar", "sfat"]', '}'])
+        self.norcal_dao.insert_raw_file(raw_file)
+
+        doc = self.norcal_dao.raw_files_col.find_one({'_id': raw_file.id})
+        self.assertEquals(doc['length'], len('{"participants": ["gar", "sfat"]}'))
+        self.assertEquals(self.norcal_dao.get_raw_file_by_id(raw_file.id).data,
+                          '{"participants": ["gar", "sfat"]}')
+
+    def test_get_raw_file_by_id_legacy(self):
+        raw_file_id = ObjectId()
+        self.norcal_dao.raw_files_col.insert({'_id': raw_file_id, 'data': 'raw data'})
+
+        raw_file = self.norcal_dao.get_raw_file_by_id(raw_file_id)
+        self.assertEquals(raw_file.data, 'raw data')
+        self.assertIsNone(raw_file.compression)
+
+    def test_update_raw_file(self):
+        raw_file_id = ObjectId()
+        self.norcal_dao.raw_files_col.insert({'_id': raw_file_id, 'data': 'raw data'})
+
+        raw_file = self.norcal_dao.get_raw_file_by_id(raw_file_id)
+        raw_file.data = '"raw data"'
+        self.norcal_dao.update_raw_file(raw_file)
+
+        raw_file = self.norcal_dao.get_raw_file_by_id(raw_file_id)
+        self.assertEquals(raw_file.data, '"raw data"')
+        self.assertEquals(raw_file.compression, 'zlib')
+        self.assertEquals(self.norcal_dao.raw_file_chunks_col.find(
+            {'raw_id': raw_file_id}).count(), 1)
+        self.assertEquals(self.norcal_dao.insert_pending_tournaments([]), [])
+
+    def _get_head_to_head(self, player_id, opponent_id):
+        h = self.norcal_dao.get_head_to_head(player_id, opponent_id)
+        return h and (h.wins, h.losses, h.excluded, h.last_played)
+
+    def test_rebuild_head_to_head(self):
+        # 6 in norcal, and 4 in texas from tournament 2
+        self.assertEquals(self.norcal_dao.rebuild_head_to_head(), 10)
+
+        self.assertEquals(self._get_head_to_head(self.player_1_id, self.player_2_id),
+                          (1, 0, 0, self.tournament_date_1))
+        self.assertEquals(self._get_head_to_head(self.player_2_id, self.player_1_id),
+                          (0, 1, 0, self.tournament_date_1))
+        # played in both tournaments
+        self.assertEquals(self._get_head_to_head(self.player_3_id, self.player_4_id),
+                          (2, 0, 0, self.tournament_date_1))
+        self.assertIsNone(self._get_head_to_head(self.player_1_id, self.player_5_id))
+
+        self.assertEquals(len(self.norcal_dao.get_head_to_heads_for_player(self.player_2_id)), 2)
+        self.assertEquals(len(self.norcal_dao.get_head_to_head_matrix(
+            [self.player_1_id, self.player_2_id, self.player_5_id])), 4)
+
+    def test_head_to_head_by_region(self):
+        self.norcal_dao.rebuild_head_to_head()
+        texas_dao = Dao('texas', self.mongo_client, database_name=DATABASE_NAME)
+
+        # only tournament 2 was in texas
+        self.assertEquals(texas_dao.get_head_to_head(self.player_3_id, self.player_4_id).wins, 1)
+        self.assertIsNone(texas_dao.get_head_to_head(self.player_1_id, self.player_2_id))
+        self.assertEquals(len(texas_dao.get_head_to_heads_for_player(self.player_2_id)), 1)
+
+        self.tournament_2.regions = ['norcal']
+        self.norcal_dao.update_tournament(self.tournament_2)
+        self.assertIsNone(texas_dao.get_head_to_head(self.player_3_id, self.player_4_id))
+        self.assertEquals(self._get_head_to_head(self.player_3_id, self.player_4_id),
+                          (2, 0, 0, self.tournament_date_1))
+
+    def test_head_to_head_follows_match_updates(self):
+        self._set_match_ids(self.tournament_1)
+        self.norcal_dao.rebuild_head_to_head()
+
+        self.norcal_dao.swap_winner_loser_by_tournament_id_and_match_id(self.tournament_id_1, 0)
+        self.assertEquals(self._get_head_to_head(self.player_1_id, self.player_2_id),
+                          (0, 1, 0, self.tournament_date_1))
+        self.assertEquals(self._get_head_to_head(self.player_2_id, self.player_1_id),
+                          (1, 0, 0, self.tournament_date_1))
+
+        self.norcal_dao.set_match_exclusion_by_tournament_id_and_match_id(
+            self.tournament_id_1, 1, True)
+        self.assertEquals(self._get_head_to_head(self.player_4_id, self.player_3_id),
+                          (0, 1, 1, self.tournament_date_1))
+
+        self.norcal_dao.add_match_by_tournament_id(
+            self.tournament_id_1, self.player_1_id, self.player_4_id)
+        self.assertEquals(self._get_head_to_head(self.player_4_id, self.player_1_id),
+                          (0, 1, 0, self.tournament_date_1))
+
+    def test_head_to_head_follows_tournament_updates(self):
+        self.norcal_dao.rebuild_head_to_head()
+
+        # p3 beat p4 in both tournaments, tournament 1 being the latest
+        self.norcal_dao.delete_tournament(self.tournament_1)
+        self.assertEquals(self._get_head_to_head(self.player_3_id, self.player_4_id),
+                          (1, 0, 0, self.tournament_date_2))
+        self.assertIsNone(self._get_head_to_head(self.player_1_id, self.player_2_id))
+
+        self.tournament_2.matches = [Match(winner=self.player_2_id, loser=self.player_5_id),
+                                     Match(winner=self.player_3_id, loser=self.player_4_id)]
+        self.norcal_dao.update_tournament(self.tournament_2)
+        self.assertEquals(self._get_head_to_head(self.player_5_id, self.player_2_id),
+                          (0, 1, 0, self.tournament_date_2))
+        self.assertEquals(self._get_head_to_head(self.player_3_id, self.player_4_id),
+                          (1, 0, 0, self.tournament_date_2))
+
+    def test_head_to_head_follows_merges(self):
+        self.norcal_dao.rebuild_head_to_head()
+        self.norcal_dao.insert_player(self.player_5)
+
+        # p1 and p5 never played each other
+        the_merge = Merge(requester_user_id=self.user_id_1,
+                          source_player_obj_id=self.player_5_id,
+                          target_player_obj_id=self.player_1_id,
+                          time=datetime.today(),
+                          id=ObjectId())
+        self.norcal_dao.merge_players(the_merge)
+        self.assertIsNone(self._get_head_to_head(self.player_5_id, self.player_2_id))
+        self.assertEquals(self._get_head_to_head(self.player_1_id, self.player_2_id),
+                          (2, 0, 0, self.tournament_date_1))
+        self.assertEquals(self._get_head_to_head(self.player_2_id, self.player_1_id),
+                          (0, 2, 0, self.tournament_date_1))
+
+        self.norcal_dao.unmerge_players(the_merge)
+        self.assertEquals(self._get_head_to_head(self.player_5_id, self.player_2_id),
+                          (1, 0, 0, self.tournament_date_2))
+        self.assertEquals(self._get_head_to_head(self.player_1_id, self.player_2_id),
+                          (1, 0, 0, self.tournament_date_1))
+
+    def test_merge_resolves_tournaments(self):
+        self.norcal_dao.rebuild_head_to_head()
+        self.norcal_dao.rebuild_player_stats()
+        self.norcal_dao.insert_player(self.player_5)
+        self.assertEquals(self._get_player_stats(self.player_1_id), (1, 0, 1, self.tournament_date_1))
+        self.assertEquals(self._get_player_stats(self.player_5_id), (1, 0, 1, self.tournament_date_2))
+
+        the_merge = Merge(requester_user_id=self.user_id_1,
+                          source_player_obj_id=self.player_5_id,
+                          target_player_obj_id=self.player_1_id,
+                          time=datetime.today(),
+                          id=ObjectId())
+        self.norcal_dao.insert_merge(the_merge)
+
+        # the tournament keeps p5, reads see p1
+        self.assertTrue(self.player_5_id in
+                        self.norcal_dao.tournaments_col.find_one({'_id': self.tournament_id_2})['players'])
+        tournament = self.norcal_dao.get_tournament_by_id(self.tournament_id_2)
+        self.assertTrue(self.player_1_id in tournament.players)
+        self.assertFalse(self.player_5_id in tournament.players)
+        self.assertEquals(tournament.matches[0].winner, self.player_1_id)
+        self.assertEquals(len(self.norcal_dao.get_all_tournaments(
+            players=[self.norcal_dao.get_player_by_id(self.player_1_id)])), 2)
+        self.assertEquals(self._get_player_stats(self.player_1_id), (2, 0, 2, self.tournament_date_1))
+        self.assertIsNone(self._get_player_stats(self.player_5_id))
+
+        self.assertEquals(self.norcal_dao.compact_merges(), 1)
+        self.assertEquals(self.norcal_dao.compact_merges(), 0)
+        self.assertFalse(self.player_5_id in
+                         self.norcal_dao.tournaments_col.find_one({'_id': self.tournament_id_2})['players'])
+        self.assertEquals(self._get_head_to_head(self.player_1_id, self.player_2_id),
+                          (2, 0, 0, self.tournament_date_1))
+        self.assertEquals(self._get_player_stats(self.player_1_id), (2, 0, 2, self.tournament_date_1))
+
+        # compacted tournaments are recorded on the merge, and rewritten back
+        the_merge = self.norcal_dao.get_merge(the_merge.id)
+        self.assertEquals(the_merge.rewritten_tournaments, [self.tournament_id_2])
+        self.assertEquals(the_merge.aliases_added, ['pewpewu'])
+        self.assertEquals(the_merge.regions_added, ['socal'])
+        self.norcal_dao.undo_merge(the_merge)
+        player_1 = self.norcal_dao.get_player_by_id(self.player_1_id)
+        self.assertEquals(player_1.aliases, self.player_1.aliases)
+        self.assertEquals(player_1.regions, self.player_1.regions)
+        self.assertTrue(self.player_5_id in
+                        self.norcal_dao.tournaments_col.find_one({'_id': self.tournament_id_2})['players'])
+        self.assertEquals(self._get_head_to_head(self.player_5_id, self.player_2_id),
+                          (1, 0, 0, self.tournament_date_2))
+        self.assertEquals(self._get_player_stats(self.player_1_id), (1, 0, 1, self.tournament_date_1))
+
+    def test_record_merge_provenance(self):
+        self.norcal_dao.insert_player(self.player_5)
+        the_merge = Merge(requester_user_id=self.user_id_1,
+                          source_player_obj_id=self.player_5_id,
+                          target_player_obj_id=self.player_1_id,
+                          time=datetime.today(),
+                          id=ObjectId())
+        self.norcal_dao.insert_merge(the_merge)
+        self.norcal_dao.compact_merges()
+
+        # a merge from before merges recorded what they rewrote
+        self.norcal_dao.merges_col.update_one({'_id': the_merge.id},
+                                              {'$unset': {'rewritten_tournaments': ''}})
+        self.assertEquals(self.norcal_dao.record_merge_provenance(), 1)
+        self.assertEquals(self.norcal_dao.record_merge_provenance(), 0)
+        self.assertEquals(self.norcal_dao.get_merge(the_merge.id).rewritten_tournaments,
+                          [self.tournament_id_2])
+
+    def _get_player_stats(self, player_id):
+        stats = self.norcal_dao.get_player_stats(player_id)
+        return stats and (stats.wins, stats.losses, stats.tournaments_attended, stats.last_active)
+
+    def test_rebuild_player_stats(self):
+        self.assertEquals(self.norcal_dao.rebuild_player_stats(), 5)
+
+        self.assertEquals(self._get_player_stats(self.player_2_id),
+                          (0, 2, 2, self.tournament_date_1))
+        self.assertEquals(self._get_player_stats(self.player_5_id),
+                          (1, 0, 1, self.tournament_date_2))
+
+        stats = self.norcal_dao.get_player_stats(self.player_1_id)
+        self.assertEquals([(e.time, e.rank) for e in stats.rating_history['norcal']],
+                          [(self.ranking_time_1, 1), (self.ranking_time_2, 1), (self.ranking_time_2, 1)])
+
+    def test_player_stats_follow_tournament_updates(self):
+        self._set_match_ids(self.tournament_1)
+        self._set_match_ids(self.tournament_2)
+        self.norcal_dao.rebuild_player_stats()
+
+        self.norcal_dao.swap_winner_loser_by_tournament_id_and_match_id(self.tournament_id_1, 0)
+        self.assertEquals(self._get_player_stats(self.player_1_id),
+                          (0, 1, 1, self.tournament_date_1))
+        self.assertEquals(self._get_player_stats(self.player_2_id),
+                          (1, 1, 2, self.tournament_date_1))
+
+        # p2 was last active at tournament 1
+        self.norcal_dao.delete_tournament(self.tournament_1)
+        self.assertEquals(self._get_player_stats(self.player_2_id),
+                          (0, 1, 1, self.tournament_date_2))
+        self.assertEquals(self._get_player_stats(self.player_1_id), (0, 0, 0, None))
+
+        self.norcal_dao.add_match_by_tournament_id(
+            self.tournament_id_2, self.player_1_id, self.player_5_id)
+        self.assertEquals(self._get_player_stats(self.player_1_id),
+                          (1, 0, 1, self.tournament_date_2))
+
     # TODO: add more tests for merging players
     # this is currently covered by test_get_and_insert_merge
     # def test_merge_players(self):
@@ -799,6 +1374,87 @@ class TestDAO(unittest.TestCase):
         self.assertEquals(rankings[1], self.ranking_entry_2)
         self.assertEquals(rankings[2], self.ranking_entry_4)
 
+    def _insert_ranking_series(self, num_rankings):
+        # players trade places every run, and one drops out every other run
+        rankings = []
+        for i in xrange(num_rankings):
+            players = [self.player_1_id, self.player_2_id, self.player_3_id]
+            if i % 2:
+                players.reverse()
+                players.pop()
+            ranking = Ranking(
+                id=ObjectId(),
+                region='texas',
+                time=datetime(2014, 1, 1 + i),
+                tournaments=self.tournament_ids[:1 + i % 2],
+                ranking=[RankingEntry(rank=rank, player=player, rating=10.0 - rank - i)
+                         for rank, player in enumerate(players, start=1)])
+            self.norcal_dao.insert_ranking(ranking)
+            rankings.append(ranking)
+        return rankings
+
+    def test_insert_ranking_delta_encoding(self):
+        rankings = self._insert_ranking_series(dao_module.RANKING_KEYFRAME_INTERVAL + 2)
+
+        docs = list(self.norcal_dao.rankings_col.find({'region': 'texas'}).sort('time', 1))
+        self.assertEquals([d['depth'] for d in docs],
+                          range(dao_module.RANKING_KEYFRAME_INTERVAL) + [0, 1])
+        self.assertEquals(len(docs[0]['ranking']), 3)
+        self.assertEquals(docs[1]['ranking'], [])
+        self.assertEquals(docs[1]['removed'], [self.player_1_id])
+        self.assertEquals(docs[1]['tournaments_added'], [self.tournament_id_2])
+        self.assertEquals(docs[2]['tournaments_removed'], [self.tournament_id_2])
+        self.assertEquals(docs[dao_module.RANKING_KEYFRAME_INTERVAL]['keyframe_id'],
+                          rankings[dao_module.RANKING_KEYFRAME_INTERVAL].id)
+
+        texas_dao = Dao('texas', self.mongo_client, database_name=DATABASE_NAME)
+        latest = texas_dao.get_latest_ranking()
+        self.assertEquals(latest.ranking, rankings[-1].ranking)
+        self.assertEquals(latest.tournaments, rankings[-1].tournaments)
+
+        history = texas_dao.get_ranking_history()
+        self.assertEquals([r.ranking for r in history], [r.ranking for r in rankings])
+        self.assertEquals([r.tournaments for r in history], [r.tournaments for r in rankings])
+
+    def test_get_ranking_history_window(self):
+        rankings = self._insert_ranking_series(8)
+        texas_dao = Dao('texas', self.mongo_client, database_name=DATABASE_NAME)
+
+        history = texas_dao.get_ranking_history(since=datetime(2014, 1, 4), until=datetime(2014, 1, 6))
+        self.assertEquals([r.id for r in history], [r.id for r in rankings[3:6]])
+        self.assertEquals([r.ranking for r in history], [r.ranking for r in rankings[3:6]])
+
+        history = texas_dao.get_ranking_history(limit=2)
+        self.assertEquals([r.ranking for r in history], [r.ranking for r in rankings[-2:]])
+
+    def test_get_ranking_history_with_previous(self):
+        interval = dao_module.RANKING_KEYFRAME_INTERVAL
+        rankings = self._insert_ranking_series(interval + 2)
+        texas_dao = Dao('texas', self.mongo_client, database_name=DATABASE_NAME)
+
+        # the one before is a change
+        previous, history = texas_dao.get_ranking_history(
+            since=datetime(2014, 1, 4), until=datetime(2014, 1, 6), with_previous=True)
+        self.assertEquals(previous.id, rankings[2].id)
+        self.assertEquals(previous.ranking, rankings[2].ranking)
+        self.assertEquals([r.id for r in history], [r.id for r in rankings[3:6]])
+
+        # the window starts at a full ranking, the one before ends the last run
+        previous, history = texas_dao.get_ranking_history(
+            since=datetime(2014, 1, 1 + interval), with_previous=True)
+        self.assertEquals(previous.id, rankings[interval - 1].id)
+        self.assertEquals(previous.ranking, rankings[interval - 1].ranking)
+        self.assertEquals([r.id for r in history], [r.id for r in rankings[interval:]])
+
+        previous, history = texas_dao.get_ranking_history(limit=2, with_previous=True)
+        self.assertEquals(previous.ranking, rankings[-3].ranking)
+
+        # nothing before the first one
+        previous, history = texas_dao.get_ranking_history(
+            until=datetime(2014, 1, 1), with_previous=True)
+        self.assertIsNone(previous)
+        self.assertEquals([r.id for r in history], [rankings[0].id])
+
     def test_get_all_users(self):
         users = self.norcal_dao.get_all_users()
         self.assertEquals(len(users), 3)
@@ -869,6 +1525,72 @@ class TestDAO(unittest.TestCase):
         self.assertNotEquals(old_salt, new_salt)
         self.assertTrue(verify_password(new_password, new_salt, new_hash))
 
+    def test_get_user_by_session_id(self):
+        user = self.norcal_dao.get_all_users()[0]
+        self.norcal_dao.update_session_id_for_user(user.id, 'token')
+
+        self.assertEquals(self.norcal_dao.get_user_by_session_id_or_none('token'), user)
+        self.assertIsNone(self.norcal_dao.get_user_by_session_id_or_none('other token'))
+        self.assertIsNone(self.norcal_dao.get_user_by_session_id_or_none(None))
+
+        # one session per user
+        self.norcal_dao.update_session_id_for_user(user.id, 'new token')
+        self.assertIsNone(self.norcal_dao.get_user_by_session_id_or_none('token'))
+        self.assertEquals(self.norcal_dao.get_user_by_session_id_or_none('new token'), user)
+
+    def test_session_expiry(self):
+        user = self.norcal_dao.get_all_users()[0]
+        self.norcal_dao.update_session_id_for_user(user.id, 'token')
+        sessions_col = self.norcal_dao.sessions_col
+        query = {'token_hash': hash_session_token('token')}
+
+        # recently seen sessions aren't written to
+        last_seen = sessions_col.find_one(query)['last_seen'] - timedelta(minutes=1)
+        sessions_col.update_one(query, {'$set': {'last_seen': last_seen}})
+        self.assertEquals(self.norcal_dao.get_user_by_session_id_or_none('token'), user)
+        self.assertEquals(sessions_col.find_one(query)['last_seen'], last_seen)
+
+        # the rest are kept alive
+        last_seen = datetime.utcnow() - dao_module.SESSION_TTL + timedelta(hours=1)
+        sessions_col.update_one(query, {'$set': {'last_seen': last_seen}})
+        self.assertEquals(self.norcal_dao.get_user_by_session_id_or_none('token'), user)
+        self.assertTrue(sessions_col.find_one(query)['last_seen'] > last_seen)
+
+        last_seen = datetime.utcnow() - dao_module.SESSION_TTL - timedelta(hours=1)
+        sessions_col.update_one(query, {'$set': {'last_seen': last_seen}})
+        self.assertIsNone(self.norcal_dao.get_user_by_session_id_or_none('token'))
+
+    def test_hash_session_ids(self):
+        user = self.norcal_dao.get_all_users()[0]
+        self.norcal_dao.sessions_col.insert({'session_id': 'token', 'user_id': user.id})
+
+        self.assertEquals(self.norcal_dao.hash_session_ids(), 1)
+        self.assertEquals(self.norcal_dao.hash_session_ids(), 0)
+        self.assertEquals(self.norcal_dao.get_user_by_session_id_or_none('token'), user)
+
+    def test_ensure_indexes_hashes_session_ids(self):
+        user = self.norcal_dao.get_all_users()[0]
+        self.norcal_dao.sessions_col.insert_many([
+            {'session_id': 'token', 'user_id': user.id},
+            {'session_id': 'other token', 'user_id': user.id}])
+
+        Dao.ensure_indexes(self.mongo_client, database_name=DATABASE_NAME)
+        self.assertEquals(self.norcal_dao.get_user_by_session_id_or_none('token'), user)
+        self.assertEquals(self.norcal_dao.get_user_by_session_id_or_none('other token'), user)
+
+    def test_ensure_indexes_versions_merge_forest(self):
+        Dao.ensure_indexes(self.mongo_client, database_name=DATABASE_NAME)
+        forest = self.norcal_dao.get_merge_forest()
+
+        # another request (with its own dao) gets the cached forest
+        dao = Dao('norcal', self.mongo_client, database_name=DATABASE_NAME)
+        self.assertIs(dao.get_merge_forest(), forest)
+
+        # and running it again keeps the version
+        Dao.ensure_indexes(self.mongo_client, database_name=DATABASE_NAME)
+        dao = Dao('norcal', self.mongo_client, database_name=DATABASE_NAME)
+        self.assertIs(dao.get_merge_forest(), forest)
+
     def test_get_and_insert_merge(self):
         dao = self.norcal_dao
         dao.insert_player(self.merge_player_1)
@@ -919,6 +1641,25 @@ class TestDAO(unittest.TestCase):
         self.assertTrue(
             abs(the_merge.time - the_merge_redux.time).total_seconds() < 1)
 
+    def test_get_merges_page(self):
+        # two merges at the same time, so the page boundary falls on a tie
+        times = [datetime(2013, 10, 16), datetime(2013, 10, 17), datetime(2013, 10, 17)]
+        merge_ids = []
+        for time in times:
+            merge = Merge(requester_user_id='user',
+                          source_player_obj_id=self.player_1_id,
+                          target_player_obj_id=self.player_2_id,
+                          time=time,
+                          id=ObjectId())
+            self.norcal_dao.merges_col.insert(merge.dump(context='db'))
+            merge_ids.append(merge.id)
+
+        page, cursor = self.norcal_dao.get_merges_page(2)
+        self.assertEqual([m.id for m in page], merge_ids[:2])
+        page, cursor = self.norcal_dao.get_merges_page(2, after=cursor)
+        self.assertEqual([m.id for m in page], merge_ids[2:])
+        self.assertIsNone(cursor)
+
     def test_get_and_undo_merge(self):
         dao = self.norcal_dao
         dao.insert_player(self.merge_player_1)
@@ -0,0 +1,91 @@
+import unittest
+import mongomock
+
+from bson.objectid import ObjectId
+from mock import patch
+
+import import_service
+
+from dao import Dao
+from model import Player, Rating, Region, RawFile
+
+NORCAL_FILES = [('test/data/norcal1.tio', 'Singles'), ('test/data/norcal2.tio', 'Singles Pro Bracket')]
+
+
+def _tio_item(path, bracket):
+    with open(path) as f:
+        return {'type': 'tio', 'data': f.read(), 'bracket': bracket, 'source': path}
+
+
+class TestImportService(unittest.TestCase):
+    def setUp(self):
+        self.mongo_client = mongomock.MongoClient()
+        Dao.insert_region(Region(id='norcal', display_name='Norcal'), self.mongo_client)
+        self.dao = Dao('norcal', mongo_client=self.mongo_client)
+
+        self.sfat = Player(
+                name='sfat',
+                aliases=['sfat', 'miom|sfat'],
+                ratings={'norcal': Rating()},
+                regions=['norcal'],
+                id=ObjectId())
+        self.dao.insert_player(self.sfat)
+
+        self.items = [_tio_item(path, bracket) for path, bracket in NORCAL_FILES]
+
+    def test_import_tournaments(self):
+        report = import_service.import_tournaments(self.dao, self.items, num_workers=2)
+
+        self.assertEquals(len(report), 2)
+        for i, r in enumerate(report):
+            self.assertEquals(r['index'], i)
+            self.assertEquals(r['status'], import_service.STATUS_SUCCESS)
+            self.assertEquals(r['source'], NORCAL_FILES[i][0])
+
+            pending_tournament = self.dao.get_pending_tournament_by_id(ObjectId(r['id']))
+            self.assertIsNotNone(pending_tournament)
+            self.assertEquals(pending_tournament.name, r['name'])
+            self.assertEquals(len(pending_tournament.alias_to_id_map), r['num_players'])
+            self.assertEquals(set(pending_tournament.players),
+                              {m.player_alias for m in pending_tournament.alias_to_id_map})
+
+            raw_file = RawFile.load(self.dao.raw_files_col.find_one(
+                {'_id': pending_tournament.raw_id}), context='db')
+            self.assertIsNotNone(raw_file)
+
+        sfat_mappings = [m for m in self.dao.get_pending_tournament_by_id(
+                            ObjectId(report[0]['id'])).alias_to_id_map
+                         if m.player_alias == 'MIOM|SFAT']
+        self.assertEquals(sfat_mappings[0].player_id, self.sfat.id)
+
+    def test_import_tournaments_resolves_aliases_once(self):
+        with patch.object(self.dao, 'get_players_with_similar_aliases',
+                          wraps=self.dao.get_players_with_similar_aliases) as mock_lookup:
+            import_service.import_tournaments(self.dao, self.items)
+            self.assertEquals(mock_lookup.call_count, 1)
+
+    def test_import_tournaments_reports_errors(self):
+        self.items.insert(1, _tio_item(NORCAL_FILES[0][0], 'not a bracket'))
+        self.items.append({'type': 'unknown', 'data': 'data'})
+
+        report = import_service.import_tournaments(self.dao, self.items)
+
+        self.assertEquals([r['status'] for r in report],
+                          [import_service.STATUS_SUCCESS, import_service.STATUS_ERROR,
+                           import_service.STATUS_SUCCESS, import_service.STATUS_ERROR])
+        self.assertTrue('not a bracket' in report[1]['error'])
+        self.assertEquals(report[3]['source'], 'data')
+        self.assertEquals(len(self.dao.get_all_pending_tournaments()), 2)
+
+    def test_import_tournaments_empty(self):
+        self.assertEquals(import_service.import_tournaments(self.dao, []), [])
+
+    def test_get_scraper_tio_missing_bracket(self):
+        with self.assertRaises(ValueError):
+            import_service.get_scraper('tio', 'data')
+
+    @patch('import_service.ChallongeScraper')
+    def test_get_scraper_challonge_url(self, mock_challonge_scraper):
+        mock_challonge_scraper.get_tournament_id_from_url.return_value = 'sub-bracket'
+        import_service.get_scraper('challonge', 'http://sub.challonge.com/bracket')
+        mock_challonge_scraper.assert_called_once_with('sub-bracket')
@@ -0,0 +1,36 @@
+import unittest
+
+from bson.objectid import ObjectId
+
+from merge_forest import MergeForest, MergeForestCache
+
+
+class TestMergeForest(unittest.TestCase):
+    def setUp(self):
+        self.a, self.b, self.c, self.d = [ObjectId() for _ in xrange(4)]
+        # c was merged into b, then b into a
+        self.forest = MergeForest({self.c: self.b, self.b: self.a})
+
+    def test_find(self):
+        self.assertEquals(self.forest.find(self.c), self.a)
+        self.assertEquals(self.forest.find(self.b), self.a)
+        self.assertEquals(self.forest.find(self.a), self.a)
+        self.assertEquals(self.forest.find(self.d), self.d)
+        # c's path was compressed
+        self.assertEquals(self.forest.parents[self.c], self.a)
+
+    def test_members(self):
+        self.assertEquals(self.forest.members(self.a), set([self.a, self.b, self.c]))
+        self.assertEquals(self.forest.members(self.b), set())
+        self.assertEquals(self.forest.members(self.d), set([self.d]))
+
+    def test_cache(self):
+        cache = MergeForestCache()
+        cache.put('db', 'v1', self.forest)
+        self.assertIs(cache.get('db', 'v1'), self.forest)
+        self.assertIsNone(cache.get('db', 'v2'))
+        self.assertIsNone(cache.get('other_db', 'v1'))
+
+        # unversioned forests aren't cached
+        cache.put('db', None, MergeForest())
+        self.assertIsNone(cache.get('db', None))
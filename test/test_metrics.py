@@ -0,0 +1,127 @@
+import unittest
+
+from datetime import timedelta
+from flask import Flask, Response, jsonify
+from pymongo import monitoring
+
+import metrics
+
+from model import Player
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        metrics.registry.reset()
+
+        self.listener = metrics.MongoCommandListener()
+        self.player = Player.create_with_default_values('gar', 'norcal')
+
+        app = Flask(__name__)
+        metrics.init_app(app, server_timing=True)
+
+        @app.route('/<string:region>/players')
+        def players(region):
+            # stands in for two mongo queries
+            for _ in xrange(2):
+                self.listener.succeeded(monitoring.CommandSucceededEvent(
+                    timedelta(milliseconds=2), {'ok': 1}, 'find', 1, ('localhost', 27017), 1))
+            player = Player.load(self.player.dump(context='db'), context='db')
+            return jsonify(player.dump(context='web'))
+
+        @app.route('/<string:region>/players:stream')
+        def players_stream(region):
+            def generate():
+                # stands in for a mongo query per batch of players
+                for _ in xrange(3):
+                    self.listener.succeeded(monitoring.CommandSucceededEvent(
+                        timedelta(milliseconds=2), {'ok': 1}, 'getMore', 1,
+                        ('localhost', 27017), 1))
+                    yield 'players\n'
+            return Response(generate())
+
+        @app.route('/<string:region>/broken')
+        def broken(region):
+            raise ValueError('broken')
+
+        self.app = app.test_client()
+
+    def get_metrics_lines(self):
+        return self.app.get('/metrics').data.splitlines()
+
+    def test_server_timing(self):
+        response = self.app.get('/norcal/players')
+        self.assertEquals(response.status_code, 200)
+
+        server_timing = response.headers['Server-Timing']
+        self.assertTrue(server_timing.startswith('total;dur='))
+        self.assertTrue('mongo;dur=4.0;desc="2 commands"' in server_timing)
+        self.assertTrue('orm-load;dur=' in server_timing)
+        self.assertTrue('orm-dump;dur=' in server_timing)
+
+    def test_metrics(self):
+        # like a wsgi server, buffered responses are closed once read, which
+        # is when their metrics are recorded
+        self.app.get('/norcal/players', buffered=True)
+        self.app.get('/texas/players', buffered=True)
+        self.app.get('/not/a/route', buffered=True)
+
+        response = self.app.get('/metrics')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.headers['Content-Type'], metrics.METRICS_CONTENT_TYPE)
+
+        lines = response.data.splitlines()
+        route_labels = 'method="GET",route="/<string:region>/players"'
+        self.assertTrue('garpr_requests_total{' + route_labels + ',status="200"} 2' in lines)
+        self.assertTrue('garpr_requests_total{method="GET",route="unmatched",status="404"} 1' in lines)
+        self.assertTrue('garpr_request_duration_seconds_count{' + route_labels + '} 2' in lines)
+        self.assertTrue('garpr_request_duration_seconds_bucket{' + route_labels + ',le="+Inf"} 2' in lines)
+        self.assertTrue('garpr_mongo_commands_total{' + route_labels + '} 4' in lines)
+        self.assertTrue('garpr_mongo_seconds_total{' + route_labels + '} 0.008' in lines)
+
+    def test_metrics_streamed_response(self):
+        response = self.app.get('/norcal/players:stream', buffered=True)
+        self.assertEquals(response.data, 'players\n' * 3)
+
+        route_labels = 'method="GET",route="/<string:region>/players:stream"'
+        lines = self.get_metrics_lines()
+        self.assertTrue('garpr_requests_total{' + route_labels + ',status="200"} 1' in lines)
+        self.assertTrue('garpr_mongo_commands_total{' + route_labels + '} 3' in lines)
+
+    def test_metrics_unhandled_exception(self):
+        response = self.app.get('/norcal/broken', buffered=True)
+        self.assertEquals(response.status_code, 500)
+
+        route_labels = 'method="GET",route="/<string:region>/broken"'
+        lines = self.get_metrics_lines()
+        self.assertTrue('garpr_requests_total{' + route_labels + ',status="500"} 1' in lines)
+
+    def test_listener_outside_request(self):
+        # commands sent outside of a request (e.g. by scripts) are ignored
+        self.listener.succeeded(monitoring.CommandSucceededEvent(
+            timedelta(milliseconds=2), {'ok': 1}, 'find', 1, ('localhost', 27017), 1))
+
+    def test_orm_nested_documents_timed_once(self):
+        stats = metrics.RequestStats()
+        metrics._local.stats = stats
+        try:
+            self.player.dump(context='db')
+            self.assertEquals(stats.orm_depth, 0)
+            self.assertTrue(stats.orm_dump_seconds > 0)
+        finally:
+            metrics._local.stats = None
+
+    def test_record_password_hash(self):
+        stats = metrics.RequestStats()
+        metrics._local.stats = stats
+        try:
+            metrics.record_password_hash(0.25)
+            self.assertEquals(stats.password_hashes, 1)
+            self.assertEquals(stats.password_hash_seconds, 0.25)
+        finally:
+            metrics._local.stats = None
+
+        metrics.registry.record('PUT', '/users/session', 200, 0.3, stats)
+        lines = metrics.registry.render().splitlines()
+        route_labels = 'method="PUT",route="/users/session"'
+        self.assertTrue('garpr_password_hashes_total{' + route_labels + '} 1' in lines)
+        self.assertTrue('garpr_password_hash_seconds_total{' + route_labels + '} 0.25' in lines)
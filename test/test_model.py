@@ -1,3 +1,4 @@
+import json
 import mock
 import unittest
 import trueskill
@@ -6,7 +7,8 @@ from bson.objectid import ObjectId
 from datetime import datetime
 
 from model import AliasMapping, AliasMatch, Match, Player, PendingTournament, \
-                 Ranking, RankingEntry, Rating, Region, Tournament, User
+                 Ranking, RankingEntry, Rating, Region, Tournament, User, \
+                 RAW_JSON_PIECE_SIZE, iter_raw_json
 
 from scraper.challonge import ChallongeScraper
 
@@ -230,7 +232,8 @@ class TestTournament(unittest.TestCase):
             'orig_ids': self.player_ids,
             'matches': [m.dump(context='db') for m in self.matches],
             'regions': self.regions,
-            'excluded': self.excluded
+            'excluded': self.excluded,
+            'version': None
         }
         self.tournament = Tournament(
             id=self.id,
@@ -423,7 +426,8 @@ class TestPendingTournament(unittest.TestCase):
             'regions': self.regions,
             'alias_to_id_map': [am.dump(context='db') for am in self.alias_to_id_map],
             'excluded':False,
-            'url': self.url
+            'url': self.url,
+            'new_player_ids': []
         }
         self.pending_tournament = PendingTournament(
             id=self.id,
@@ -498,9 +502,12 @@ class TestPendingTournament(unittest.TestCase):
         mock_scraper.get_name.return_value = self.name
         mock_scraper.get_url.return_value = ''
 
-        pending_tournament, _ = PendingTournament.from_scraper(
+        pending_tournament, raw_file = PendingTournament.from_scraper(
             self.type, mock_scraper, 'norcal')
 
+        self.assertIsNone(raw_file.data)
+        self.assertEqual(''.join(raw_file.data_pieces), '""')
+        self.assertEqual(pending_tournament.raw_id, raw_file.id)
         self.assertEqual(pending_tournament.type, self.type)
         self.assertEqual(pending_tournament.date, self.date)
         self.assertEqual(pending_tournament.name, self.name)
@@ -509,6 +516,19 @@ class TestPendingTournament(unittest.TestCase):
         self.assertEqual(pending_tournament.regions, ['norcal'])
 
 
+    def test_iter_raw_json(self):
+        raw = u'<Name>Mang\xf8</Name>\n' * (RAW_JSON_PIECE_SIZE / 10)
+        self.assertEqual(''.join(iter_raw_json(raw.encode('utf-8'))), json.dumps(raw))
+        self.assertEqual(''.join(iter_raw_json(raw)), json.dumps(raw))
+        self.assertEqual(''.join(iter_raw_json({'participants': [raw]})),
+                         json.dumps({'participants': [raw]}))
+
+    def test_iter_raw_json_not_utf8(self):
+        # .tio files saved in a windows code page
+        raw = u'<Name>Mang\xf8</Name>'
+        self.assertEqual(''.join(iter_raw_json(raw.encode('latin-1'))), json.dumps(raw))
+
+
 class TestRanking(unittest.TestCase):
 
     def setUp(self):
@@ -587,16 +607,19 @@ class TestRegion(unittest.TestCase):
         self.ranking_num_tourneys_attended=2
         self.ranking_activity_day_limit=60
         self.tournament_qualified_day_limit=999
+        self.rating_engine='glicko2'
         self.region = Region(id=self.id, display_name=self.display_name,
                              ranking_num_tourneys_attended=self.ranking_num_tourneys_attended,
                              ranking_activity_day_limit=self.ranking_activity_day_limit,
-                             tournament_qualified_day_limit=self.tournament_qualified_day_limit)
+                             tournament_qualified_day_limit=self.tournament_qualified_day_limit,
+                             rating_engine=self.rating_engine)
         self.region_json_dict = {
             '_id': self.id,
             'display_name': self.display_name,
             'ranking_num_tourneys_attended': self.ranking_num_tourneys_attended,
             'ranking_activity_day_limit': self.ranking_activity_day_limit,
-            'tournament_qualified_day_limit': self.tournament_qualified_day_limit
+            'tournament_qualified_day_limit': self.tournament_qualified_day_limit,
+            'rating_engine': self.rating_engine
         }
 
     def test_dump(self):
@@ -606,6 +629,16 @@ class TestRegion(unittest.TestCase):
         region = Region.load(self.region_json_dict, context='db')
         self.assertEqual(region.id, self.id)
         self.assertEqual(region.display_name, self.display_name)
+        self.assertEqual(region.rating_engine, self.rating_engine)
+
+    def test_load_defaults_rating_engine(self):
+        del self.region_json_dict['rating_engine']
+        region = Region.load(self.region_json_dict, context='db')
+        self.assertEqual(region.rating_engine, 'trueskill')
+
+    def test_validate_rating_engine(self):
+        self.region.rating_engine = 'coin flip'
+        self.assertFalse(self.region.validate()[0])
 
 
 class TestUser(unittest.TestCase):
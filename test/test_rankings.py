@@ -186,6 +186,34 @@ class TestRankings(unittest.TestCase):
         self.assertAlmostEquals(entry.rating, -1.349, delta=delta)
         '''
 
+    def test_generate_rankings_player_stats(self):
+        now = datetime(2013, 10, 17)
+
+        rankings.generate_ranking(self.dao, now=now, day_limit=30, num_tourneys=1)
+
+        stats = self.dao.get_player_stats(self.player_1_id)
+        self.assertEquals(len(stats.rating_history['norcal']), 1)
+        entry = stats.rating_history['norcal'][0]
+        self.assertEquals(entry.time, now)
+        self.assertEquals(entry.rank, 2)
+        self.assertAlmostEquals(entry.rating, 6.857, delta=delta)
+
+        self.assertEquals(len(stats.best_wins['norcal']), 1)
+        best_win = stats.best_wins['norcal'][0]
+        self.assertEquals(best_win.opponent, self.player_2_id)
+        self.assertAlmostEquals(best_win.rating, -1.349, delta=delta)
+        self.assertEquals(best_win.tournament, self.tournament_id_1)
+        self.assertEquals(best_win.date, self.tournament_date_1)
+
+        stats = self.dao.get_player_stats(self.player_2_id)
+        self.assertEquals(stats.best_wins['norcal'], [])
+
+        # another run adds to the history
+        rankings.generate_ranking(self.dao, now=datetime(2013, 10, 18), day_limit=30, num_tourneys=1)
+        stats = self.dao.get_player_stats(self.player_1_id)
+        self.assertEquals([e.time for e in stats.rating_history['norcal']],
+                          [now, datetime(2013, 10, 18)])
+
     # players that only played in the first tournament will be excluded for inactivity
     def test_generate_rankings_excluded_for_inactivity(self):
         now = datetime(2013, 11, 25)
@@ -213,3 +241,46 @@ class TestRankings(unittest.TestCase):
         self.assertEquals(entry.rank, 2)
         self.assertEquals(entry.player, self.player_2_id)
         self.assertAlmostEquals(entry.rating, -1.349, delta=delta)
+
+    def test_generate_rankings_rating_engine(self):
+        now = datetime(2013, 10, 17)
+
+        rankings.generate_ranking(self.dao, now=now, day_limit=30, num_tourneys=1,
+                                  rating_engine='glicko2')
+
+        # ratings are stored on the glicko scale (rating and deviation)
+        rating = self.dao.get_player_by_id(self.player_1_id).ratings['norcal']
+        self.assertTrue(rating.mu > 1500)
+        self.assertTrue(rating.sigma < 350)
+        self.assertEquals(self.dao.get_player_by_id(self.player_1_id).ratings['texas'],
+                          self.player_1.ratings['texas'])
+
+        ranking = self.dao.get_latest_ranking()
+        self.assertEquals(len(ranking.ranking), 3)
+        self.assertEquals(ranking.ranking[-1].player, self.player_2_id)
+        ratings = [entry.rating for entry in ranking.ranking]
+        self.assertEquals(ratings, sorted(ratings, reverse=True))
+
+    def test_simulate_rankings(self):
+        now = datetime(2013, 11, 25)
+        criteria_sets = [
+            {'ranking_activity_day_limit': 30, 'ranking_num_tourneys_attended': 1,
+             'tournament_qualified_day_limit': 999},
+            {'ranking_activity_day_limit': 45, 'ranking_num_tourneys_attended': 1,
+             'tournament_qualified_day_limit': 999},
+            {'ranking_activity_day_limit': 999, 'ranking_num_tourneys_attended': 2,
+             'tournament_qualified_day_limit': 999}]
+
+        with patch('rankings.replay_ratings', wraps=rankings.replay_ratings) as mock_replay:
+            ranking_lists = rankings.simulate_rankings(self.dao, criteria_sets, now=now)
+            # the criteria share the same rating pass
+            self.assertEquals(mock_replay.call_count, 1)
+
+        self.assertEquals(ranking_lists[0], [])
+        self.assertEquals([e.player for e in ranking_lists[1]], [self.player_1_id, self.player_2_id])
+        self.assertAlmostEquals(ranking_lists[1][0].rating, 6.857, delta=delta)
+        self.assertEquals([e.player for e in ranking_lists[2]], [self.player_2_id])
+
+        # nothing is written
+        self.assertIsNone(self.dao.get_latest_ranking())
+        self.assertEquals(self.dao.get_player_by_id(self.player_1_id).ratings, self.player_1.ratings)
@@ -28,3 +28,53 @@ class TestRatingCalculators(unittest.TestCase):
 
         self.assertTrue(self.player_2.ratings[self.region_id].mu < 25)
         self.assertTrue(self.player_2.ratings['socal'].mu == 25)
+
+    def test_trueskill_engine(self):
+        engine = rating_calculators.get_rating_engine('trueskill')
+        ratings = {self.player_1_id: engine.initial_rating(),
+                   self.player_2_id: engine.initial_rating()}
+        engine.rate_period(ratings, [(self.player_1_id, self.player_2_id)])
+
+        rating_calculators.update_trueskill_ratings(self.region_id, winner=self.player_1, loser=self.player_2)
+        self.assertEquals(engine.to_rating(ratings[self.player_1_id]), self.player_1.ratings[self.region_id])
+        self.assertEquals(engine.to_rating(ratings[self.player_2_id]), self.player_2.ratings[self.region_id])
+        self.assertTrue(engine.win_probability(ratings[self.player_1_id], ratings[self.player_2_id]) > .5)
+
+    def test_elo_engine(self):
+        engine = rating_calculators.get_rating_engine('elo')
+        ratings = {self.player_1_id: engine.initial_rating(),
+                   self.player_2_id: engine.initial_rating()}
+        engine.rate_period(ratings, [(self.player_1_id, self.player_2_id)])
+
+        self.assertAlmostEquals(ratings[self.player_1_id], 1516., delta=.001)
+        self.assertAlmostEquals(ratings[self.player_2_id], 1484., delta=.001)
+        self.assertAlmostEquals(engine.win_probability(1500., 1500.), .5, delta=.001)
+        self.assertEquals(engine.to_rating(ratings[self.player_1_id]), Rating(mu=1516., sigma=0.))
+
+    def test_glicko2_engine(self):
+        # the example from the glicko-2 paper
+        engine = rating_calculators.get_rating_engine('glicko2')
+        scale = rating_calculators.GLICKO2_SCALE
+        player_id, opponent_1_id, opponent_2_id, opponent_3_id, absent_id = \
+            [ObjectId() for _ in xrange(5)]
+        ratings = {player_id: (0., 200. / scale, .06),
+                   opponent_1_id: (-100. / scale, 30. / scale, .06),
+                   opponent_2_id: (50. / scale, 100. / scale, .06),
+                   opponent_3_id: (200. / scale, 300. / scale, .06),
+                   absent_id: engine.initial_rating()}
+        engine.rate_period(ratings, [(player_id, opponent_1_id),
+                                     (opponent_2_id, player_id),
+                                     (opponent_3_id, player_id)])
+
+        rating = engine.to_rating(ratings[player_id])
+        self.assertAlmostEquals(rating.mu, 1464.06, delta=.01)
+        self.assertAlmostEquals(rating.sigma, 151.52, delta=.01)
+        self.assertAlmostEquals(ratings[player_id][2], .05999, delta=.00001)
+
+        # players who sit out a period get less certain
+        self.assertEquals(ratings[absent_id][0], 0.)
+        self.assertTrue(ratings[absent_id][1] > engine.initial_rating()[1])
+
+    def test_get_rating_engine_unknown(self):
+        with self.assertRaises(ValueError):
+            rating_calculators.get_rating_engine('coin flip')
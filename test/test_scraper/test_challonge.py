@@ -91,3 +91,11 @@ class TestChallongeScraper(unittest.TestCase):
         self.assertEquals(len(players), 41)
         self.assertTrue('Shroomed' in players)
         self.assertTrue('MIOM | SFAT' in players)
+
+    def test_get_tournament_id_from_url(self):
+        self.assertEquals(ChallongeScraper.get_tournament_id_from_url(
+            'http://challonge.com/bracket'), 'bracket')
+        self.assertEquals(ChallongeScraper.get_tournament_id_from_url(
+            'www.challonge.com/bracket'), 'bracket')
+        self.assertEquals(ChallongeScraper.get_tournament_id_from_url(
+            'https://sub.challonge.com/bracket/'), 'sub-bracket')
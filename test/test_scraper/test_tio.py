@@ -1,6 +1,8 @@
 import unittest
+from scraper import tio
 from scraper.tio import TioScraper
 from datetime import datetime
+from mock import patch
 from model import AliasMatch
 
 # SFAT and Silentwolf have spaces before and after
@@ -67,3 +69,26 @@ class TestTioScraper(unittest.TestCase):
         self.assertEquals(len(players), 59)
         self.assertTrue('MIOM|SFAT' in players)
         self.assertTrue('GC|silent wolf' in players)
+
+    def test_get_matches_other_bracket(self):
+        self.scraper = TioScraper.from_file('test/data/norcal2.tio', 'Singles Am Bracket')
+        matches = self.scraper.get_matches()
+        self.assertEquals(len(matches), 31)
+        self.assertEquals(self.scraper.get_name(), 'BAM: 4 stocks is not a lead')
+
+    def test_get_raw_unicode(self):
+        with open(FILEPATH) as f:
+            text = f.read().decode('utf-8')
+        self.scraper = TioScraper(text, BRACKET_NAME)
+        self.assertEquals(self.scraper.get_name(), 'BAM: i got 5 on it')
+        self.assertEquals(len(self.scraper.get_matches()), 117)
+
+    def test_parses_file_once(self):
+        with patch('scraper.tio.etree.iterparse', wraps=tio.etree.iterparse) as mock_iterparse:
+            self.scraper.get_name()
+            self.scraper.get_date()
+            self.scraper.get_matches()
+            self.scraper.get_players()
+            self.scraper.get_matches()
+
+            self.assertEquals(mock_iterparse.call_count, 1)
@@ -12,10 +12,11 @@ from bson.objectid import ObjectId
 from datetime import datetime
 from mock import patch, Mock
 
+import credentials
 import rankings
 import server
 
-from dao import Dao, DATABASE_NAME, ITERATION_COUNT
+from dao import ConcurrentUpdateException, Dao, DATABASE_NAME, ITERATION_COUNT, hash_session_token
 from scraper.tio import TioScraper
 from model import AliasMapping, AliasMatch, Match, Merge, Player, PendingTournament, \
                  Ranking, RankingEntry, Rating, Region, Tournament, User, Session
@@ -73,6 +74,9 @@ class TestServer(unittest.TestCase):
             scraper = TioScraper.from_file(f[0], f[1])
             norcal_dao.insert_pending_tournament(PendingTournament.from_scraper('tio', scraper, norcal_dao.region_id)[0])
 
+        norcal_dao.rebuild_head_to_head()
+        norcal_dao.rebuild_player_stats()
+
         now = datetime(2014, 11, 1)
         rankings.generate_ranking(norcal_dao, now=now)
         rankings.generate_ranking(texas_dao, now=now)
@@ -131,6 +135,8 @@ class TestServer(unittest.TestCase):
 
         server.app.config['TESTING'] = True
         self.app = server.app.test_client()
+        credentials.ip_throttle.reset()
+        credentials.username_throttle.reset()
 
         self.norcal_region = Region(id='norcal', display_name='Norcal')
         self.texas_region = Region(id='texas', display_name='Texas')
@@ -200,11 +206,13 @@ class TestServer(unittest.TestCase):
                     {'id': 'norcal', 'display_name': 'Norcal',
                         'ranking_num_tourneys_attended': 2,
                         'ranking_activity_day_limit': 60,
-                        'tournament_qualified_day_limit': 999},
+                        'tournament_qualified_day_limit': 999,
+                        'rating_engine': 'trueskill'},
                     {'id': 'texas', 'display_name': 'Texas',
                         'ranking_num_tourneys_attended': 2,
                         'ranking_activity_day_limit': 60,
-                        'tournament_qualified_day_limit': 999}
+                        'tournament_qualified_day_limit': 999,
+                        'rating_engine': 'trueskill'}
                 ]
         }
 
@@ -308,6 +316,91 @@ class TestServer(unittest.TestCase):
         json_player = json_data['players'][0]
         self.assertEquals(json_player['name'], 'CT Denti')
 
+    def test_get_player_list_all_etag(self):
+        rv = self.app.get('/norcal/players?all=true')
+        json_data = json.loads(rv.data)
+        self.assertEquals(len(json_data['players']),
+                          len(self.norcal_dao.get_all_players(all_regions=True)))
+        self.assertEquals(json_data['change_stamp'], self.norcal_dao.get_player_change_stamp())
+        etag = rv.headers['ETag']
+
+        # nothing changed
+        rv = self.app.get('/norcal/players?all=true', headers={'If-None-Match': etag})
+        self.assertEquals(rv.status_code, 304)
+        self.assertEquals(rv.data, '')
+
+        # compressed, the etag is weak
+        rv = self.app.get('/norcal/players?all=true', headers={'Accept-Encoding': 'gzip'})
+        self.assertEquals(rv.headers['Content-Encoding'], 'gzip')
+        rv = self.app.get('/norcal/players?all=true', headers={'If-None-Match': rv.headers['ETag']})
+        self.assertEquals(rv.status_code, 304)
+
+        player = self.norcal_dao.get_player_by_alias('gar')
+        player.name = 'garr'
+        self.norcal_dao.update_player(player)
+
+        rv = self.app.get('/norcal/players?all=true', headers={'If-None-Match': etag})
+        self.assertEquals(rv.status_code, 200)
+        self.assertNotEquals(rv.headers['ETag'], etag)
+
+    def test_get_player_list_paginated(self):
+        players = []
+        url = '/norcal/players?limit=10'
+        while True:
+            json_data = json.loads(self.app.get(url).data)
+            self.assertTrue(len(json_data['players']) <= 10)
+            players.extend(json_data['players'])
+            if json_data['next'] is None:
+                break
+            url = '/norcal/players?limit=10&after=' + json_data['next']
+
+        self.assertEquals(players, json.loads(self.app.get('/norcal/players').data)['players'])
+
+        rv = self.app.get('/norcal/players?limit=0')
+        self.assertEquals(rv.status_code, 400)
+        rv = self.app.get('/norcal/players?limit=10&after=garbage')
+        self.assertEquals(rv.status_code, 400)
+
+    def test_get_player_changes(self):
+        dao = self.norcal_dao
+        target, deleted = dao.get_all_players()[:2]
+        source = Player(
+            name='blah',
+            aliases=['blah'],
+            ratings=dict(),
+            regions=['norcal'],
+            id=ObjectId())
+        dao.insert_player(source)
+
+        change_stamp = json.loads(self.app.get('/norcal/players?all=true').data)['change_stamp']
+
+        json_data = json.loads(self.app.get('/norcal/players/changes?since={}'.format(change_stamp)).data)
+        self.assertEquals(json_data, {'change_stamp': change_stamp, 'players': [], 'removed': []})
+
+        dao.merge_players(Merge(id=ObjectId(),
+                                requester_user_id='asdf',
+                                source_player_obj_id=source.id,
+                                target_player_obj_id=target.id,
+                                time=datetime.now()))
+        dao.delete_player(deleted)
+
+        json_data = json.loads(self.app.get('/norcal/players/changes?since={}'.format(change_stamp)).data)
+        self.assertEquals(json_data['change_stamp'], dao.get_player_change_stamp())
+        self.assertEquals([p['id'] for p in json_data['players']], [str(target.id)])
+        self.assertEquals(set(json_data['players'][0].keys()),
+                          set(['id', 'name', 'merged', 'merge_children', 'merge_parent', 'regions', 'ratings']))
+        self.assertEquals(sorted(json_data['removed']), sorted([str(source.id), str(deleted.id)]))
+
+        # caught up
+        json_data = json.loads(self.app.get(
+            '/norcal/players/changes?since={}'.format(json_data['change_stamp'])).data)
+        self.assertEquals(json_data['players'], [])
+        self.assertEquals(json_data['removed'], [])
+
+    def test_get_player_changes_requires_since(self):
+        self.assertEquals(self.app.get('/norcal/players/changes').status_code, 400)
+        self.assertEquals(self.app.get('/norcal/players/changes?since=yesterday').status_code, 400)
+
     def test_get_player(self):
         player = self.norcal_dao.get_player_by_alias('gar')
         data = self.app.get('/norcal/players/' + str(player.id)).data
@@ -337,6 +430,46 @@ class TestServer(unittest.TestCase):
         self.assertEquals(json_data['merged'], False)
         self.assertEquals(json_data['merge_parent'], None)
 
+    def test_get_player_fields(self):
+        player = self.norcal_dao.get_player_by_alias('gar')
+        json_data = json.loads(self.app.get(
+            '/norcal/players/{}?fields=name,regions'.format(player.id)).data)
+        self.assertEquals(json_data, {'id': str(player.id), 'name': 'gar', 'regions': ['norcal']})
+
+        rv = self.app.get('/norcal/players/{}?fields=name,password'.format(player.id))
+        self.assertEquals(rv.status_code, 400)
+
+    def test_get_player_list_fields(self):
+        json_data = json.loads(self.app.get('/norcal/players?fields=name').data)
+        self.assertEquals(json_data['players'],
+                          [{'id': str(p.id), 'name': p.name}
+                           for p in self.norcal_dao.iter_all_players()])
+
+        json_data = json.loads(self.app.get('/norcal/players?all=true&limit=5&fields=name,aliases').data)
+        self.assertEquals(len(json_data['players']), 5)
+        self.assertEquals(set(json_data['players'][0].keys()), set(['id', 'name', 'aliases']))
+
+    def test_get_player_batch(self):
+        players = self.norcal_dao.get_all_players()[:3]
+        missing_id = str(ObjectId())
+        ids = [str(players[2].id), missing_id, str(players[0].id), str(players[2].id)]
+        data = self.app.get('/norcal/players:batch?ids=' + ','.join(ids)).data
+        json_data = json.loads(data)
+
+        self.assertEquals([p['id'] for p in json_data['players']],
+                          [str(players[2].id), str(players[0].id)])
+        self.assertEquals(json_data['players'][0],
+                          json.loads(self.app.get('/norcal/players/' + ids[0]).data))
+        self.assertEquals(json_data['not_found'], [missing_id])
+
+    def test_get_player_batch_bad_ids(self):
+        rv = self.app.get('/norcal/players:batch?ids=' + str(ObjectId()) + ',garbage')
+        self.assertEquals(rv.status_code, 400)
+
+        ids = [str(ObjectId()) for _ in xrange(server.MAX_BATCH_SIZE + 1)]
+        rv = self.app.get('/norcal/players:batch?ids=' + ','.join(ids))
+        self.assertEquals(rv.status_code, 400)
+
     def test_get_tournament_list(self):
         def for_region(data, dao):
             json_data = json.loads(data)
@@ -420,6 +553,47 @@ class TestServer(unittest.TestCase):
             self.assertEquals(tournament['regions'], [dao.region_id])
 
 
+    def test_get_tournament_list_paginated(self):
+        tournaments = json.loads(self.app.get('/norcal/tournaments').data)['tournaments']
+
+        for order, expected in [('oldest', tournaments), ('newest', tournaments[::-1])]:
+            pages = []
+            url = '/norcal/tournaments?limit=1&order=' + order
+            while True:
+                json_data = json.loads(self.app.get(url).data)
+                self.assertTrue(len(json_data['tournaments']) <= 1)
+                pages.extend(json_data['tournaments'])
+                if json_data['next'] is None:
+                    break
+                url = '/norcal/tournaments?limit=1&order={}&after={}'.format(
+                    order, json_data['next'])
+            self.assertEquals([t['id'] for t in pages], [t['id'] for t in expected])
+            self.assertEquals(pages[0], expected[0])
+
+    @patch('server.auth_user')
+    def test_get_tournament_list_paginated_include_pending(self, mock_auth_user):
+        mock_auth_user.return_value = self.user
+        pending_tournaments = self.norcal_dao.get_all_pending_tournaments(regions=['norcal'])
+
+        json_data = json.loads(self.app.get(
+            '/norcal/tournaments?includePending=true&order=newest&limit=1').data)
+        self.assertEquals([t['id'] for t in json_data['tournaments'][:len(pending_tournaments)]],
+                          [str(t.id) for t in reversed(pending_tournaments)])
+        self.assertTrue(all(t['pending'] for t in json_data['tournaments'][:len(pending_tournaments)]))
+        self.assertEquals(len(json_data['tournaments']), len(pending_tournaments) + 1)
+
+        # pending tournaments only come with the first page
+        json_data = json.loads(self.app.get(
+            '/norcal/tournaments?includePending=true&order=newest&limit=1&after=' +
+            json_data['next']).data)
+        self.assertEquals(len(json_data['tournaments']), 1)
+        self.assertFalse(any(t['pending'] for t in json_data['tournaments']))
+
+    def test_get_tournament_list_paginated_bad_args(self):
+        for query in ('limit=0', 'limit=100000', 'limit=3&after=garbage', 'limit=3&order=sideways'):
+            rv = self.app.get('/norcal/tournaments?' + query)
+            self.assertEquals(rv.status_code, 400, msg=query)
+
     def test_get_tournament_list_include_pending_not_logged_in(self):
         response = self.app.get('/norcal/tournaments?includePending=true')
         self.assertEqual(response.status_code, 403)
@@ -431,7 +605,7 @@ class TestServer(unittest.TestCase):
 
 
     @patch('server.auth_user')
-    @patch('server.TioScraper')
+    @patch('import_service.TioScraper')
     def test_post_to_tournament_list_tio(self, mock_tio_scraper, mock_auth_user):
         mock_auth_user.return_value = self.user
         scraper = TioScraper.from_file(NORCAL_FILES[0][0], NORCAL_FILES[0][1])
@@ -453,6 +627,35 @@ class TestServer(unittest.TestCase):
         self.assertIsNotNone(pending_tournament)
         self.assertEquals(len(pending_tournament.alias_to_id_map), 59)
 
+        raw_file = self.norcal_dao.get_raw_file_by_id(pending_tournament.raw_id)
+        self.assertEquals(json.loads(raw_file.data), scraper.get_raw().decode('utf-8'))
+
+    @patch('server.auth_user')
+    @patch('import_service.ChallongeScraper')
+    def test_post_to_tournament_list_large_tournament(self, mock_challonge_scraper, mock_auth_user):
+        mock_auth_user.return_value = self.user
+        players = ['player %d' % i for i in xrange(1500)]
+        scraper = mock_challonge_scraper.return_value
+        scraper.get_players.return_value = players
+        scraper.get_matches.return_value = [
+            AliasMatch(winner=players[i], loser=players[i + 1])
+            for i in xrange(0, len(players), 2)]
+        scraper.get_raw.return_value = {'participants': players}
+        scraper.get_date.return_value = datetime(2016, 1, 1)
+        scraper.get_name.return_value = 'big tournament'
+        scraper.get_url.return_value = ''
+        data = {
+            'data': 'data',
+            'type': 'challonge'
+        }
+
+        response = self.app.post('/norcal/tournaments', data=json.dumps(data), content_type='application/json')
+        json_data = json.loads(response.data)
+
+        pending_tournament = self.norcal_dao.get_pending_tournament_by_id(ObjectId(json_data['id']))
+        raw_file = self.norcal_dao.get_raw_file_by_id(pending_tournament.raw_id)
+        self.assertEquals(json.loads(raw_file.data), {'participants': players})
+
     @patch('server.auth_user')
     def test_post_to_tournament_list_tio_missing_bracket(self, mock_auth_user):
         mock_auth_user.return_value = self.user
@@ -466,7 +669,7 @@ class TestServer(unittest.TestCase):
         self.assertEquals(response.status_code, 400)
 
     @patch('server.auth_user')
-    @patch('server.ChallongeScraper')
+    @patch('import_service.ChallongeScraper')
     def test_post_to_tournament_list_challonge(self, mock_challonge_scraper, mock_auth_user):
         mock_auth_user.return_value = self.user
         scraper = TioScraper.from_file(NORCAL_FILES[0][0], NORCAL_FILES[0][1])
@@ -508,6 +711,43 @@ class TestServer(unittest.TestCase):
         response = self.app.post('/texas/tournaments')
         self.assertEquals(response.status_code, 403)
 
+    @patch('server.auth_user')
+    def test_post_bulk_import(self, mock_auth_user):
+        mock_auth_user.return_value = self.user
+        tournaments = []
+        for path, bracket in NORCAL_PENDING_FILES + [(NORCAL_FILES[0][0], 'not a bracket')]:
+            with open(path) as f:
+                tournaments.append({'type': 'tio', 'data': f.read(), 'bracket': bracket})
+
+        response = self.app.post('/norcal/tournaments/bulk',
+                                 data=json.dumps({'tournaments': tournaments}),
+                                 content_type='application/json')
+        json_data = json.loads(response.data)
+
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(len(json_data['results']), 2)
+        self.assertEquals(json_data['results'][0]['status'], 'success')
+        self.assertEquals(json_data['results'][0]['source'], 'bam 6 singles')
+        self.assertEquals(json_data['results'][1]['status'], 'error')
+
+        pending_tournament = self.norcal_dao.get_pending_tournament_by_id(
+            ObjectId(json_data['results'][0]['id']))
+        self.assertIsNotNone(pending_tournament)
+        self.assertEquals(len(pending_tournament.alias_to_id_map),
+                          len(pending_tournament.players))
+
+    @patch('server.auth_user')
+    def test_post_bulk_import_missing_data(self, mock_auth_user):
+        mock_auth_user.return_value = self.user
+        response = self.app.post('/norcal/tournaments/bulk',
+                                 data=json.dumps({'tournaments': [{'type': 'tio'}]}),
+                                 content_type='application/json')
+        self.assertEquals(response.status_code, 400)
+
+    def test_post_bulk_import_invalid_permissions(self):
+        response = self.app.post('/norcal/tournaments/bulk')
+        self.assertEquals(response.status_code, 403)
+
     def setup_finalize_tournament_fixtures(self):
         player_1_id = ObjectId()
         player_2_id = ObjectId()
@@ -704,6 +944,87 @@ class TestServer(unittest.TestCase):
 
         self.cleanup_finalize_tournament_fixtures(fixtures)
 
+    @patch('server.auth_user')
+    def test_finalize_incompletely_mapped_tournament_creates_no_players(self, mock_auth_user):
+        mock_auth_user.return_value = self.user
+        fixtures = self.setup_finalize_tournament_fixtures()
+        fixture_pending_tournaments = fixtures["pending_tournaments"]
+
+        pending_tournament = fixture_pending_tournaments[3]
+        pending_tournament.set_alias_id_mapping('Scar', None)
+        self.norcal_dao.update_pending_tournament(pending_tournament)
+
+        response = self.app.post(
+            '/norcal/tournaments/' + str(pending_tournament.id) + '/finalize')
+        self.assertEquals(response.status_code, 400, msg=str(response.data))
+        self.assertIsNone(self.norcal_dao.get_player_by_alias('Scar'))
+
+        self.cleanup_finalize_tournament_fixtures(fixtures)
+
+    @patch('server.auth_user')
+    def test_finalize_tournament_with_merged_player(self, mock_auth_user):
+        mock_auth_user.return_value = self.user
+        fixtures = self.setup_finalize_tournament_fixtures()
+        fixture_pending_tournaments = fixtures["pending_tournaments"]
+
+        player = fixtures["players"][0]
+        player.merged = True
+        player.merge_parent = fixtures["players"][1].id
+        self.norcal_dao.update_player(player)
+
+        response = self.app.post(
+            '/norcal/tournaments/' + str(fixture_pending_tournaments[1].id) + '/finalize')
+        self.assertEquals(response.status_code, 400, msg=str(response.data))
+        self.assertIsNotNone(self.norcal_dao.get_pending_tournament_by_id(
+            fixture_pending_tournaments[1].id))
+        self.assertIsNone(self.norcal_dao.get_player_by_alias('Scar'))
+
+        self.cleanup_finalize_tournament_fixtures(fixtures)
+
+    @patch('server.auth_user')
+    def test_finalize_tournament_after_interrupted_finalize(self, mock_auth_user):
+        mock_auth_user.return_value = self.user
+        fixtures = self.setup_finalize_tournament_fixtures()
+        fixture_pending_tournaments = fixtures["pending_tournaments"]
+        pending_tournament_id = fixture_pending_tournaments[1].id
+
+        with patch.object(Dao, 'delete_pending_tournament', side_effect=Exception):
+            response = self.app.post(
+                '/norcal/tournaments/' + str(pending_tournament_id) + '/finalize')
+            self.assertEquals(response.status_code, 400)
+
+        response = self.app.post(
+            '/norcal/tournaments/' + str(pending_tournament_id) + '/finalize')
+        self.assertEquals(response.status_code, 200, msg=response.data)
+
+        self.assertIsNone(self.norcal_dao.get_pending_tournament_by_id(pending_tournament_id))
+        tournament = self.norcal_dao.get_tournament_by_id(pending_tournament_id)
+        self.assertIsNotNone(tournament)
+        self.assertEquals(self.norcal_dao.players_col.find({'aliases': 'scar'}).count(), 1)
+        self.assertTrue(self.norcal_dao.get_player_by_alias('Scar').id in tournament.players)
+
+        self.cleanup_finalize_tournament_fixtures(fixtures)
+
+    @patch('server.auth_user')
+    def test_exclude_match_concurrent_update(self, mock_auth_user):
+        mock_auth_user.return_value = self.user
+        tournament = self.norcal_dao.get_all_tournaments(regions=['norcal'])[0]
+
+        with patch.object(Dao, 'set_match_exclusion_by_tournament_id_and_match_id',
+                          side_effect=ConcurrentUpdateException('modified')):
+            response = self.app.post(
+                '/norcal/tournaments/{}/excludeMatch'.format(tournament.id),
+                data={'match_id': '0', 'excluded_tf': 'true'})
+        self.assertEquals(response.status_code, 409, msg=response.data)
+
+    @patch('server.auth_user')
+    def test_exclude_match_tournament_not_found(self, mock_auth_user):
+        mock_auth_user.return_value = self.user
+        response = self.app.post(
+            '/norcal/tournaments/{}/excludeMatch'.format(ObjectId()),
+            data={'match_id': '0', 'excluded_tf': 'true'})
+        self.assertEquals(response.status_code, 404, msg=response.data)
+
     def test_get_tournament(self):
         tournament = self.norcal_dao.get_all_tournaments(regions=['norcal'])[0]
         data = self.app.get('/norcal/tournaments/' + str(tournament.id)).data
@@ -754,6 +1075,29 @@ class TestServer(unittest.TestCase):
         self.assertEquals(len(json_data['players']), len(tournament.players))
         self.assertEquals(len(json_data['matches']), len(tournament.matches))
 
+    def test_get_tournament_fields(self):
+        tournament = self.norcal_dao.get_all_tournaments(regions=['norcal'])[0]
+        full = json.loads(self.app.get('/norcal/tournaments/' + str(tournament.id)).data)
+
+        json_data = json.loads(self.app.get(
+            '/norcal/tournaments/{}?fields=name,matches'.format(tournament.id)).data)
+        self.assertEquals(json_data, {'id': full['id'], 'name': full['name'],
+                                      'matches': full['matches']})
+
+        json_data = json.loads(self.app.get(
+            '/norcal/tournaments?fields=name,players').data)
+        self.assertEquals(set(json_data['tournaments'][0].keys()), set(['id', 'name', 'players']))
+        self.assertEquals(len(json_data['tournaments'][0]['players']), len(tournament.players))
+
+    def test_get_tournament_batch(self):
+        tournaments = self.norcal_dao.get_all_tournaments(regions=['norcal'])
+        ids = [str(t.id) for t in reversed(tournaments)]
+        json_data = json.loads(self.app.get('/norcal/tournaments:batch?ids=' + ','.join(ids)).data)
+
+        self.assertEquals(json_data['tournaments'],
+                          [json.loads(self.app.get('/norcal/tournaments/' + id).data) for id in ids])
+        self.assertEquals(json_data['not_found'], [])
+
     @patch('server.auth_user')
     def test_get_tournament_pending(self,mock_auth_user):
         mock_auth_user.return_value = self.user
@@ -834,6 +1178,61 @@ class TestServer(unittest.TestCase):
         self.assertEquals(ranking_entry['name'], self.norcal_dao.get_player_by_id(db_ranking_entry.player).name)
         self.assertTrue(ranking_entry['rating'] > -3.86)
 
+    def test_get_ranking_history(self):
+        first_ranking = self.norcal_dao.get_latest_ranking()
+        rankings.generate_ranking(self.norcal_dao, now=datetime(2014, 11, 8))
+        second_ranking = self.norcal_dao.get_latest_ranking()
+
+        json_data = json.loads(self.app.get('/norcal/rankings/history').data)
+        self.assertEquals([r['id'] for r in json_data['rankings']],
+                          [str(first_ranking.id), str(second_ranking.id)])
+
+        entry = second_ranking.ranking[0]
+        first_rank = next(e.rank for e in first_ranking.ranking if e.player == entry.player)
+        trajectory = json_data['players'][str(entry.player)]
+        self.assertEquals(len(trajectory), 2)
+        self.assertEquals(trajectory[0]['rank_change'], None)
+        self.assertEquals(trajectory[1]['ranking_id'], str(second_ranking.id))
+        self.assertEquals(trajectory[1]['rank'], entry.rank)
+        self.assertEquals(trajectory[1]['rank_change'], first_rank - entry.rank)
+
+    def test_get_ranking_history_filters(self):
+        rankings.generate_ranking(self.norcal_dao, now=datetime(2014, 11, 8))
+        ranking = self.norcal_dao.get_latest_ranking()
+        player_id = str(ranking.ranking[0].player)
+
+        json_data = json.loads(self.app.get(
+            '/norcal/rankings/history?player={}&since=11/05/14'.format(player_id)).data)
+        self.assertEquals([r['id'] for r in json_data['rankings']], [str(ranking.id)])
+        self.assertEquals(json_data['players'].keys(), [player_id])
+        # the ranking before the window still counts for the rank change
+        first_ranking = self.norcal_dao.get_ranking_history()[0]
+        first_rank = next(e.rank for e in first_ranking.ranking if str(e.player) == player_id)
+        self.assertEquals(json_data['players'][player_id][0]['rank_change'],
+                          first_rank - ranking.ranking[0].rank)
+
+        json_data = json.loads(self.app.get('/norcal/rankings/history?limit=1').data)
+        self.assertEquals([r['id'] for r in json_data['rankings']], [str(ranking.id)])
+        for limit in [0, server.MAX_PAGE_SIZE + 1]:
+            response = self.app.get('/norcal/rankings/history?limit={}'.format(limit))
+            self.assertEquals(response.status_code, 400)
+
+        json_data = json.loads(self.app.get('/norcal/rankings/history?until=11/01/14').data)
+        self.assertEquals(len(json_data['rankings']), 1)
+        self.assertNotEquals(json_data['rankings'][0]['id'], str(ranking.id))
+
+        response = self.app.get('/norcal/rankings/history?since=yesterday')
+        self.assertEquals(response.status_code, 400)
+
+    def test_get_rankings_fields(self):
+        json_data = json.loads(self.app.get('/norcal/rankings?fields=time').data)
+        db_ranking = self.norcal_dao.get_latest_ranking()
+        self.assertEquals(set(json_data.keys()), set(['id', 'time', 'ranking_criteria']))
+        self.assertEquals(json_data['time'], db_ranking.time.strftime("%x"))
+
+        rv = self.app.get('/norcal/rankings?fields=time,nope')
+        self.assertEquals(rv.status_code, 400)
+
     def test_get_rankings_ignore_invalid_player_id(self):
         # delete a player that exists in the rankings
         db_ranking = self.norcal_dao.get_latest_ranking()
@@ -906,6 +1305,76 @@ class TestServer(unittest.TestCase):
         self.assertEquals(json_data['time'], db_ranking.time.strftime("%x"))
         self.assertEquals(len(json_data['ranking']), 0)
 
+    @patch('server.auth_user')
+    @patch('server.datetime')
+    def test_post_rankings_simulate(self, mock_datetime, mock_auth_user):
+        now = datetime(2014, 11, 2)
+
+        mock_datetime.now.return_value = now
+        mock_auth_user.return_value = self.user
+
+        num_rankings = self.norcal_dao.rankings_col.count()
+        db_ranking = self.norcal_dao.get_latest_ranking()
+
+        the_data = {'criteria': [
+            {},
+            {'ranking_num_tourneys_attended': 3, 'ranking_activity_day_limit': 1},
+            {'tournament_qualified_day_limit': 0},
+            {'rating_engine': 'elo'}]}
+        data = self.app.post('/norcal/rankings/simulate', data=json.dumps(the_data),
+                             content_type='application/json').data
+        json_data = json.loads(data)
+
+        self.assertEquals(len(json_data['rankings']), 4)
+        default, strict, unqualified, elo = json_data['rankings']
+        self.assertEquals(default['ranking_criteria'], {
+            'ranking_num_tourneys_attended': 2,
+            'ranking_activity_day_limit': 60,
+            'tournament_qualified_day_limit': 999,
+            'rating_engine': 'trueskill'})
+        self.assertEquals(strict['ranking_criteria']['ranking_num_tourneys_attended'], 3)
+        self.assertEquals(strict['ranking_criteria']['tournament_qualified_day_limit'], 999)
+
+        # same as running the rankings with the default criteria
+        self.assertEquals([(e['id'], e['rank']) for e in default['ranking']],
+                          [(str(e.player), e.rank) for e in db_ranking.ranking])
+        self.assertEquals(default['ranking'][0]['name'],
+                          self.norcal_dao.get_player_by_id(db_ranking.ranking[0].player).name)
+        self.assertEquals(strict['ranking'], [])
+        self.assertEquals(unqualified['ranking'], [])
+
+        # the same players qualify, rated by a different engine
+        self.assertEquals(elo['ranking_criteria']['rating_engine'], 'elo')
+        self.assertEquals(sorted(e['id'] for e in elo['ranking']),
+                          sorted(e['id'] for e in default['ranking']))
+        self.assertTrue(elo['ranking'][0]['rating'] > 1500)
+
+        # nothing was saved
+        self.assertEquals(self.norcal_dao.rankings_col.count(), num_rankings)
+        self.assertEquals(self.norcal_dao.get_latest_ranking().id, db_ranking.id)
+
+    @patch('server.auth_user')
+    def test_post_rankings_simulate_invalid_criteria(self, mock_auth_user):
+        mock_auth_user.return_value = self.user
+
+        response = self.app.post('/norcal/rankings/simulate', data=json.dumps({'criteria': []}),
+                                 content_type='application/json')
+        self.assertEquals(response.status_code, 400)
+
+        the_data = {'criteria': [{'ranking_activity_day_limit': 'soon'}]}
+        response = self.app.post('/norcal/rankings/simulate', data=json.dumps(the_data),
+                                 content_type='application/json')
+        self.assertEquals(response.status_code, 400)
+
+        the_data = {'criteria': [{'rating_engine': 'coin flip'}]}
+        response = self.app.post('/norcal/rankings/simulate', data=json.dumps(the_data),
+                                 content_type='application/json')
+        self.assertEquals(response.status_code, 400)
+
+    def test_post_rankings_simulate_permission_denied(self):
+        response = self.app.post('/texas/rankings/simulate')
+        self.assertEquals(response.status_code, 403)
+
     def test_post_rankings_permission_denied(self):
         response = self.app.post('/texas/rankings')
         self.assertEquals(response.status_code, 403)
@@ -929,6 +1398,32 @@ class TestServer(unittest.TestCase):
         self.assertEqual(json_data['ranking_activity_day_limit'], 90)
         self.assertEqual(json_data['tournament_qualified_day_limit'], 999)
 
+    @patch('server.auth_user')
+    @patch('server.datetime')
+    def test_put_rankings_rating_engine(self, mock_datetime, mock_auth_user):
+        mock_datetime.now.return_value = datetime(2014, 11, 2)
+        mock_auth_user.return_value = self.user
+
+        the_data = {
+            'ranking_num_tourneys_attended': 2,
+            'ranking_activity_day_limit': 60,
+            'tournament_qualified_day_limit': 999,
+            'rating_engine': 'glicko2'
+        }
+        data = self.app.put('/norcal/rankings', data=json.dumps(the_data), content_type='application/json').data
+        self.assertEqual(json.loads(data)['rating_engine'], 'glicko2')
+
+        # rankings are now generated with the region's engine
+        json_data = json.loads(self.app.post('/norcal/rankings').data)
+        self.assertEqual(json_data['ranking_criteria']['rating_engine'], 'glicko2')
+        player = self.norcal_dao.get_player_by_id(ObjectId(json_data['ranking'][0]['id']))
+        self.assertTrue(player.ratings['norcal'].mu > 1500)
+
+        the_data['rating_engine'] = 'coin flip'
+        response = self.app.put('/norcal/rankings', data=json.dumps(the_data), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.norcal_dao.get_region_ranking_criteria('norcal')['rating_engine'], 'glicko2')
+
     def test_put_rankings_permission_denied(self):
 
         the_data = {
@@ -979,6 +1474,16 @@ class TestServer(unittest.TestCase):
         self.assertEquals(match['tournament_name'], tournament.name)
         self.assertEquals(match['tournament_date'], tournament.date.strftime("%x"))
 
+    def test_get_matches_with_opponent_never_played(self):
+        player = self.norcal_dao.get_player_by_alias('gar')
+        opponent = self.norcal_dao.get_all_players()[-1]
+        self.assertIsNone(self.norcal_dao.get_head_to_head(player.id, opponent.id))
+
+        response = self.app.get('/norcal/matches/{}?opponent={}'.format(player.id, opponent.id))
+        self.assertEquals(response.status_code, 200)
+        json_data = json.loads(response.data)
+        self.assertEquals((json_data['wins'], json_data['losses'], json_data['matches']), (0, 0, []))
+
     def test_get_matches_with_opponent(self):
         player = self.norcal_dao.get_player_by_alias('gar')
         opponent = self.norcal_dao.get_player_by_alias('tang')
@@ -1010,6 +1515,107 @@ class TestServer(unittest.TestCase):
         self.assertEquals(match['tournament_name'], tournament.name)
         self.assertEquals(match['tournament_date'], tournament.date.strftime("%x"))
 
+    def test_get_player_stats(self):
+        player = self.norcal_dao.get_player_by_alias('gar')
+        data = self.app.get('/norcal/players/' + str(player.id) + '/stats').data
+        json_data = json.loads(data)
+
+        matches = json.loads(self.app.get('/norcal/matches/' + str(player.id)).data)
+        tournaments = self.norcal_dao.get_all_tournaments(players=[player])
+        self.assertEquals(json_data['id'], str(player.id))
+        self.assertEquals(json_data['wins'], matches['wins'])
+        self.assertEquals(json_data['losses'], matches['losses'])
+        self.assertEquals(json_data['tournaments_attended'], len(tournaments))
+        self.assertEquals(json_data['last_active'], tournaments[-1].date.strftime('%x'))
+
+        # from the ranking run in setUpClass
+        ranking = self.norcal_dao.get_latest_ranking()
+        entry = [e for e in ranking.ranking if e.player == player.id][0]
+        self.assertEquals(len(json_data['rating_history']['norcal']), 1)
+        self.assertEquals(json_data['rating_history']['norcal'][0]['rank'], entry.rank)
+        self.assertTrue(json_data['best_wins']['norcal'])
+
+    def test_get_player_stats_no_tournaments(self):
+        data = self.app.get('/norcal/players/' + str(ObjectId()) + '/stats').data
+        json_data = json.loads(data)
+
+        self.assertEquals(json_data['wins'], 0)
+        self.assertEquals(json_data['tournaments_attended'], 0)
+        self.assertEquals(json_data['rating_history'], {})
+
+    def test_get_head_to_head(self):
+        player = self.norcal_dao.get_player_by_alias('gar')
+        opponent = self.norcal_dao.get_player_by_alias('tang')
+        data = self.app.get('/norcal/headtohead/' + str(player.id) + '?opponent=' + str(opponent.id)).data
+        json_data = json.loads(data)
+
+        tournament = self.norcal_dao.get_all_tournaments(regions=['norcal'])[0]
+        self.assertEquals(json_data, {'player': str(player.id),
+                                      'opponent': str(opponent.id),
+                                      'region': 'norcal',
+                                      'wins': 0,
+                                      'losses': 1,
+                                      'excluded': 0,
+                                      'last_played': tournament.date.strftime('%x')})
+
+        # never played
+        data = self.app.get('/norcal/headtohead/' + str(player.id) + '?opponent=' + str(ObjectId())).data
+        json_data = json.loads(data)
+        self.assertEquals(json_data['wins'], 0)
+        self.assertEquals(json_data['losses'], 0)
+        self.assertIsNone(json_data['last_played'])
+
+    def test_get_head_to_head_all_opponents(self):
+        player = self.norcal_dao.get_player_by_alias('gar')
+        data = self.app.get('/norcal/headtohead/' + str(player.id)).data
+        json_data = json.loads(data)
+
+        self.assertEquals(json_data['player'], str(player.id))
+        matches = json.loads(self.app.get('/norcal/matches/' + str(player.id)).data)
+        self.assertEquals(sum(h['wins'] for h in json_data['opponents']), matches['wins'])
+        self.assertEquals(sum(h['losses'] for h in json_data['opponents']), matches['losses'])
+        self.assertEquals({h['opponent'] for h in json_data['opponents']},
+                          {m['opponent_id'] for m in matches['matches']})
+
+    def test_get_head_to_head_matrix(self):
+        data = self.app.get('/norcal/headtohead').data
+        json_data = json.loads(data)
+
+        player_ids = {p['id'] for p in json_data['players']}
+        self.assertEquals(player_ids, {str(p.id) for p in self.norcal_dao.get_all_players()})
+        self.assertTrue(json_data['head_to_head'])
+        for h in json_data['head_to_head']:
+            self.assertIn(h['player'], player_ids)
+            self.assertIn(h['opponent'], player_ids)
+
+    def test_get_head_to_head_fields(self):
+        player = self.norcal_dao.get_player_by_alias('gar')
+        opponent = self.norcal_dao.get_player_by_alias('tang')
+        json_data = json.loads(self.app.get('/norcal/headtohead/{}?opponent={}&fields=wins,losses'.format(
+            player.id, opponent.id)).data)
+        self.assertEquals(json_data, {'wins': 0, 'losses': 1})
+
+        json_data = json.loads(self.app.get('/norcal/headtohead?fields=player,opponent,wins').data)
+        self.assertTrue(json_data['head_to_head'])
+        for h in json_data['head_to_head']:
+            self.assertEquals(set(h.keys()), set(['player', 'opponent', 'wins']))
+
+    @patch('server.auth_user')
+    def test_exclude_match_updates_head_to_head(self, mock_auth_user):
+        mock_auth_user.return_value = self.user
+        tournament = self.norcal_dao.get_all_tournaments(regions=['norcal'])[0]
+        match = tournament.matches[0]
+
+        rv = self.app.post('/norcal/tournaments/' + str(tournament.id) + '/excludeMatch',
+                           data=json.dumps({'match_id': str(match.match_id), 'excluded_tf': 'true'}),
+                           content_type='application/json')
+        self.assertEquals(rv.status_code, 200, msg=rv.data)
+
+        data = self.app.get('/norcal/headtohead/' + str(match.winner) + '?opponent=' + str(match.loser)).data
+        json_data = json.loads(data)
+        self.assertEquals(json_data['wins'], 0)
+        self.assertEquals(json_data['excluded'], 1)
+
     @patch('server.auth_user')
     def test_get_current_user(self, mock_auth_user):
         mock_auth_user.return_value = self.user
@@ -1409,6 +2015,40 @@ class TestServer(unittest.TestCase):
         self.assertEquals(the_merge.target_player_obj_id, player_one.id)
         self.assertEquals(the_merge.source_player_obj_id, player_two.id)
 
+    @patch('server.auth_user')
+    def test_get_merges(self, mock_auth_user):
+        mock_auth_user.return_value = self.user
+        dao = self.norcal_dao
+        players = dao.get_all_players()[:3]
+        merge_ids = []
+        for day, source in enumerate(players[1:], start=1):
+            merge = Merge(requester_user_id=self.user.id,
+                          source_player_obj_id=source.id,
+                          target_player_obj_id=players[0].id,
+                          time=datetime(2016, 1, day),
+                          id=ObjectId())
+            dao.merges_col.insert(merge.dump(context='db'))
+            merge_ids.append(str(merge.id))
+
+        json_data = json.loads(self.app.get('/norcal/merges').data)
+        self.assertEquals([m['id'] for m in json_data['merges']], merge_ids)
+        self.assertEquals(json_data['merges'][0]['source_player_name'], players[1].name)
+        self.assertEquals(json_data['merges'][0]['target_player_name'], players[0].name)
+        self.assertFalse('rewritten_tournaments' in json_data['merges'][0])
+
+        json_data = json.loads(self.app.get('/norcal/merges?limit=1').data)
+        self.assertEquals(json_data['merges'][0]['id'], merge_ids[0])
+        json_data = json.loads(self.app.get('/norcal/merges?limit=1&after=' + json_data['next']).data)
+        self.assertEquals(json_data['merges'][0]['id'], merge_ids[1])
+        self.assertEquals(json_data['merges'][0]['source_player_name'], players[2].name)
+        self.assertIsNone(json_data['next'])
+
+        json_data = json.loads(self.app.get('/norcal/merges?fields=time').data)
+        self.assertEquals(json_data['merges'][0], {'id': merge_ids[0], 'time': '01/01/16'})
+        json_data = json.loads(self.app.get(
+            '/norcal/merges?fields=source_player_obj_id,target_player_obj_id').data)
+        self.assertEquals(json_data['merges'][0]['source_player_name'], players[1].name)
+
     @patch('server.auth_user')
     def test_put_merge_not_admin(self, mock_auth_user):
         old_admin_regions = self.user.admin_regions
@@ -1523,8 +2163,10 @@ class TestServer(unittest.TestCase):
         self.assertTrue('Set-Cookie' in response.headers.keys(), msg=str(response.headers))
         cookie_string = response.headers['Set-Cookie']
         my_cookie = cookie_string.split('"')[1] #split sessionID out of cookie string
-        result = self.sessions_col.find({"session_id": my_cookie})
+        result = self.sessions_col.find({"token_hash": hash_session_token(my_cookie)})
         self.assertTrue(result.count() == 1, msg=str(result))
+        # we never store the session id itself
+        self.assertEquals(self.sessions_col.find({"session_id": my_cookie}).count(), 0)
 
     def test_put_session_bad_creds(self):
         username = "gar"
@@ -1546,6 +2188,23 @@ class TestServer(unittest.TestCase):
         response = self.app.put('/users/session', data=the_data, content_type='application/json')
         self.assertEquals(response.status_code, 403, msg=response.data)
 
+    def test_put_session_throttled(self):
+        the_data = json.dumps({'username': 'gar', 'password': 'stillworksongarpr'})
+        for _ in xrange(credentials.MAX_FAILED_LOGINS_PER_USERNAME):
+            response = self.app.put('/users/session', data=the_data, content_type='application/json')
+            self.assertEquals(response.status_code, 403, msg=response.data)
+
+        # even with the right password now
+        the_data = json.dumps({'username': 'gar', 'password': 'rip'})
+        response = self.app.put('/users/session', data=the_data, content_type='application/json')
+        self.assertEquals(response.status_code, 429, msg=response.data)
+        self.assertTrue(int(response.headers['Retry-After']) > 0)
+
+        # other users are fine
+        the_data = json.dumps({'username': 'superadmin', 'password': 'admin'})
+        response = self.app.put('/users/session', data=the_data, content_type='application/json')
+        self.assertEquals(response.status_code, 200, msg=response.data)
+
     @patch('server.auth_user')
     def test_delete_finalized_tournament(self, mock_get_user_from_access_token):
         mock_get_user_from_access_token.return_value = self.user
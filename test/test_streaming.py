@@ -0,0 +1,57 @@
+import json
+import unittest
+
+from flask import Flask
+
+import streaming
+
+
+class TestStreaming(unittest.TestCase):
+    def setUp(self):
+        self.pulled = []
+
+        app = Flask(__name__)
+
+        def items(n):
+            for i in xrange(n):
+                self.pulled.append(i)
+                yield {'id': i, 'name': 'player {}'.format(i)}
+
+        @app.route('/players/<int:n>')
+        def players(n):
+            return streaming.stream_json({'change_stamp': 3}, 'players', items(n),
+                                         headers={'ETag': '"players-3"'}, chunk_size=64)
+
+        @app.route('/empty')
+        def empty():
+            return streaming.stream_json({}, 'players', iter([]))
+
+        self.app = app.test_client()
+
+    def test_stream_json(self):
+        response = self.app.get('/players/10')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.content_type, 'application/json')
+        self.assertEquals(response.headers['ETag'], '"players-3"')
+        self.assertEquals(json.loads(response.data), {
+            'change_stamp': 3,
+            'players': [{'id': i, 'name': 'player {}'.format(i)} for i in xrange(10)]})
+
+    def test_stream_json_empty(self):
+        response = self.app.get('/empty')
+        self.assertEquals(json.loads(response.data), {'players': []})
+
+    def test_stream_json_is_lazy(self):
+        with Flask(__name__).test_request_context():
+            def items():
+                for i in xrange(100):
+                    self.pulled.append(i)
+                    yield {'id': i}
+
+            response = streaming.stream_json({}, 'players', items(), chunk_size=64)
+            self.assertTrue(response.is_streamed)
+            self.assertEquals(self.pulled, [])
+
+            # only as many items as fit in the first chunk are pulled
+            next(iter(response.response))
+            self.assertTrue(0 < len(self.pulled) < 100)
@@ -0,0 +1,126 @@
+import datetime
+import json
+import mongomock
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from bson.objectid import ObjectId
+from mock import patch
+
+from config.config import Config
+from scripts import take_backup
+
+TEMPLATE_CONFIG_FILE = 'config/config.ini.template'
+
+# writes its arguments to stdout, like mongodump writes the archive
+FAKE_MONGODUMP = '''#!{}
+import sys
+if '--fail' in sys.argv:
+    sys.exit(1)
+sys.stdout.write(' '.join(sys.argv[1:]))
+'''.format(sys.executable)
+
+
+class TestTakeBackup(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.bin_directory = os.path.join(self.directory, 'bin')
+        os.makedirs(self.bin_directory)
+        self.mongodump = os.path.join(self.bin_directory, 'mongodump')
+        with open(self.mongodump, 'w') as f:
+            f.write(FAKE_MONGODUMP)
+        os.chmod(self.mongodump, stat.S_IRWXU)
+
+        self.config = Config(TEMPLATE_CONFIG_FILE)
+        self.mongo_client = mongomock.MongoClient()
+        db = self.mongo_client[self.config.get_db_name()]
+        db.players.insert_one({'name': 'gaR'})
+        db.regions.insert_one({'_id': 'norcal', 'display_name': 'Norcal'})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read_archive(self, path):
+        with open(os.path.join(self.directory, path)) as f:
+            return f.read()
+
+    def get_query(self, command):
+        return json.loads(command[command.index('-q') + 1]) if '-q' in command else None
+
+    def test_plan_dumps_full(self):
+        dumps = take_backup.plan_dumps(self.config, self.mongo_client, 'full', False)
+        self.assertEquals(dumps, [('DB', take_backup.mongodump_command(self.config, 'DB'))])
+
+    def test_plan_dumps_parallel(self):
+        dumps = take_backup.plan_dumps(self.config, self.mongo_client, 'full', True)
+        self.assertEquals([name for name, command in dumps], ['players', 'regions'])
+        for name, command in dumps:
+            self.assertEquals(command[command.index('-c') + 1], name)
+            self.assertIsNone(self.get_query(command))
+
+    def test_plan_dumps_incremental(self):
+        since = datetime.datetime(2016, 1, 1)
+        dumps = dict(take_backup.plan_dumps(self.config, self.mongo_client, 'incremental',
+                                            False, since=since))
+
+        # players are keyed on ObjectIds, so only new ones are dumped
+        self.assertEquals(self.get_query(dumps['players']),
+                          {'_id': {'$gte': {'$oid': str(ObjectId.from_datetime(since))}}})
+        # regions aren't, so they're dumped in full
+        self.assertIsNone(self.get_query(dumps['regions']))
+
+    def test_plan_dumps_incremental_first_backup(self):
+        dumps = take_backup.plan_dumps(self.config, self.mongo_client, 'incremental', False)
+        for name, command in dumps:
+            self.assertIsNone(self.get_query(command))
+
+    def test_plan_dumps_oplog(self):
+        oplog_ts = {'t': 1451606400, 'i': 3}
+        dumps = take_backup.plan_dumps(self.config, self.mongo_client, 'oplog', False,
+                                       oplog_ts=oplog_ts)
+        self.assertEquals(len(dumps), 1)
+        name, command = dumps[0]
+        self.assertEquals(name, 'oplog')
+        self.assertEquals(command[command.index('-d') + 1], take_backup.OPLOG_DB_NAME)
+        self.assertEquals(command[command.index('-c') + 1], take_backup.OPLOG_COLLECTION_NAME)
+        self.assertEquals(self.get_query(command), {'ts': {'$gt': {'$timestamp': oplog_ts}}})
+
+    def test_stream_dump(self):
+        uploader = take_backup.LocalUploader(self.directory, '/backup/db.archive.gz')
+        size = take_backup.stream_dump([self.mongodump, '--archive', '--gzip'], uploader,
+                                       chunk_size=4)
+
+        self.assertEquals(self.read_archive('backup/db.archive.gz'), '--archive --gzip')
+        self.assertEquals(size, len('--archive --gzip'))
+
+    def test_stream_dump_failure(self):
+        uploader = take_backup.LocalUploader(self.directory, '/db.archive.gz')
+        with self.assertRaises(subprocess.CalledProcessError):
+            take_backup.stream_dump([self.mongodump, '--fail'], uploader)
+        # the upload isn't finished
+        self.assertFalse(uploader.f.closed)
+
+    def test_take_backup_incremental(self):
+        environ = dict(os.environ, PATH=self.bin_directory + os.pathsep + os.environ['PATH'])
+        last_backup = datetime.datetime(2016, 1, 1)
+        take_backup.save_state(self.directory, {'date': last_backup.strftime('%Y-%m-%dT%H:%M:%S')})
+
+        with patch.dict(os.environ, environ), \
+                patch.object(Config, 'get_environment_backups_directory',
+                             return_value=self.directory), \
+                patch('scripts.take_backup.MongoClient', return_value=self.mongo_client):
+            take_backup.take_backup(self.config, mode='incremental', local_dir=self.directory)
+
+        backup_name = datetime.datetime.utcnow().date().isoformat() + '-incremental'
+        archive = self.read_archive(os.path.join(backup_name, 'players.archive.gz'))
+        self.assertIn(str(ObjectId.from_datetime(last_backup)), archive)
+        self.assertNotIn('-q', self.read_archive(os.path.join(backup_name, 'regions.archive.gz')))
+
+        state = take_backup.load_state(self.directory)
+        self.assertGreater(datetime.datetime.strptime(state['date'], '%Y-%m-%dT%H:%M:%S'),
+                           last_backup)
@@ -0,0 +1,85 @@
+import mongomock
+import unittest
+
+from bson.objectid import ObjectId
+from datetime import datetime
+
+from dao import Dao, hash_session_token
+from model import *
+from scripts import validate_db
+
+
+class TestValidateDB(unittest.TestCase):
+    def setUp(self):
+        self.mongo_client = mongomock.MongoClient()
+        self.db = self.mongo_client['garpr_test']
+        self.dao = Dao(None, self.mongo_client, database_name='garpr_test')
+
+        self.player_1 = Player.create_with_default_values('gaR', 'norcal')
+        self.player_1.ratings = {'norcal': Rating(mu=30.0, sigma=5.0)}
+        self.player_2 = Player.create_with_default_values('sfat', 'norcal')
+        self.dao.insert_players([self.player_1, self.player_2])
+
+    def get_ids(self):
+        return dict((name, validate_db.get_ids(self.db[col]))
+                    for name, col in validate_db.ID_SETS.iteritems())
+
+    def test_check_players_only_writes_fixed_fields(self):
+        self.db.players.update_one({'_id': self.player_1.id},
+                                   {'$set': {'regions': ['norcal', 'nowhere']}})
+        self.db.regions.insert_one({'_id': 'norcal', 'display_name': 'Norcal'})
+        change_stamp = self.dao.get_player_change_stamp()
+
+        result = validate_db.check_players(self.db, self.get_ids(), True)
+        self.assertEquals((result['checked'], result['errors'], result['fixed']), (2, 1, 1))
+
+        player = self.db.players.find_one({'_id': self.player_1.id})
+        self.assertEquals(player['regions'], ['norcal'])
+        self.assertEquals(player['sort_name'], 'gar')
+        self.assertGreater(player['change_stamp'], change_stamp)
+        self.assertNotIn('ratings', player)
+        self.assertEquals(self.dao.get_ratings([self.player_1.id]),
+                          {self.player_1.id: {'norcal': Rating(mu=30.0, sigma=5.0)}})
+
+    def test_check_ratings(self):
+        self.db.regions.insert_one({'_id': 'norcal', 'display_name': 'Norcal'})
+        Dao('norcal', self.mongo_client, database_name='garpr_test').update_ratings(
+            {ObjectId(): Rating(mu=25.0, sigma=8.0)})
+
+        result = validate_db.check_ratings(self.db, self.get_ids(), True)
+        self.assertEquals((result['checked'], result['errors'], result['deleted']), (2, 1, 1))
+        self.assertEquals(self.db.ratings.count(), 1)
+
+    def test_check_players_without_tournaments(self):
+        # player_2 was merged into player_3, whose tournaments are all still
+        # stored under player_2's id
+        player_3 = Player.create_with_default_values('mango', 'norcal')
+        self.dao.insert_player(player_3)
+        self.db.players.update_one({'_id': self.player_2.id},
+                                   {'$set': {'merged': True, 'merge_parent': player_3.id}})
+        self.db.tournaments.insert_one({'players': [self.player_2.id]})
+
+        result = validate_db.check_players_without_tournaments(self.db, self.get_ids(), True)
+        self.assertEquals((result['checked'], result['errors'], result['deleted']), (3, 1, 1))
+
+        self.assertEquals(set(p['_id'] for p in self.db.players.find()),
+                          set([self.player_2.id, player_3.id]))
+        self.assertEquals(self.dao.get_player_changes(0)[1], [self.player_1.id])
+        self.assertEquals(self.dao.get_ratings([self.player_1.id]), {})
+
+    def test_check_sessions(self):
+        now = datetime(2016, 1, 1)
+        self.db.users.insert_one({'_id': 'user', 'username': 'gar'})
+        self.db.sessions.insert_many([
+            {'token_hash': hash_session_token('valid'), 'user_id': 'user',
+             'created': now, 'last_seen': now},
+            {'token_hash': hash_session_token('invalid'), 'user_id': 'deleted user',
+             'created': now, 'last_seen': now}])
+
+        result = validate_db.check_sessions(self.db, self.get_ids(), False)
+        self.assertEquals((result['checked'], result['errors'], result['deleted']), (2, 1, 0))
+
+        result = validate_db.check_sessions(self.db, self.get_ids(), True)
+        self.assertEquals((result['errors'], result['deleted']), (1, 1))
+        self.assertEquals([s['token_hash'] for s in self.db.sessions.find()],
+                          [hash_session_token('valid')])
@@ -1,4 +1,6 @@
 angular.module('app.common').service('RegionService', function ($http, PlayerService, TournamentService, RankingsService, MergeService, SessionService) {
+    var TOURNAMENT_PAGE_SIZE = 100;
+
     var service = {
         regionsPromise: $http.get(hostname + 'regions'),
         regions: [],
@@ -31,10 +33,8 @@ angular.module('app.common').service('RegionService', function ($http, PlayerSer
         populateDataForCurrentRegion: function() {
             // get all players instead of just players in region
             var curRegion = this.region;
-            $http.get(hostname + this.region.id + '/players?all=true').
-                success(function(data) {
-                    PlayerService.allPlayerList = data;
-
+            PlayerService.syncAllPlayers(this.region.id).
+                then(function(data) {
                     // filter players for this region
                     PlayerService.playerList = {
                             'players': data.players.filter(
@@ -48,18 +48,35 @@ angular.module('app.common').service('RegionService', function ($http, PlayerSer
                         };
                     });
 
-            var tournamentURL = '/tournaments';
+            // newest first, a page at a time, so the list shows up right away
+            // no matter how many tournaments the region has
+            var tournamentURL = hostname + this.region.id + '/tournaments?order=newest&limit=' +
+                TOURNAMENT_PAGE_SIZE;
             if(SessionService.loggedIn){
-                tournamentURL += '?includePending=true';
+                tournamentURL += '&includePending=true';
             }
-            SessionService.authenticatedGet(hostname + this.region.id + tournamentURL,
-                function(data) {
-                    TournamentService.tournamentList = data.tournaments.reverse();
-                    TournamentService.tournamentList.forEach(function(tournament){
+            // this gets called again after logging in and importing, so start
+            // the lists over and drop pages from any load still in flight
+            var tournamentLoad = service.tournamentLoad = {};
+            TournamentService.tournamentList = [];
+            TournamentService.excludedList = [];
+            var getTournamentPage = function(url) {
+                SessionService.authenticatedGet(url, function(data) {
+                    // the region changed or the list was reloaded while we
+                    // were loading
+                    if(service.region !== curRegion || service.tournamentLoad !== tournamentLoad) return;
+
+                    TournamentService.tournamentList = TournamentService.tournamentList.concat(data.tournaments);
+                    data.tournaments.forEach(function(tournament){
                         if(tournament.excluded == true)
                             TournamentService.excludedList.push(tournament);
-                    })
+                    });
+                    if(data.next){
+                        getTournamentPage(tournamentURL + '&after=' + encodeURIComponent(data.next));
+                    }
                 });
+            };
+            getTournamentPage(tournamentURL);
 
             $http.get(hostname + this.region.id + '/rankings').
                 success(function(data) {
@@ -9,14 +9,20 @@ angular.module('app.headToHead').controller("HeadToHeadController", function($sc
 
     $scope.onChange = function() {
         if ($scope.player1 != null && $scope.player2 != null) {
+            // the record is kept up to date on the server, the matches take
+            // a look through the tournaments
+            $http.get(hostname + $routeParams.region +
+                '/headtohead/' + $scope.player1.id + '?opponent=' + $scope.player2.id).
+                success(function(data) {
+                    $scope.wins = data.wins;
+                    $scope.losses = data.losses;
+                });
             $http.get(hostname + $routeParams.region +
                 '/matches/' + $scope.player1.id + '?opponent=' + $scope.player2.id).
                 success(function(data) {
                     $scope.playerName = $scope.player1.name;
                     $scope.opponentName = $scope.player2.name;
                     $scope.matches = data.matches.reverse();
-                    $scope.wins = data.wins;
-                    $scope.losses = data.losses;
                 });
         }
     };
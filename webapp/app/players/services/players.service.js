@@ -1,7 +1,64 @@
 angular.module('app.players').service('PlayerService', function($http) {
+    var ALL_PLAYERS_STORAGE_KEY = 'allPlayers';
     var service = {
         playerList: null,
         allPlayerList:null,
+        // every player in every region, and the change stamp it's up to date
+        // with, is kept in localStorage. after the first download we only
+        // fetch the players that changed since.
+        syncAllPlayers: function(regionId) {
+            var cached = service.allPlayerList;
+            if (!cached) {
+                try {
+                    cached = JSON.parse(localStorage.getItem(ALL_PLAYERS_STORAGE_KEY));
+                } catch (err) {
+                    cached = null;
+                }
+            }
+
+            var downloadAll = function() {
+                return $http.get(hostname + regionId + '/players?all=true').then(function(response) {
+                    return service.setAllPlayers(response.data);
+                });
+            };
+            if (!cached || cached.change_stamp === undefined) {
+                return downloadAll();
+            }
+            return $http.get(hostname + regionId + '/players/changes?since=' + cached.change_stamp).then(
+                function(response) {
+                    return service.setAllPlayers(service.applyPlayerChanges(cached, response.data));
+                }, downloadAll);
+        },
+        applyPlayerChanges: function(allPlayers, changes) {
+            var replaced = {};
+            changes.players.forEach(function(player) {
+                replaced[player.id] = true;
+            });
+            changes.removed.forEach(function(playerId) {
+                replaced[playerId] = true;
+            });
+
+            var players = allPlayers.players.filter(function(player) {
+                return !replaced[player.id];
+            }).concat(changes.players);
+            players.sort(function(p1, p2) {
+                var name1 = p1.name.toLowerCase();
+                var name2 = p2.name.toLowerCase();
+                if(name1 < name2) return -1;
+                else if(name1 > name2) return 1;
+                else return 0;
+            });
+            return {'players': players, 'change_stamp': changes.change_stamp};
+        },
+        setAllPlayers: function(data) {
+            service.allPlayerList = data;
+            try {
+                localStorage.setItem(ALL_PLAYERS_STORAGE_KEY, JSON.stringify(data));
+            } catch (err) {
+                /* storage full or disabled, download everything next visit */
+            }
+            return data;
+        },
         getPlayerIdFromName: function (name) {
             for (i = 0; i < this.playerList.players.length; i++) {
                 p = this.playerList.players[i]
@@ -15,6 +15,10 @@ angular.module('app.tournaments').controller("TournamentDetailController", funct
     $scope.playerData = {};
     $scope.playerCheckboxState = {};
 
+    // ids per players:batch request. keeps the url well under uWSGI's
+    // request buffer (and the server's limit of 500 ids)
+    var PLAYER_BATCH_SIZE = 100;
+
     $scope.matchCheckbox = null;
     $scope.addMatchWinner = '';
     $scope.addMatchLoser = '';
@@ -191,7 +195,8 @@ angular.module('app.tournaments').controller("TournamentDetailController", funct
         if ($scope.tournament.hasOwnProperty('alias_to_id_map')) {
             $scope.isPendingTournament = true;
 
-            // load individual player detail
+            // load individual player detail, a batch of players per request
+            var playerIds = [];
             $scope.tournament.alias_to_id_map.forEach(
                 function(aliasItem){
                     var player = aliasItem["player_alias"];
@@ -199,19 +204,28 @@ angular.module('app.tournaments').controller("TournamentDetailController", funct
                     $scope.aliasMap[player] = id;
                     if(id != null){
                         $scope.playerCheckboxState[player] = false;
-
-                        // TODO: this generates tons of requests. we should be
-                        // able to do this with one giant request.
-                        $http.get(hostname + $routeParams.region + '/players/' + id).
-                            success(function(data) {
-                                $scope.playerService.addTypeaheadDisplayText(data);
-                                $scope.playerData[player] = data;
-                            });
-
+                        playerIds.push(id);
                     }else{
                         $scope.playerCheckboxState[player] = true;
                     }
                 });
+
+            for(var i = 0; i < playerIds.length; i += PLAYER_BATCH_SIZE){
+                var batchIds = playerIds.slice(i, i + PLAYER_BATCH_SIZE);
+                $http.get(hostname + $routeParams.region + '/players:batch?ids=' + batchIds.join(',')).
+                    success(function(data) {
+                        var playersById = {};
+                        data.players.forEach(function(player){
+                            $scope.playerService.addTypeaheadDisplayText(player);
+                            playersById[player.id] = player;
+                        });
+                        for(var player in $scope.aliasMap){
+                            if(playersById.hasOwnProperty($scope.aliasMap[player])){
+                                $scope.playerData[player] = playersById[$scope.aliasMap[player]];
+                            }
+                        }
+                    });
+            }
         }
     }
     // TODO submission checks! check to make sure everything in $scope.playerData is an object (not a string. string = partially typed box)
@@ -0,0 +1,17 @@
+# entry point for serving the api with uwsgi (see serve_api.py)
+from uwsgidecorators import postfork
+
+import server
+
+from dao import Dao
+
+# runs once, in the uwsgi master before it forks the workers
+Dao.ensure_indexes(server.mongo_client)
+
+
+@postfork
+def create_worker_mongo_client():
+    # MongoClient isn't fork safe, so every worker makes its own
+    server.mongo_client = server.create_mongo_client()
+
+app = server.app